@@ -0,0 +1,4 @@
+from .fake_servers import FakeApiServer
+from .benchmark import run_benchmark, print_report
+
+__all__ = ['FakeApiServer', 'run_benchmark', 'print_report']
@@ -0,0 +1,5 @@
+from google_scholar_scraper.benchmark.benchmark import main
+
+# This is the entry point for the benchmark of the Google Scholar scraper
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+import argparse
+import json
+import math
+import tempfile
+import time
+from sys import exit, platform
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path as p
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.benchmark.fake_servers import FakeApiServer
+from google_scholar_scraper import http_transport
+from google_scholar_scraper.result_files import read_rows, RowWriter
+
+# The representative workloads: their kind, and the number of queries (or
+# files) and of results per query (or rows per file)
+workloads = {
+    'scrape-1x1000': ('scrape', 1, 1000),
+    'scrape-500x20': ('scrape', 500, 20),
+    'doi-500x20': ('doi', 500, 20),
+    'merge-5000': ('merge', 5000, 20),
+    'end-to-end-500x20': ('end-to-end', 500, 20),
+    'pipeline-500x20': ('pipeline', 500, 20),
+}
+
+
+def _query(idx):
+    """Build the search query of a workload from its index. Only letters are
+    used, so every query has its own output file name"""
+    letters = ''
+    while True:
+        letters = chr(ord('a') + idx % 26) + letters
+        idx //= 26
+        if idx == 0:
+            return f'bench {letters}'
+
+
+def _write_result_files(directory, num_files, rows_per_file, output_format):
+    """Write files of search results, as the scraper would, sharing a fifth of
+    their rows with the previous file so merging has duplicates to remove.
+    Return their paths"""
+    directory.mkdir(exist_ok=True, parents=True)
+    fieldnames = [global_vars.author_key, global_vars.pub_year_key,
+                  global_vars.title_key, global_vars.scholar_link_key, global_vars.pub_url_key,
+                  global_vars.gs_rank_key, global_vars.num_citations_key]
+    files = []
+    for file_idx in range(num_files):
+        file_path = directory / f'results_{file_idx}.{output_format}'
+        with RowWriter(file_path, fieldnames) as writer:
+            for row_idx in range(rows_per_file):
+                key = file_idx * rows_per_file + row_idx
+                if file_idx > 0 and row_idx % 5 == 0:
+                    key -= rows_per_file
+                writer.writerow(dict(zip(fieldnames, [
+                    'A Author; B Author', str(1990 + key % 35), f'Benchmark publication {key}',
+                    f'https://scholar.google.com/scholar?cluster={key}',
+                    f'https://example.org/{key}', str(row_idx + 1), str(key % 100)])))
+        files.append(file_path)
+    return files
+
+
+def _count_rows(files):
+    """Count the rows of the given files of search results"""
+    return sum(1 for file_path in files for _ in read_rows(file_path))
+
+
+def _disk_usage(directory):
+    """Return the size in megabytes of the files in a directory"""
+    return sum(x.stat().st_size for x in directory.rglob('*') if x.is_file()) / (1024 * 1024)
+
+
+def _peak_memory():
+    """Return the peak resident memory of the current process in megabytes, or
+    None if it cannot be measured on this platform"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / (1024 * 1024 if platform == 'darwin' else 1024)
+
+
+def _run_workload(kind, num_queries, num_results, settings, work_dir):
+    """Run a workload in the current process against the stand-in servers, and
+    return its elapsed time, the number of rows it processed, the peak memory
+    of the process, and the size of the files it read and wrote"""
+    # Imported here, so the memory of the process only includes what the
+    # workload needs
+    from google_scholar_scraper.serp_query import scrape_google_scholar
+    from google_scholar_scraper.crossref_query.crossref_query import crossref_query
+    from google_scholar_scraper.crossref_query.doi_pipeline import DoiPipeline
+    from google_scholar_scraper.utils import merge_search
+
+    http_transport.configure(max_connections=settings['http_max_connections'])
+    work_dir = p(work_dir)
+    output_dir = work_dir / 'output'
+    output_dir.mkdir(exist_ok=True, parents=True)
+    # The input files of the DOI lookups and merges are not part of the timing
+    if kind in ('doi', 'merge'):
+        files = _write_result_files(work_dir / 'input', num_queries, num_results,
+                                    settings['output_format'])
+
+    start_time = time.perf_counter()
+    if kind in ('scrape', 'end-to-end'):
+        files = [scrape_google_scholar('benchmark', _query(idx), num_results, output_dir, False,
+                                       settings['concurrency'], settings['serp_rate_limit'],
+                                       api_url=settings['serp_api_url'],
+                                       output_format=settings['output_format'])
+                 for idx in range(num_queries)]
+    # The same as end-to-end, but looking up the DOIs while the queries are scraped
+    if kind == 'pipeline':
+        doi_pipeline = DoiPipeline('benchmark@example.org', False, settings['crossref_concurrency'],
+                                   api_url=settings['crossref_api_url'])
+        files = []
+        for idx in range(num_queries):
+            files.append(scrape_google_scholar('benchmark', _query(idx), num_results, output_dir,
+                                               False, settings['concurrency'],
+                                               settings['serp_rate_limit'],
+                                               api_url=settings['serp_api_url'],
+                                               output_format=settings['output_format'],
+                                               on_rows=doi_pipeline.put))
+            doi_pipeline.add_file(files[-1])
+        doi_pipeline.close()
+    if kind in ('doi', 'end-to-end'):
+        crossref_query('benchmark@example.org', False, files,
+                       settings['crossref_concurrency'], api_url=settings['crossref_api_url'])
+    if kind in ('merge', 'end-to-end', 'pipeline'):
+        merge_search(files, output_dir, False, settings['output_format'])
+    elapsed = time.perf_counter() - start_time
+
+    return {'elapsed': elapsed, 'rows': _count_rows(files), 'peak_memory': _peak_memory(),
+            'disk_usage': _disk_usage(work_dir)}
+
+
+def run_benchmark(names, scale=1.0, latency=global_vars.benchmark_latency,
+                  error_rate=global_vars.benchmark_error_rate,
+                  serp_results=global_vars.benchmark_serp_results,
+                  crossref_hit_rate=global_vars.benchmark_crossref_hit_rate,
+                  concurrency=global_vars.default_concurrency,
+                  serp_rate_limit=global_vars.benchmark_serp_rate_limit,
+                  crossref_concurrency=global_vars.default_crossref_concurrency,
+                  http_max_connections=global_vars.default_http_max_connections,
+                  output_format=global_vars.default_output_format, verbose=False):
+    """Run the given workloads against local stand-in SerpApi and Crossref
+    servers, each in a fresh process so its peak memory can be measured, and
+    return a list with the results of each workload. The number of queries (or
+    files) of every workload is multiplied by the scale."""
+    server = FakeApiServer(latency, error_rate, serp_results, crossref_hit_rate).start()
+    settings = {'concurrency': concurrency, 'serp_rate_limit': serp_rate_limit,
+                'crossref_concurrency': crossref_concurrency,
+                'http_max_connections': http_max_connections,
+                'output_format': output_format,
+                'serp_api_url': server.serp_api_url,
+                'crossref_api_url': server.crossref_api_url}
+    results = []
+    try:
+        for name in names:
+            kind, num_queries, num_results = workloads[name]
+            num_queries = max(math.ceil(num_queries * scale), 1)
+            if (verbose):
+                print(f'\nRunning the {name} workload ({num_queries} x {num_results})')
+            before = server.snapshot()
+            with tempfile.TemporaryDirectory() as work_dir, \
+                    ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                try:
+                    result = executor.submit(_run_workload, kind, num_queries, num_results,
+                                             settings, work_dir).result()
+                # The scraper exits if it runs out of retry attempts
+                except SystemExit as e:
+                    print(f'\nError: The {name} workload failed (exit code {e.code})')
+                    continue
+            after = server.snapshot()
+            pages = sum(after[x] - before[x] for x in ('serp_requests', 'crossref_requests'))
+            results.append({
+                'workload': name, 'queries': num_queries, 'results': num_results,
+                'elapsed': round(result['elapsed'], 3), 'pages': pages,
+                'pages_per_second': round(pages / result['elapsed'], 1),
+                'rows': result['rows'],
+                'rows_per_second': round(result['rows'] / result['elapsed'], 1),
+                'peak_memory_mb': round(result['peak_memory'], 1)
+                if result['peak_memory'] is not None else None,
+                'disk_mb': round(result['disk_usage'], 2),
+                'errors': after['errors'] - before['errors']})
+    finally:
+        server.stop()
+    return results
+
+
+def print_report(results):
+    """Print a table with the results of the workloads"""
+    print(f'\n{"Workload":<20}{"Time (s)":>10}{"Pages":>8}{"Pages/s":>10}{"Rows":>9}'
+          f'{"Rows/s":>11}{"Peak MB":>9}{"Disk MB":>9}{"Errors":>8}')
+    for x in results:
+        peak_memory = '-' if x['peak_memory_mb'] is None else x['peak_memory_mb']
+        print(f'{x["workload"]:<20}{x["elapsed"]:>10}{x["pages"]:>8}{x["pages_per_second"]:>10}'
+              f'{x["rows"]:>9}{x["rows_per_second"]:>11}{peak_memory:>9}{x["disk_mb"]:>9}{x["errors"]:>8}')
+
+
+def main():
+    """Command line interface to run the benchmark workloads"""
+    parser = argparse.ArgumentParser(prog='Google Scholar Scraper Benchmark',
+                                     description='Measure the throughput of the scraper against local stand-in SerpApi and Crossref servers, without spending any searches.')
+    parser.add_argument('workloads', nargs='*',
+                        help=f'The workloads to run. Default = all of them ({", ".join(workloads)}).')
+    parser.add_argument('-s', '--scale',
+                        help='Multiplies the number of queries (or files) of every workload. Default = 1.',
+                        default=1.0, type=float)
+    parser.add_argument('--latency',
+                        help=f'Sets the latency in seconds of every response of the stand-in servers. Default = {global_vars.benchmark_latency}.',
+                        default=global_vars.benchmark_latency, type=float)
+    parser.add_argument('--error-rate',
+                        help=f'Sets the fraction of requests which fail with a server error. Default = {global_vars.benchmark_error_rate}.',
+                        default=global_vars.benchmark_error_rate, type=float)
+    parser.add_argument('--serp-results',
+                        help=f'Sets the number of search results of every query. Default = {global_vars.benchmark_serp_results}.',
+                        default=global_vars.benchmark_serp_results, type=int)
+    parser.add_argument('--crossref-hit-rate',
+                        help=f'Sets the fraction of Crossref lookups which find a DOI. Default = {global_vars.benchmark_crossref_hit_rate}.',
+                        default=global_vars.benchmark_crossref_hit_rate, type=float)
+    parser.add_argument('-c', '--concurrency',
+                        help=f'Sets the number of SerpApi requests per query performed at the same time. Default = {global_vars.default_concurrency}.',
+                        default=global_vars.default_concurrency, type=int)
+    parser.add_argument('--serp-rate-limit',
+                        help=f'Sets the maximum number of SerpApi requests per second. Default = {global_vars.benchmark_serp_rate_limit}.',
+                        default=global_vars.benchmark_serp_rate_limit, type=float)
+    parser.add_argument('-C', '--crossref-concurrency',
+                        help=f'Sets the number of Crossref lookups performed at the same time. Default = {global_vars.default_crossref_concurrency}.',
+                        default=global_vars.default_crossref_concurrency, type=int)
+    parser.add_argument('--http-max-connections',
+                        help=f'Sets the maximum number of keep-alive HTTP connections. Default = {global_vars.default_http_max_connections}.',
+                        default=global_vars.default_http_max_connections, type=int)
+    parser.add_argument('--output-format',
+                        help=f'Sets the format of the files of search results (csv or parquet). Default = {global_vars.default_output_format}.',
+                        choices=['csv', 'parquet'], default=global_vars.default_output_format)
+    parser.add_argument('-o', '--json-output',
+                        help='Set the path of a JSON file to save the results into, e.g. to compare them between versions.',
+                        type=str)
+    parser.add_argument('-v', '--verbose',
+                        help='Verbose logging mode.',
+                        action='store_true')
+    args = parser.parse_args()
+
+    # Check that every requested workload exists
+    unknown = [x for x in args.workloads if x not in workloads]
+    if unknown:
+        print(
+            f'\nError: unknown workloads ({", ".join(unknown)}). Available workloads: {", ".join(workloads)}')
+        exit(406)
+
+    results = run_benchmark(args.workloads or list(workloads), args.scale, args.latency,
+                            args.error_rate, args.serp_results, args.crossref_hit_rate,
+                            args.concurrency, args.serp_rate_limit, args.crossref_concurrency,
+                            args.http_max_connections, args.output_format, args.verbose)
+    print_report(results)
+    if (args.json_output):
+        with open(args.json_output, 'w', encoding='utf-8') as json_file:
+            json.dump({'settings': {x: y for (x, y) in vars(args).items() if x != 'json_output'},
+                       'results': results}, json_file, indent=2)
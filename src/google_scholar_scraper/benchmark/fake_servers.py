@@ -0,0 +1,202 @@
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib import parse
+from google_scholar_scraper.config import global_vars
+
+
+class _FakeApiHandler(BaseHTTPRequestHandler):
+    """Handler of the requests to the stand-in server, answering the SerpApi
+    search endpoint and the Crossref works endpoint"""
+    # Keep the connections alive, as the real APIs do, and send the headers and
+    # body of the responses without waiting for acknowledgements
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        """Do not log every request"""
+
+    def _send_json(self, status, body, headers=None):
+        """Send a JSON response with the given status code and extra headers"""
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for (key, value) in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        """Answer a SerpApi or Crossref request after the configured latency,
+        failing with a server error at the configured rate"""
+        url = parse.urlsplit(self.path)
+        params = dict(parse.parse_qsl(url.query))
+        if url.path == '/account.json':
+            (status, body) = self.server.serp_account(params.get('api_key'))
+            self._send_json(status, body)
+            return
+        if url.path == '/search':
+            service = 'serp'
+        elif url.path == '/works':
+            service = 'crossref'
+        else:
+            self._send_json(404, {'error': 'Not found'})
+            return
+        failed = self.server.simulate(service)
+        if failed:
+            self._send_json(503, {'error': 'Simulated server error'})
+        elif service == 'serp':
+            # Reject the unknown keys and the ones out of searches, as SerpApi does
+            error = self.server.charge_search(params.get('api_key'))
+            if error is not None:
+                self._send_json(*error)
+            else:
+                self._send_json(200, self.server.serp_response(params))
+        else:
+            self._send_json(200, self.server.crossref_response(params), {
+                'X-Rate-Limit-Limit': str(self.server.crossref_rate_limit),
+                'X-Rate-Limit-Interval': '1s'})
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    """Local stand-in for the SerpApi and Crossref APIs, so the scraper can be
+    benchmarked without spending searches. Every query has the same number of
+    search results, and Crossref finds a DOI for a fraction of the lookups.
+    Responses are delayed by the given latency (in seconds), and fail with a
+    503 error at the given rate. If accounts are given (a dictionary of the
+    searches left of each API key), only their keys are accepted, and each
+    search is charged to its key until it runs out of searches. The search
+    results of a query span the years 1990 to 2024, can be narrowed to a range
+    of years, and only the first ones up to the result cap are returned, as
+    Google Scholar does."""
+    daemon_threads = True
+
+    def __init__(self, latency=global_vars.benchmark_latency,
+                 error_rate=global_vars.benchmark_error_rate,
+                 serp_results=global_vars.benchmark_serp_results,
+                 crossref_hit_rate=global_vars.benchmark_crossref_hit_rate,
+                 crossref_rate_limit=global_vars.benchmark_crossref_rate_limit, seed=1,
+                 serp_accounts=None, result_cap=global_vars.scholar_result_cap):
+        super().__init__(('127.0.0.1', 0), _FakeApiHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.serp_results = serp_results
+        self.crossref_hit_rate = crossref_hit_rate
+        self.crossref_rate_limit = crossref_rate_limit
+        self.serp_accounts = dict(serp_accounts) if serp_accounts is not None else None
+        self.result_cap = result_cap
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # Counters of the requests received and the errors simulated
+        self.counts = {'serp_requests': 0, 'crossref_requests': 0, 'errors': 0}
+        self._thread = None
+
+    @property
+    def serp_api_url(self):
+        """URL replacing the SerpApi search URL"""
+        return f'http://127.0.0.1:{self.server_address[1]}/search'
+
+    @property
+    def crossref_api_url(self):
+        """URL replacing the Crossref API URL"""
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        """Serve the requests in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving the requests"""
+        self.shutdown()
+        self.server_close()
+
+    def snapshot(self):
+        """Return a copy of the request counters"""
+        with self._lock:
+            return dict(self.counts)
+
+    def simulate(self, service):
+        """Count a request, wait for the latency, and return whether it should
+        fail"""
+        with self._lock:
+            self.counts[f'{service}_requests'] += 1
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.counts['errors'] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return failed
+
+    def serp_account(self, api_key):
+        """Return the status code and body of the account endpoint of a key"""
+        with self._lock:
+            if self.serp_accounts is not None and api_key not in self.serp_accounts:
+                return (401, {'error': 'Invalid API key. Your API key should be here: https://serpapi.com/manage-api-key'})
+            searches_left = self.serp_accounts[api_key] \
+                if self.serp_accounts is not None else global_vars.benchmark_serp_results
+        return (200, {'plan_searches_left': searches_left, 'extra_credit': 0,
+                      'total_searches_left': searches_left, 'this_hour_searches': 0,
+                      'account_rate_limit_per_hour': 1000000})
+
+    def charge_search(self, api_key):
+        """Charge a search to its key, returning the status code and body of
+        the error if the key is not accepted"""
+        with self._lock:
+            if self.serp_accounts is None:
+                return None
+            if api_key not in self.serp_accounts:
+                return (401, {'error': 'Invalid API key. Your API key should be here: https://serpapi.com/manage-api-key'})
+            if self.serp_accounts[api_key] <= 0:
+                return (429, {'error': 'Your account has run out of searches.'})
+            self.serp_accounts[api_key] -= 1
+        return None
+
+    def serp_response(self, params):
+        """Build a page of Google Scholar search results of a query, or of the
+        publications citing another one, in the format of SerpApi"""
+        start, num = int(params.get('start', 0)), int(params.get('num', 10))
+        # Results of the same query (or cited publication) are always the same
+        query_id = zlib.crc32(params['q'].encode('utf-8') if 'q' in params
+                              else f'cites:{params.get('cites', '')}'.encode('utf-8'))
+        # The search result with index idx is from the year 1990 + idx % 35
+        indices = range(self.serp_results)
+        if 'as_ylo' in params or 'as_yhi' in params:
+            (year_low, year_high) = (int(params.get('as_ylo', 0)), int(params.get('as_yhi', 9999)))
+            indices = [x for x in indices if year_low <= 1990 + x % 35 <= year_high]
+        results = []
+        for (position, idx) in enumerate(indices[start:min(start + num, self.result_cap)]):
+            results.append({
+                'position': position,
+                'title': f'Benchmark publication {query_id}-{idx}',
+                'link': f'https://example.org/{query_id}/{idx}',
+                'publication_info': {
+                    'summary': f'A Author, B Author - Journal of Benchmarks, {1990 + idx % 35} - example.org',
+                    'authors': [{'name': 'A Author'}, {'name': 'B Author'}]},
+                'inline_links': {
+                    'versions': {'cluster_id': str(query_id * 100000 + idx)},
+                    'cited_by': {'total': idx % 100,
+                                 'cites_id': str(query_id * 100000 + idx)}}})
+        # SerpApi leaves out the organic results when there are none
+        response = {'search_metadata': {'status': 'Success'},
+                    'search_information': {'total_results': len(indices)}}
+        if results:
+            response['organic_results'] = results
+        return response
+
+    def crossref_response(self, params):
+        """Build the response of a Crossref works query, in the format of the
+        Crossref API"""
+        query = params.get('query', '')
+        rows = int(params.get('rows', 20))
+        # Whether a DOI is found depends only on the query
+        query_id = zlib.crc32(query.encode('utf-8'))
+        items = [{'DOI': f'10.5555/benchmark.{query_id}'}] \
+            if rows > 0 and query_id % 1000 < self.crossref_hit_rate * 1000 else []
+        return {'status': 'ok', 'message-type': 'work-list',
+                'message': {'total-results': len(items), 'items': items}}
@@ -0,0 +1,94 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from sys import exit
+from google_scholar_scraper.config import global_vars
+
+# Code run in a fresh interpreter to time the import of a module, reporting
+# the heavy optional dependencies it loaded
+_child_code = """import json, sys, time
+start_time = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start_time
+print(json.dumps({{'elapsed': elapsed, 'loaded': [x for x in {heavy!r} if x in sys.modules]}}))
+"""
+
+
+def _parse_importtime(stderr, top):
+    """Return the modules with the largest cumulative import times (in
+    milliseconds) from the output of python -X importtime"""
+    times = []
+    for line in stderr.splitlines():
+        # Lines look like: import time:   self [us] | cumulative | package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        times.append((module.strip(), int(cumulative) / 1000))
+    return sorted(times, key=lambda x: -x[1])[:top]
+
+
+def measure_import_time(module='google_scholar_scraper.main', runs=global_vars.import_time_runs,
+                        heavy=global_vars.import_heavy_modules, top=10):
+    """Import a module in fresh interpreters, and return the median and best
+    import times in milliseconds, the heavy optional dependencies it loaded,
+    and the slowest modules it imported (from the last run)"""
+    times = []
+    for _ in range(max(runs, 1)):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                                  _child_code.format(module=module, heavy=tuple(heavy))],
+                                 capture_output=True, text=True, check=True)
+        result = json.loads(process.stdout)
+        times.append(result['elapsed'] * 1000)
+    return {'module': module, 'runs': len(times),
+            'median_ms': round(statistics.median(times), 1), 'best_ms': round(min(times), 1),
+            'heavy_modules_loaded': result['loaded'],
+            'slowest_imports': [{'module': x, 'cumulative_ms': round(y, 1)}
+                                for (x, y) in _parse_importtime(process.stderr, top)]}
+
+
+def print_import_report(result):
+    """Print the import times of a module and its slowest imports"""
+    print(f'\nImport of {result["module"]}: {result["median_ms"]} ms median, '
+          f'{result["best_ms"]} ms best ({result["runs"]} runs)')
+    print('Heavy modules loaded: ' + (', '.join(result['heavy_modules_loaded']) or 'none'))
+    print(f'\n{"Module":<60}{"Cumulative ms":>15}')
+    for x in result['slowest_imports']:
+        print(f'{x["module"]:<60}{x["cumulative_ms"]:>15}')
+
+
+def main():
+    """Command line interface to measure the import time of the scraper"""
+    parser = argparse.ArgumentParser(prog='Google Scholar Scraper Import Benchmark',
+                                     description='Measure how long starting the scraper takes, i.e. importing its entry point in a fresh interpreter.')
+    parser.add_argument('module', nargs='?', default='google_scholar_scraper.main',
+                        help='The module to import. Default = google_scholar_scraper.main.')
+    parser.add_argument('-r', '--runs',
+                        help=f'Sets the number of fresh interpreters to time the import in. Default = {global_vars.import_time_runs}.',
+                        default=global_vars.import_time_runs, type=int)
+    parser.add_argument('--max-ms',
+                        help="""Sets the maximum median import time in milliseconds.
+                        The benchmark fails if it is exceeded, or if any heavy
+                        optional dependency is loaded on import.""",
+                        type=float)
+    parser.add_argument('-o', '--json-output',
+                        help='Set the path of a JSON file to save the results into, e.g. to compare them between versions.',
+                        type=str)
+    args = parser.parse_args()
+
+    result = measure_import_time(args.module, args.runs)
+    print_import_report(result)
+    if (args.json_output):
+        with open(args.json_output, 'w', encoding='utf-8') as json_file:
+            json.dump(result, json_file, indent=2)
+    # Fail if the import got slower than allowed, e.g. in a CI job
+    if (args.max_ms is not None and
+            (result['median_ms'] > args.max_ms or result['heavy_modules_loaded'])):
+        print(
+            f'\nError: the import takes {result["median_ms"]} ms (maximum {args.max_ms} ms) and loads {len(result["heavy_modules_loaded"])} heavy modules')
+        exit(406)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+import argparse
+import contextvars
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path as p
+from sys import exit
+from urllib import parse
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.retry import get_retrier
+from google_scholar_scraper.metrics import get_metrics
+from google_scholar_scraper.result_files import read_columns, RowWriter
+from google_scholar_scraper.serp_query.serp_cache import SerpCache
+from google_scholar_scraper.serp_query.serp_query import _fetch_json, _parse_result
+from google_scholar_scraper.serp_query.credit_budget import CreditBudget, BudgetExhausted
+from google_scholar_scraper.serp_query.response_archive import ResponseArchive
+from google_scholar_scraper.serp_query.key_pool import KeyPool, KeysExhausted, KeysRejected, \
+    load_keys
+
+# Columns of the node and edge files of the citation graph
+node_fieldnames = [global_vars.cluster_id_key, global_vars.depth_key, global_vars.author_key,
+                   global_vars.pub_year_key, global_vars.title_key, global_vars.scholar_link_key,
+                   global_vars.pub_url_key, global_vars.num_citations_key]
+edge_fieldnames = [global_vars.citing_key, global_vars.cited_key]
+
+# Cluster ID in a Google Scholar publication page link
+_cluster_regex = re.compile(r'cluster=(\d+)')
+
+
+class CrawlState:
+    """State of a citation graph crawl, stored in an SQLite database in its
+    output directory, so an interrupted crawl resumes where it stopped. The
+    nodes table is the visited set, indexed on the cluster ID of each
+    publication, with the depth it was first found at and how far its citing
+    publications were expanded. The nodes at a depth which are not expanded
+    yet are the frontier of the crawl."""
+
+    def __init__(self, output_dir):
+        p(output_dir).mkdir(exist_ok=True, parents=True)
+        # A single connection shared by all the concurrent expansions,
+        # protected by a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(p(output_dir) / 'crawl.sqlite3'),
+                                     check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS nodes (
+                cluster_id TEXT PRIMARY KEY,
+                cites_id TEXT,
+                depth INTEGER NOT NULL,
+                author TEXT,
+                pub_year TEXT,
+                title TEXT,
+                scholar_link TEXT,
+                pub_url TEXT,
+                num_citations INTEGER,
+                next_start INTEGER NOT NULL DEFAULT 0,
+                expanded INTEGER NOT NULL DEFAULT 0)""")
+            # Index used to find the frontier of each depth
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS nodes_frontier ON nodes (expanded, depth)')
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS edges (
+                citing TEXT NOT NULL,
+                cited TEXT NOT NULL,
+                PRIMARY KEY (citing, cited))""")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL)""")
+
+    def get(self, key):
+        """Return a counter of the crawl (e.g. the credits used), or 0"""
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _add_nodes(self, nodes, depth):
+        """Insert the (node, row) tuples not visited yet at the depth. Nodes
+        without citing publications need no expansion"""
+        self._conn.executemany(
+            'INSERT OR IGNORE INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)',
+            [(x['cluster_id'], x['cites_id'], depth, row[global_vars.author_key],
+              row[global_vars.pub_year_key], row[global_vars.title_key],
+              row[global_vars.scholar_link_key], row[global_vars.pub_url_key],
+              row[global_vars.num_citations_key],
+              int(not x['cites_id'] or not row[global_vars.num_citations_key]))
+             for (x, row) in nodes])
+
+    def add_seeds(self, nodes, credits=0, seeded=True):
+        """Add the seed nodes of the crawl at depth 0, using the given credits,
+        and record whether the crawl is fully seeded"""
+        with self._lock, self._conn:
+            self._add_nodes(nodes, 0)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('seeded', ?)", (int(seeded),))
+            self._conn.execute("""INSERT INTO meta VALUES ('credits', ?)
+                ON CONFLICT (key) DO UPDATE SET value = value + excluded.value""", (credits,))
+
+    def frontier(self, depth):
+        """Return the (cluster ID, cites ID, next start, number of citations)
+        tuples of the nodes at the depth which are not fully expanded yet"""
+        with self._lock:
+            return self._conn.execute("""SELECT cluster_id, cites_id, next_start, num_citations
+                FROM nodes WHERE expanded = 0 AND depth = ? ORDER BY rowid""", (depth,)).fetchall()
+
+    def page_saved(self, cluster_id, nodes, depth, next_start, expanded, credits):
+        """Record a page of publications citing a node, in a single
+        transaction: the new nodes at the depth, the edges, how far the node is
+        expanded and the credits used"""
+        with self._lock, self._conn:
+            self._add_nodes(nodes, depth)
+            self._conn.executemany('INSERT OR IGNORE INTO edges VALUES (?, ?)',
+                                   [(x['cluster_id'], cluster_id) for (x, _) in nodes])
+            self._conn.execute('UPDATE nodes SET next_start = ?, expanded = ? WHERE cluster_id = ?',
+                               (next_start, int(expanded), cluster_id))
+            self._conn.execute("""INSERT INTO meta VALUES ('credits', ?)
+                ON CONFLICT (key) DO UPDATE SET value = value + excluded.value""", (credits,))
+
+    def counts(self):
+        """Return the numbers of nodes and edges"""
+        with self._lock:
+            return (self._conn.execute('SELECT COUNT(*) FROM nodes').fetchone()[0],
+                    self._conn.execute('SELECT COUNT(*) FROM edges').fetchone()[0])
+
+    def write(self, nodes_path, edges_path):
+        """Write the nodes, in the order they were found, and the edges of the
+        graph to their CSV files"""
+        with self._lock:
+            with RowWriter(nodes_path, node_fieldnames, 'csv') as writer:
+                for row in self._conn.execute("""SELECT cluster_id, depth, author, pub_year,
+                        title, scholar_link, pub_url, num_citations FROM nodes ORDER BY rowid"""):
+                    writer.writerow(dict(zip(node_fieldnames, row)))
+            with RowWriter(edges_path, edge_fieldnames, 'csv') as writer:
+                for row in self._conn.execute('SELECT citing, cited FROM edges ORDER BY rowid'):
+                    writer.writerow(dict(zip(edge_fieldnames, row)))
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._conn.close()
+
+
+def _node(result, start):
+    """Return the node of a search result (its cluster ID and cites ID, which
+    may be missing) and its row"""
+    inline_links = result.get('inline_links', {})
+    return ({'cluster_id': inline_links.get('versions', {}).get('cluster_id'),
+             'cites_id': inline_links.get('cited_by', {}).get('cites_id')},
+            _parse_result(result, start))
+
+
+def _seed_nodes(seed_files):
+    """Return the seed nodes of files of search results, identified by the
+    cluster ID in their Google Scholar link, which is also their cites ID"""
+    nodes = []
+    for seed_file in seed_files:
+        columns = read_columns(seed_file)
+        for i in range(len(columns[global_vars.title_key])):
+            row = {x: columns[x][i] if x in columns else '' for x in node_fieldnames}
+            cluster_id = _cluster_regex.search(row[global_vars.scholar_link_key] or '')
+            if cluster_id is None:
+                continue
+            row[global_vars.num_citations_key] = int(row[global_vars.num_citations_key] or 0)
+            nodes.append(({'cluster_id': cluster_id.group(1),
+                           'cites_id': cluster_id.group(1)}, row))
+    return nodes
+
+
+class CitationCrawler:
+    """Breadth-first crawler of the citation graph of Google Scholar, from
+    seed publications to the publications citing them, using the cites
+    parameter of SerpApi. Each depth is expanded concurrently, up to fan_out
+    citing publications per node, and a publication is only visited once.
+    The crawl stops once it used max_credits SerpApi searches (across all the
+    runs of the crawl), and resumes from its saved frontier when run again."""
+
+    def __init__(self, serp_api_key, output_dir, max_depth=global_vars.crawl_default_depth,
+                 fan_out=global_vars.crawl_default_fan_out,
+                 max_credits=global_vars.crawl_default_max_credits,
+                 concurrency=global_vars.default_concurrency,
+                 rate_limit=global_vars.default_serp_rate_limit, cache=None, budget=None,
+                 api_url=global_vars.serp_api_url, verbose=False, archive=None):
+        self.output_dir = p(output_dir)
+        self.max_depth = max_depth
+        self.fan_out = fan_out
+        self.max_credits = max_credits
+        self.concurrency = max(concurrency, 1)
+        self.cache = cache
+        self.budget = budget
+        self.archive = archive
+        self.api_url = api_url
+        self.verbose = verbose
+        self.state = CrawlState(output_dir)
+        # Spread the requests across the keys of the pool (or use the single
+        # API key), and share a single retry engine between all the SerpApi requests
+        self.key_pool = serp_api_key if isinstance(serp_api_key, KeyPool) \
+            else KeyPool([serp_api_key], rate_limit)
+        self.retrier = get_retrier('SerpApi')
+        # Credits used by the crawl, including its previous runs, protected
+        # by a lock
+        self._lock = threading.Lock()
+        self._credits = self.state.get('credits')
+        self._exhausted = False
+
+    def _reserve(self):
+        """Reserve a credit of the crawl, returning False if there are none left"""
+        with self._lock:
+            if self._credits >= self.max_credits:
+                self._exhausted = True
+                return False
+            self._credits += 1
+            return True
+
+    def _release(self):
+        """Release a reserved credit which was not used"""
+        with self._lock:
+            self._credits -= 1
+
+    def _search(self, params):
+        """Return the search results of a page and the credits it used (0 if it
+        was cached), or None if the crawl has no credits left"""
+        cached = self.cache.get(params) if self.cache is not None else None
+        if cached is not None:
+            get_metrics().increment('cache_lookups', cache='serpapi', result='hit')
+            return (cached[0].get('organic_results', []), 0)
+        if self.cache is not None:
+            get_metrics().increment('cache_lookups', cache='serpapi', result='miss')
+        if not self._reserve():
+            return None
+        def request(key, rate_limiter):
+            """Request the page with a key of the pool"""
+            url = f'{self.api_url}?' + parse.urlencode({**params, 'api_key': key})
+            return _fetch_json(url, rate_limiter, self.budget)
+        try:
+            # Perform the request, retrying it on transient errors
+            response = self.retrier.call(self.key_pool.call, request)
+        except Exception:
+            self._release()
+            raise
+        if self.cache is not None:
+            self.cache.put(params, response)
+        if self.archive is not None:
+            self.archive.append(params, response)
+        return (response.get('organic_results', []), 1)
+
+    def seed_query(self, search_query, max_results):
+        """Seed the crawl with the search results of a query, unless it was
+        already seeded. If the crawl runs out of credits, it is seeded again
+        when resumed"""
+        if self.state.get('seeded'):
+            return
+        nodes = []
+        credits = 0
+        seeded = True
+        for start in range(0, max_results, global_vars.default_serp_max_results):
+            num = min(max_results - start, global_vars.default_serp_max_results)
+            page = self._search({'engine': 'google_scholar', 'q': search_query,
+                                 'start': start, 'num': num})
+            if page is None:
+                seeded = False
+                break
+            nodes.extend(_node(x, start) for x in page[0])
+            credits += page[1]
+            # Stop once the search results run out
+            if len(page[0]) < num:
+                break
+        self.state.add_seeds([x for x in nodes if x[0]['cluster_id']], credits, seeded)
+
+    def seed_files(self, seed_files):
+        """Seed the crawl with the publications of files of search results,
+        unless it was already seeded"""
+        if not self.state.get('seeded'):
+            self.state.add_seeds(_seed_nodes(seed_files))
+
+    def _expand(self, cluster_id, cites_id, next_start, num_citations, depth):
+        """Request the publications citing a node page by page, from where a
+        previous run stopped, saving each page. Return False if the crawl ran
+        out of credits before the node was fully expanded"""
+        # Never request more citing publications than the node has
+        limit = min(self.fan_out, num_citations or 0)
+        start = next_start
+        while start < limit:
+            num = min(limit - start, global_vars.default_serp_max_results)
+            page = self._search({'engine': 'google_scholar', 'cites': cites_id,
+                                 'start': start, 'num': num})
+            if page is None:
+                return False
+            (results, credits) = page
+            start += num
+            # Publications without a cluster ID cannot be told apart, so they
+            # are left out of the graph
+            nodes = [x for x in (_node(y, start - num) for y in results) if x[0]['cluster_id']]
+            self.state.page_saved(cluster_id, nodes, depth + 1, start,
+                                  start >= limit or len(results) < num, credits)
+            get_metrics().increment('rows_scraped', len(nodes))
+            if len(results) < num:
+                break
+        # Mark nodes which were already fully expanded (e.g. with no citing
+        # publications) as such
+        if start == next_start:
+            self.state.page_saved(cluster_id, [], depth + 1, start, True, 0)
+        return True
+
+    def crawl(self):
+        """Crawl the citation graph breadth-first from the seeds to the maximum
+        depth, or until the crawl runs out of credits. Return whether the
+        crawl is complete"""
+        for depth in range(self.max_depth):
+            frontier = self.state.frontier(depth)
+            if not frontier:
+                continue
+            if (self.verbose):
+                print(f'\nExpanding {len(frontier)} publications at depth {depth}')
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, self._expand,
+                                           *x, depth) for x in frontier]
+                try:
+                    # Raise any unexpected error
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    executor.shutdown(cancel_futures=True)
+                    raise
+            if self._exhausted:
+                return False
+            if (self.verbose):
+                (nodes, edges) = self.state.counts()
+                print(f'{nodes} publications and {edges} citations found, {self._credits} credits used')
+        return True
+
+    def write(self):
+        """Write the node and edge files of the graph, and return their paths"""
+        nodes_path = self.output_dir / 'nodes.csv'
+        edges_path = self.output_dir / 'edges.csv'
+        self.state.write(nodes_path, edges_path)
+        return (nodes_path, edges_path)
+
+    def close(self):
+        """Close the state of the crawl"""
+        self.state.close()
+
+
+def main():
+    """Command line interface to crawl the citation graph of a query or of
+    files of search results"""
+    parser = argparse.ArgumentParser(prog='Google Scholar Citation Graph Crawler',
+                                     description='Crawl the publications citing the search results of a query, or of files of search results, breadth-first, and save the graph as node and edge files.')
+    parser.add_argument(
+        'serp_api_key', help='The API key for your SerpApi account to use to scrape Google Scholar data, or a pool of keys: the path of a file with one key per line, or env:NAME for an environment variable with comma-separated keys.')
+    seed_group = parser.add_mutually_exclusive_group(required=True)
+    seed_group.add_argument('-q', '--query-string',
+                            help='Set a query whose search results are the seeds of the crawl.',
+                            type=str)
+    seed_group.add_argument('-s', '--seed-files',
+                            help='Set the paths of files of search results (.csv or .parquet) whose publications are the seeds of the crawl.',
+                            nargs='+', type=str)
+    parser.add_argument('-m', '--max-results',
+                        help=f'Sets the number of search results of the query to use as seeds. Default = {global_vars.default_max_results}.',
+                        default=global_vars.default_max_results, type=int)
+    parser.add_argument('-o', '--output-dir',
+                        help="""Set the path of the directory of the crawl, where its
+                        state, and its nodes.csv and edges.csv files are saved.
+                        Run the crawler again with the same directory to resume
+                        the crawl.""",
+                        required=True, type=str)
+    parser.add_argument('-D', '--depth',
+                        help=f'Sets the number of levels of citing publications to crawl from the seeds. Default = {global_vars.crawl_default_depth}.',
+                        default=global_vars.crawl_default_depth, type=int)
+    parser.add_argument('-F', '--fan-out',
+                        help=f'Sets the maximum number of citing publications to request per publication. Default = {global_vars.crawl_default_fan_out}.',
+                        default=global_vars.crawl_default_fan_out, type=int)
+    parser.add_argument('--max-credits',
+                        help=f"""Sets the maximum number of SerpApi searches the
+                        crawl may use, across all its runs. Cached pages are
+                        free. Default = {global_vars.crawl_default_max_credits}.""",
+                        default=global_vars.crawl_default_max_credits, type=int)
+    parser.add_argument('-c', '--concurrency',
+                        help=f'Sets the number of publications to expand at the same time. Default = {global_vars.default_concurrency}.',
+                        default=global_vars.default_concurrency, type=int)
+    parser.add_argument('--serp-rate-limit',
+                        help=f'Sets the maximum number of SerpApi requests per second. Default = {global_vars.default_serp_rate_limit}.',
+                        default=global_vars.default_serp_rate_limit, type=float)
+    parser.add_argument('--cache-dir',
+                        help="""Set the path for the directory where the local cache of
+                        SerpApi responses is stored. By default, this is a 'cache'
+                        folder in the current directory.""",
+                        default=str(p.cwd() / 'cache'), type=str)
+    parser.add_argument('--no-local-cache',
+                        help='Use this option to bypass the local cache of SerpApi responses.',
+                        action='store_true')
+    parser.add_argument('--monthly-budget',
+                        help='Sets the maximum number of SerpApi searches to use per calendar month, shared with the scraper runs using the same cache directory.',
+                        type=int)
+    parser.add_argument('--archive-dir',
+                        help='Set the path of a directory to archive every raw SerpApi response into, as the scraper does.',
+                        type=str)
+    parser.add_argument('-v', '--verbose',
+                        help='Verbose logging mode.',
+                        action='store_true')
+    args = parser.parse_args()
+
+    # Check that the limits of the crawl are valid
+    if min(args.max_results, args.fan_out, args.concurrency) < 1 or args.depth < 0 \
+            or args.max_credits < 0 or args.serp_rate_limit <= 0:
+        print('\nError: the max results, fan-out, concurrency and SerpApi rate limit must be greater than 0, and the depth and max credits must not be negative')
+        exit(406)
+    # Check that the seed files exist
+    if args.seed_files:
+        missing = [x for x in args.seed_files if not p(x).is_file()]
+        if missing:
+            print(f'\nError: no seed file found at {", ".join(missing)}')
+            exit(404)
+
+    cache = None if args.no_local_cache else SerpCache(
+        args.cache_dir, global_vars.default_cache_ttl * 3600,
+        global_vars.default_cache_max_size * 1024 * 1024)
+    budget = None if args.monthly_budget is None else CreditBudget(
+        args.cache_dir, args.monthly_budget)
+    archive = ResponseArchive(args.archive_dir) if args.archive_dir else None
+    keys = load_keys(args.serp_api_key)
+    if not keys:
+        print(f'\nError: no SerpApi API key found in {args.serp_api_key}')
+        exit(404)
+    key_pool = KeyPool(keys, args.serp_rate_limit, args.cache_dir, verbose=args.verbose)
+    crawler = CitationCrawler(key_pool, args.output_dir, args.depth, args.fan_out,
+                              args.max_credits, args.concurrency, args.serp_rate_limit, cache,
+                              budget, verbose=args.verbose, archive=archive)
+    start_time = time.perf_counter()
+    rejected = False
+    try:
+        if args.query_string:
+            crawler.seed_query(args.query_string, args.max_results)
+        else:
+            crawler.seed_files(args.seed_files)
+        complete = crawler.crawl()
+    except (BudgetExhausted, KeysExhausted, KeysRejected) as e:
+        print(f'\n{e}')
+        complete = None
+        rejected = isinstance(e, KeysRejected)
+    # Save the graph found so far even if the crawl stopped early
+    finally:
+        (nodes_path, edges_path) = crawler.write()
+        (nodes, edges) = crawler.state.counts()
+        crawler.close()
+        key_pool.close()
+        if archive is not None:
+            archive.close()
+    print(f'\n{nodes} publications and {edges} citations saved in {nodes_path.name} and {edges_path.name} ({time.perf_counter() - start_time:.2f} s)')
+    if rejected:
+        print('SerpApi rejected every API key. Please check your API keys, then run the crawl again with the same output directory to resume it.')
+        exit(401)
+    if not complete:
+        print(
+            'The crawl ran out of SerpApi searches. Run it again with the same output directory (and a larger --max-credits or monthly budget) to resume it.')
+        exit(402)
+
+
+if __name__ == '__main__':
+    main()
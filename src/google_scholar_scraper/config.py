@@ -14,7 +14,7 @@ def parse_args():
     parser = argparse.ArgumentParser(prog='Google Scholar Scraper',
                                      description='Scrape Google Scholar entries by keywords.')
     parser.add_argument(
-        'serp_api_key', help='The API key for your SerpApi account to use to scrape Google Scholar data.'
+        'serp_api_key', help='The API key for your SerpApi account to use to scrape Google Scholar data, or a pool of keys: the path of a file with one key per line, or env:NAME for an environment variable with comma-separated keys.'
     )
     parser.add_argument(
         'email', help='For faster Crossref API queries, we require an email address.')
@@ -46,6 +46,101 @@ def parse_args():
                         results). Default = 20.""",
                         default=20,
                         type=int),
+    parser.add_argument('-c', '--concurrency',
+                        help=f"""Sets the maximum number of SerpApi result pages
+                        to request at the same time, across all the queries
+                        being scraped.
+                        Default = {global_vars.default_concurrency}.""",
+                        default=global_vars.default_concurrency,
+                        type=int)
+    parser.add_argument('-Q', '--query-concurrency',
+                        help=f"""Sets the maximum number of queries to scrape at
+                        the same time. Queries start in order of priority (the
+                        optional third column of the query file), then in the
+                        order of the query file.
+                        Default = {global_vars.default_query_concurrency}.""",
+                        default=global_vars.default_query_concurrency,
+                        type=int)
+    parser.add_argument('--monthly-budget',
+                        help="""Sets the maximum number of SerpApi searches
+                        (credits) to use per calendar month, tracked in the
+                        cache directory across runs. The run is refused if the
+                        planned searches exceed the remaining budget, and stops
+                        if the budget runs out mid-run.""",
+                        type=int)
+    parser.add_argument('--dry-run',
+                        help="""Use this option to only print the plan of the
+                        scrape (the pages of each query, how many are cached,
+                        and the SerpApi searches they will cost) without
+                        scraping anything.""",
+                        action='store_true')
+    parser.add_argument('--incremental',
+                        help="""Use this option to only save the search results
+                        not seen by a previous incremental run of the same
+                        query, to a _delta file, e.g. to watch for new
+                        publications on a schedule. The search results seen
+                        are remembered in the cache directory, the pages of
+                        each query are requested one at a time, and the scrape
+                        of a query stops at the first page without new search
+                        results. The local cache of SerpApi responses is
+                        refreshed rather than read.""",
+                        action='store_true')
+    parser.add_argument('--since-last-run',
+                        help="""Use this option with --incremental to only
+                        search the publications from the year of the last
+                        incremental run of each query onwards.""",
+                        action='store_true')
+    parser.add_argument('--partition-years',
+                        help=f"""Use this option to scrape the queries with more
+                        than {global_vars.scholar_result_cap} max results (the most Google Scholar
+                        returns for a query) by splitting them into ranges of
+                        publication years, from the given first year (or
+                        {global_vars.partition_first_year}) to the current one, bisecting every
+                        range which is near that cap. The ranges are scraped
+                        at the same time (as many as the query concurrency),
+                        and merged into the file of the query without
+                        duplicates, with the rank of each search result within
+                        its range and the range in a PARTITION column.""",
+                        nargs='?', const=global_vars.partition_first_year, type=int)
+    parser.add_argument('--serp-rate-limit',
+                        help=f"""Sets the maximum number of SerpApi requests per
+                        second allowed for the API key, shared between all
+                        concurrent requests.
+                        Default = {global_vars.default_serp_rate_limit}.""",
+                        default=global_vars.default_serp_rate_limit,
+                        type=float)
+
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument('--no-local-cache',
+                             help="""Use this option to bypass the local caches of
+                             SerpApi responses and DOIs, neither reading from
+                             nor writing to them.""",
+                             action='store_true')
+    cache_group.add_argument('--refresh-cache',
+                             help="""Use this option to ignore the entries stored
+                             in the local caches of SerpApi responses and DOIs and
+                             replace them with freshly requested ones.""",
+                             action='store_true')
+    parser.add_argument('--cache-dir',
+                        help="""Set the path for the directory where the local
+                        caches of SerpApi responses and DOIs are stored. By default, this
+                        is a 'cache' folder located inside the base module
+                        directory.""",
+                        default=str(p(DEFAULT_BASE_DIR / 'cache')),
+                        type=str)
+    parser.add_argument('--cache-ttl',
+                        help=f"""Sets the number of hours a cached SerpApi
+                        response remains valid.
+                        Default = {global_vars.default_cache_ttl}.""",
+                        default=global_vars.default_cache_ttl,
+                        type=float)
+    parser.add_argument('--cache-max-size',
+                        help=f"""Sets the maximum size in megabytes of the local
+                        cache of SerpApi responses. The least recently used
+                        responses are removed when it is exceeded.
+                        Default = {global_vars.default_cache_max_size}.""",
+                        default=global_vars.default_cache_max_size,
+                        type=float)
 
     output_group = parser.add_mutually_exclusive_group()
     output_group.add_argument('-b', '--base-output-dir',
@@ -71,6 +166,12 @@ def parse_args():
     parser.add_argument('-n', '--no-merge',
                         help='Use this option to prevent merging the individual query .csv files into a single .csv file that has any duplicates removed.',
                         action='store_true')
+    parser.add_argument('--fuzzy-dedup',
+                        help="""Use this option to also remove near duplicates
+                        (e.g. with different punctuation, casing or truncated
+                        authors) from the merged .csv file, keeping a single
+                        record per cluster of duplicates in a separate file.""",
+                        action='store_true')
 
     doi_group = parser.add_mutually_exclusive_group()
     doi_group.add_argument('-N', '--no-doi',
@@ -82,6 +183,83 @@ def parse_args():
                           DOIs for the results without actually performing a
                           search query.""",
                            type=str)
+    parser.add_argument('-C', '--crossref-concurrency',
+                        help=f"""Sets the maximum number of Crossref DOI lookups
+                        to perform at the same time, across all result files.
+                        The rate limit reported by Crossref is always respected.
+                        Default = {global_vars.default_crossref_concurrency}.""",
+                        default=global_vars.default_crossref_concurrency,
+                        type=int)
+    parser.add_argument('-P', '--pipeline',
+                        help="""Use this option to look up the DOIs of the search
+                        results while the queries are being scraped, as soon as
+                        each page is saved, instead of after every query is
+                        scraped. The DOIs of each query are saved into its file
+                        once it is scraped and its lookups are done.""",
+                        action='store_true')
+    parser.add_argument('--crossref-snapshot-index',
+                        help="""Set the path for an index of a local Crossref
+                        metadata dump (built with the
+                        google_scholar_scraper.crossref_query.offline_index
+                        module) to match suggested DOIs against it offline
+                        instead of querying the Crossref API.""",
+                        type=str)
+    parser.add_argument('--result-store',
+                        help="""Set the path of an SQLite database to also store
+                        the search results of every run in. Each publication
+                        is stored once with its ranks in each query, the DOI
+                        stage looks up every stored result still missing a DOI,
+                        and the merged file is exported from the store. Can
+                        also be given to --doi-only instead of files. Cannot be
+                        used with --pipeline.""",
+                        type=str)
+    parser.add_argument('--archive-dir',
+                        help="""Set the path of a directory to archive every raw
+                        SerpApi response into, in compressed append-only
+                        segments, so the search results can be parsed again
+                        offline (e.g. with more fields) with the
+                        google_scholar_scraper.serp_query.response_archive
+                        module, without paying for the searches again.""",
+                        type=str)
+    parser.add_argument('--http-timeout',
+                        help=f"""Sets the timeout in seconds of the SerpApi and
+                        Crossref HTTP requests.
+                        Default = {global_vars.default_http_timeout}.""",
+                        default=global_vars.default_http_timeout,
+                        type=float)
+    parser.add_argument('--http-max-connections',
+                        help=f"""Sets the maximum number of keep-alive HTTP
+                        connections shared by the SerpApi and Crossref requests.
+                        Default = {global_vars.default_http_max_connections}.""",
+                        default=global_vars.default_http_max_connections,
+                        type=int)
+    parser.add_argument('--output-format',
+                        help=f"""Sets the format of the files of search results
+                        and of the merged file: csv, or parquet (a compressed
+                        columnar format with typed year, rank and citation
+                        columns, which needs the pyarrow package). DOI-only runs
+                        read both formats.
+                        Default = {global_vars.default_output_format}.""",
+                        choices=['csv', 'parquet'],
+                        default=global_vars.default_output_format)
+    parser.add_argument('--metrics',
+                        help="""Use this option to save the request counts,
+                        latencies, SerpApi credits, cache hits, retries, DOI
+                        lookups and the wall time of each stage of the run, in
+                        a metrics.json report and a metrics.prom Prometheus
+                        textfile in the output directory.""",
+                        action='store_true')
+    parser.add_argument('--prometheus-textfile',
+                        help="""Set the path to save the Prometheus textfile of
+                        the metrics into instead (e.g. in the directory of the
+                        textfile collector of the node exporter). Implies
+                        --metrics.""",
+                        type=str)
+    parser.add_argument('--profile',
+                        help="""Use this option to profile each stage of the run
+                        with cProfile, saving the statistics of each stage in a
+                        .profile folder of the output directory.""",
+                        action='store_true')
     parser.add_argument('-r', '--recursive-doi-only',
                               help='Search recursively for all .csv files in the folder specified for running DOI-only searches. Only works for doi-only searches',
                               action='store_true')
@@ -106,6 +284,80 @@ class global_vars:
     gs_rank_key = 'GSRANK'
     num_citations_key = 'NUM_CITATIONS'
     doi_key = 'SUGGESTED_DOI'
+    cluster_id_key = 'CLUSTER_ID'
+    query_key = 'QUERY'
+    snippet_key = 'SNIPPET'
+    summary_key = 'SUMMARY'
+    result_id_key = 'RESULT_ID'
+    result_type_key = 'RESULT_TYPE'
+    cites_id_key = 'CITES_ID'
+    num_versions_key = 'NUM_VERSIONS'
+    resources_key = 'RESOURCES'
+    depth_key = 'DEPTH'
+    citing_key = 'CITING'
+    cited_key = 'CITED'
+    partition_key = 'PARTITION'
+    serp_api_url = 'https://serpapi.com/search'
+    crossref_api_url = 'https://api.crossref.org'
     max_attempts = 5
+    default_http_timeout = 30
+    default_http_max_connections = 20
+    retry_base_delay = 2
+    retry_max_delay = 60
+    breaker_threshold = 10
+    breaker_cooldown = 30
     default_max_results = 20
     default_serp_max_results = 20
+    default_concurrency = 4
+    default_query_concurrency = 4
+    default_serp_rate_limit = 5
+    default_cache_ttl = 168
+    default_cache_max_size = 512
+    default_crossref_concurrency = 3
+    default_crossref_rate_limit = 10
+    crossref_lookahead = 20
+    pipeline_queue_size = 200
+    result_store_batch_size = 1000
+    result_store_write_batch = 1000
+    crawl_default_depth = 2
+    crawl_default_fan_out = 20
+    crawl_default_max_credits = 100
+    key_account_ttl = 300
+    scholar_result_cap = 1000
+    partition_first_year = 1900
+    partition_split_ratio = 0.9
+    queue_lease = 600
+    queue_max_attempts = 3
+    queue_poll_interval = 5
+    daemon_host = '127.0.0.1'
+    daemon_port = 8765
+    daemon_workers = 2
+    daemon_max_finished_jobs = 1000
+    offline_min_token_length = 2
+    offline_index_batch_size = 50000
+    offline_read_size = 1 << 20
+    offline_query_tokens = 4
+    offline_max_candidates = 50
+    offline_match_threshold = 0.6
+    merge_max_keys_in_memory = 5000000
+    minhash_permutations = 64
+    minhash_shingle_size = 3
+    minhash_bands = 8
+    near_duplicate_threshold = 0.8
+    minhash_batch_size = 20000
+    default_output_format = 'csv'
+    archive_segment_size = 64 * 1024 * 1024
+    parquet_compression = 'zstd'
+    parquet_row_group_size = 50000
+    metrics_prefix = 'google_scholar_scraper'
+    metrics_latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    metrics_max_entries = 10000
+    benchmark_latency = 0.02
+    benchmark_error_rate = 0.0
+    benchmark_serp_results = 1000
+    benchmark_serp_rate_limit = 1000
+    benchmark_crossref_hit_rate = 0.9
+    benchmark_crossref_rate_limit = 1000
+    import_time_runs = 10
+    import_heavy_modules = ('pandas', 'numpy', 'habanero', 'requests', 'tkinter', 'httpx',
+                            'pyarrow')
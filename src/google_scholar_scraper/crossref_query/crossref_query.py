@@ -1,102 +1,486 @@
-from habanero import Crossref
-import pandas as pd
 from google_scholar_scraper.config import global_vars
-from time import sleep
+from google_scholar_scraper.rate_limiter import get_rate_limiter
+from google_scholar_scraper.retry import get_retrier, is_transient
+from google_scholar_scraper.crossref_query.doi_journal import DoiJournal
+from google_scholar_scraper.result_files import read_columns
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from collections import deque
+from types import SimpleNamespace
+from google_scholar_scraper import http_transport
+from google_scholar_scraper.metrics import get_metrics
+import threading
+import time
 
 
-def _get_dois(file_path, cr, verbose):
-    """Hadnler for obtaining the DOIs of the publications obtained from the scraping"""
-    # Read the CSV of search results and store it as a Pandas data frame
-    df = pd.read_csv(str(file_path), dtype=str)
+def _apply_rate_limit(headers, rate_limiter):
+    """Update the shared rate limiter with the current limits of the Crossref
+    polite pool, as reported by the X-Rate-Limit-Limit and X-Rate-Limit-Interval
+    headers of a response. Return whether the limits changed"""
+    limit = headers.get('X-Rate-Limit-Limit')
+    # The interval is returned with its unit, e.g. "1s"
+    interval = headers.get('X-Rate-Limit-Interval', '1s')
+    try:
+        limit, interval = int(limit), float(interval.rstrip('s'))
+    except (TypeError, ValueError):
+        return False
+    if (limit, interval) == (rate_limiter.limit, rate_limiter.interval):
+        return False
+    rate_limiter.update(limit, interval)
+    return True
+
+
+def _get_json(url, params):
+    """Perform a Crossref request over the shared keep-alive connections,
+    recording its latency, and return its JSON response and headers"""
+    start_time = time.perf_counter()
+    try:
+        response = http_transport.get_json(url, params=params)
+    except Exception:
+        get_metrics().record_request(
+            'crossref', time.perf_counter() - start_time, False)
+        raise
+    get_metrics().record_request(
+        'crossref', time.perf_counter() - start_time, True)
+    return response
+
+
+def _update_rate_limit(cr, rate_limiter, verbose):
+    """Set the shared rate limiter to the current limits of the Crossref polite
+    pool before the first lookup"""
+    try:
+        # Perform a request for no results, which only returns the headers we want
+        rate_limiter.acquire()
+        headers = _get_json(f'{cr.base_url}/works',
+                            params={'rows': 0, 'mailto': cr.mailto})[1]
+        if _apply_rate_limit(headers, rate_limiter) and (verbose):
+            print(
+                f'\nCrossref rate limit: {headers["X-Rate-Limit-Limit"]} requests every {headers.get("X-Rate-Limit-Interval", "1s")}')
+    # If the headers could not be obtained, keep the current limits
+    except Exception as e:
+        print(f'\n{e}')
+        print('Warning: Could not obtain the Crossref rate limits. Using the current limits.')
+
+
+def _works(cr, query, rate_limiter):
+    """Perform a Crossref works query for a single result once the rate limiter
+    allows it"""
+    # Wait for our turn so we do not exceed the Crossref rate limit
+    rate_limiter.acquire()
+    # Obtain only the first result, over the shared keep-alive connections
+    (x, headers) = _get_json(
+        f'{cr.base_url}/works',
+        params={'query': query, 'select': 'DOI', 'rows': 1, 'mailto': cr.mailto})
+    # Follow any change of the rate limits reported by Crossref
+    _apply_rate_limit(headers, rate_limiter)
+    return x
+
+
+def _lookup_doi(cr, query, rate_limiter, retrier):
+    """Query Crossref for the DOI of a single publication, returning an empty
+    string if none was found or the query cannot succeed, or None if we ran out
+    of retry attempts"""
+    # Try to query the API, retrying on transient errors
+    try:
+        x = retrier.call(_works, cr, query, rate_limiter)
+    # If there was an issue performing the query, inform the user
+    except Exception as e:
+        print(f'\n{e}')
+        # If the error is permanent (e.g. an invalid query), skip this entry
+        if not is_transient(e):
+            print('Error: There was a problem obtaining a DOI. Skipping entry.')
+            get_metrics().increment('crossref_lookups', source='api', result='error')
+            return ''
+        # Otherwise, we ran out of retry attempts
+        get_metrics().increment('crossref_lookups', source='api', result='failed')
+        return None
+    # Return the found DOI, if any
+    items = x['message']['items']
+    get_metrics().increment('crossref_lookups', source='api',
+                            result='hit' if items else 'miss')
+    return 'https://doi.org/' + items[0]['DOI'] if items else ''
+
+
+def query_string(authors, year, title):
+    """Build the normalised Crossref query string of an entry from its authors,
+    year, and title"""
+    return f'{authors.replace(";", ",").replace("\"", "").lower()} {year} "{title.lower()}"'
+
+
+def _build_query(columns, i):
+    """Build the normalised Crossref query string of an entry of a file from
+    its columns"""
+    return query_string(columns[global_vars.author_key][i], columns[global_vars.pub_year_key][i],
+                        columns[global_vars.title_key][i])
+
+
+class InFlightLookups:
+    """DOI lookups submitted to an executor, keyed on their query string, so
+    the same publication is only looked up once across files and queries,
+    even when it is submitted from several threads. The files waiting for
+    each lookup are counted, so a lookup is only cancelled once no file waits
+    for it anymore"""
+
+    def __init__(self, executor, lookup):
+        self._executor = executor
+        # Function performing the lookup of a query string
+        self._lookup = lookup
+        self._futures = {}
+        # Number of entries of files waiting for each lookup
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+    def get(self, query):
+        """Return the lookup of a query string, or None if it was not submitted"""
+        with self._lock:
+            return self._futures.get(query)
+
+    def submit(self, query, wait=True):
+        """Submit the lookup of a query string, unless it was already submitted.
+        Unless wait is unset (e.g. for lookups made ahead of their file), the
+        caller is counted as waiting for it. Return its lookup, and whether it
+        was submitted by this call"""
+        with self._lock:
+            submitted = query not in self._futures
+            if submitted:
+                self._futures[query] = self._executor.submit(self._lookup, query)
+                self._waiting[query] = 0
+            if wait:
+                self._waiting[query] += 1
+            return (self._futures[query], submitted)
+
+    def release(self, query):
+        """Stop waiting for the lookup of a query string (e.g. because its file
+        failed). If no other entry waits for it and it has not started yet, it
+        is cancelled and forgotten, so it can be submitted again later. Return
+        the number of entries still waiting for it"""
+        with self._lock:
+            self._waiting[query] -= 1
+            if self._waiting[query] > 0 or not self._futures[query].cancel():
+                return self._waiting[query]
+            del self._futures[query]
+            del self._waiting[query]
+            return 0
+
+
+def _journal_lookup(journal, query):
+    """Return a callback appending the result of a lookup to the journal of a
+    file as soon as it is done, unless it failed or was cancelled"""
+    def append(lookup):
+        if not lookup.cancelled() and lookup.exception() is None and lookup.result() is not None:
+            journal.append(query, lookup.result())
+    return append
+
+
+def _submit_dois(file_path, in_flight, doi_cache=None, offline_index=None):
+    """Read a file of search results and submit the DOI lookups of the entries
+    without a DOI (and not found in the DOI cache) to the in-flight lookups,
+    reusing the lookups already submitted for the same query string. If an
+    offline index is given, the entries are matched against it instead. The
+    result of each lookup is appended to the journal of the file as soon as it
+    is done. Return the columns of the file, the list of lookups (None for
+    entries which already have a DOI), the list of query strings and the
+    journal, or None if the file cannot be processed"""
+    # Read the file of search results into a dictionary of columns of strings,
+    # with empty strings for missing values
+    columns = read_columns(file_path)
 
     # Check that the right field headers are present
     try:
-        assert global_vars.author_key in df and global_vars.pub_year_key in df and global_vars.title_key in df
+        assert global_vars.author_key in columns and global_vars.pub_year_key in columns and global_vars.title_key in columns
     # If they are not, raise an error and exit the handling of this file
     except AssertionError:
         print(
             f'\nError: Header for file {file_path.name} does not match expected header for Google Scholar Scraper search results file. Skipping file.')
-        return
+        return None
+
+    # Number of entries in our search results
+    size = len(columns[global_vars.author_key])
 
     # If the column for DOIs still does not exist
-    if (not (global_vars.doi_key in df)):
+    if (not (global_vars.doi_key in columns)):
         # Create a new column for the DOIs and fill it with empty strings
-        df[global_vars.doi_key] = ''
+        columns[global_vars.doi_key] = [''] * size
+    dois = columns[global_vars.doi_key]
+
+    # Resume from the DOIs found in a previous interrupted run, if any
+    journal = DoiJournal(file_path)
+    journaled = journal.read()
+
+    # Pre-allocate our arrays of lookups and query strings to the number of
+    # entries in our search results
+    lookups = [None] * size
+    queries = [None] * size
+    # Query strings whose lookups are journaled once done
+    watched = set()
 
+    # Loop through all the entries in the file
+    for i in range(size):
+        # Build the query string from the authors, year, and title
+        queries[i] = _build_query(columns, i)
+        # If the DOI is empty, use the DOI from the journal if there is one.
+        # The entries journaled without a DOI were already looked up without
+        # a match, so they are not looked up again
+        if (dois[i] == '' and queries[i] in journaled):
+            dois[i] = journaled[queries[i]]
+            continue
+        # If the DOI is empty, use the cached DOI if there is one, unless it is
+        # already being looked up (e.g. while the query was being scraped)
+        if (dois[i] == '' and doi_cache is not None and in_flight.get(queries[i]) is None):
+            cached_doi = doi_cache.get(queries[i])
+            if cached_doi is not None:
+                dois[i] = cached_doi
+        # If the DOI is still empty and we are using an offline index of
+        # Crossref metadata, match the entry locally. Entries without a match
+        # are left empty
+        if (dois[i] == '' and offline_index is not None):
+            dois[i] = offline_index.match(
+                columns[global_vars.author_key][i], columns[global_vars.pub_year_key][i],
+                columns[global_vars.title_key][i]) or ''
+            get_metrics().increment('crossref_lookups', source='offline',
+                                    result='hit' if dois[i] else 'miss')
+        # If the DOI is still empty, then submit the CrossRef query, unless
+        # the same query was already submitted for another entry
+        elif (dois[i] == ''):
+            lookups[i] = in_flight.submit(queries[i])[0]
+            # Journal the result of each query once, in the order the lookups
+            # finish. The entries without a match are journaled too, so they
+            # are skipped when resumed
+            if queries[i] not in watched:
+                watched.add(queries[i])
+                lookups[i].add_done_callback(_journal_lookup(journal, queries[i]))
+
+    # Populate the DOI cache with the DOIs already present in the file or
+    # matched offline
+    if doi_cache is not None:
+        doi_cache.put_many([(queries[i], dois[i]) for i in range(size)
+                            if lookups[i] is None], replace=False)
+
+    return columns, lookups, queries, journal
+
+
+def _get_dois(file_path, in_flight, columns, lookups, queries, journal, verbose,
+              doi_cache=None):
+    """Hadnler for obtaining the DOIs of the publications obtained from the
+    scraping, collecting the results of the lookups in row order. Their
+    results are journaled as they finish, so the journal is compacted into the
+    file once they are collected"""
+    # Number of entries in our search results
+    size = len(columns[global_vars.author_key])
     # Pre-allocate our array of DOIs to the number of entries in our search results
-    dois = [''] * df[global_vars.author_key].size
-
-    # Fill any missing values with empty strings and store it in the same dataframe
-    df.fillna('', inplace=True)
-
-    # Loop through all the entries in the CSV file
-    for i in range(df[global_vars.author_key].size):
-        # If the DOI is empty, then perform the CrossRef query
-        if (df[global_vars.doi_key][i] == ''):
-            # Attempt the query as many times as we have set
-            for attempt in range(global_vars.max_attempts):
-                # Try to query the API
-                try:
-                    # Build the query string from the authors, year, and title
-                    query = f'{str(df[global_vars.author_key][i]).replace(";", ",").replace("\"", "").lower()} ' +\
-                        f'{str(df[global_vars.pub_year_key][i])} "{str(df[global_vars.title_key][i]).lower()}"'
-                    # Obtain only the first result
-                    x = cr.works(query=query, select='DOI', limit=1)
-                    # Store the found DOI in our array
-                    dois[i] = ('https://doi.org/' +
-                               x['message']['items'][0]['DOI'])
-                # If there was an issue performing the query, inform the user and try again after 15 seconds
-                except Exception as e:
-                    print(f'\n{e}')
-                    print(
-                        f'Error: There was a problem obtaining a DOI. Retrying in 15 seconds. Attempt {attempt + 1} of {global_vars.max_attempts}')
-                    sleep(15)
-                    continue
+    dois = [''] * size
+    # The (query string, DOI) tuples found, to store in the DOI cache
+    found = []
 
-                # If we reach this point, the query was successful, so break from
-                # the for loop, since we do not need to attempt the process again
-                # and continue with the next entry
-                break
+    # Loop through all the entries in the file
+    for i in range(size):
+        # If the DOI is being looked up, wait for the result
+        if (lookups[i] is not None):
+            try:
+                doi = lookups[i].result()
+            # If the lookup was cancelled (e.g. the DOI pipeline was
+            # cancelled), treat it as failed
+            except CancelledError:
+                doi = None
 
-            # If we finished the for loop, we ran out of retry attempts.
-            # Inform the user and save the currently obtained DOIs.
-            else:
+            # If we ran out of retry attempts, inform the user and save the
+            # currently obtained DOIs.
+            if (doi is None):
                 print(
                     f'Error: Too many failed attempts querying DOIs for file {file_path.name}. Saving current progress. Please run the program in DOI-only mode again to resume from this point.')
-                # The DOIs before the one we encountered the error will be stored
-                # in the data frame and saved to the CSV file.
-                df[global_vars.doi_key][:i] = dois[:i]
-                df.to_csv(str(file_path), index=False)
-                return
+                # Cancel the lookups for this file that have not started yet,
+                # unless other files wait for them, and keep the DOIs of the
+                # ones which already finished. The lookups other files wait
+                # for are left to them
+                for j in range(i + 1, len(lookups)):
+                    if lookups[j] is None:
+                        continue
+                    waiting = in_flight.release(queries[j])
+                    if lookups[j].cancelled() or (waiting and not lookups[j].done()):
+                        continue
+                    try:
+                        doi = lookups[j].result()
+                    except CancelledError:
+                        doi = None
+                    if doi:
+                        dois[j] = doi
+                        found.append((queries[j], doi))
+                break
+            dois[i] = doi
+            if doi:
+                found.append((queries[i], doi))
         # If the DOI already exists in the file, use that value
         else:
-            dois[i] = df[global_vars.doi_key][i]
+            dois[i] = columns[global_vars.doi_key][i]
 
-        # Progressively save the output file in case of issues, since these requests
-        # can take a long time. Done every 10 DOI searches, or when all searches are done
-        if (((i + 1) % 10 == 0) or ((i + 1) == df[global_vars.author_key].size)):
-            # Store all the found DOIs in our array to the dataframe
-            df[global_vars.doi_key][:i + 1] = dois[:i + 1]
-            # Save the dataframe to the CSV file
-            df.to_csv(str(file_path), index=False)
+        # If verbose logging was requested, provide feedback on progress
+        if (verbose and (((i + 1) % 10 == 0) or ((i + 1) == size))):
+            print(f'{i+1} DOIs processed.')
 
-            # If verbose logging was requested, provide feedback on progress
-            if (verbose):
-                print(f'{i+1} DOIs processed.')
+    # Store all the found DOIs in our array to the DOI column, keeping the
+    # existing values of the entries we did not obtain a DOI for
+    columns[global_vars.doi_key] = [doi if doi else existing for (doi, existing)
+                                    in zip(dois, columns[global_vars.doi_key])]
+    # Record how many DOIs were found, are still missing, or were already known
+    get_metrics().record_file(file_path.name, len(found),
+                              sum(1 for x in columns[global_vars.doi_key] if not x),
+                              sum(1 for x in lookups if x is None))
+    # Save the columns to the file once, and remove the journal
+    journal.compact(columns)
+    # Store the newly found DOIs in the DOI cache
+    if doi_cache is not None:
+        doi_cache.put_many(found)
 
 
-def crossref_query(email, verbose, output_files):
-    """Handler for performing the CrossRef queries to obtain the DOIs"""
-    # Initialise a new habanero CrossRef class with the user-provided email
-    cr = Crossref(mailto=email)
+def crossref_query(email, verbose, output_files,
+                   concurrency=global_vars.default_crossref_concurrency, doi_cache=None,
+                   offline_index=None, api_url=global_vars.crossref_api_url):
+    """Handler for performing the CrossRef queries to obtain the DOIs. If an
+    offline index of Crossref metadata is given, it is used instead of the
+    Crossref API, whose URL can be replaced (e.g. by a local stand-in server)"""
+    # The API URL and the user-provided polite pool email of the requests,
+    # which are performed over the shared keep-alive connections
+    cr = SimpleNamespace(base_url=api_url, mailto=email)
+    # Share a single rate limiter between all the Crossref requests, and set it
+    # to the limits currently reported by Crossref (unless we are offline)
+    rate_limiter = get_rate_limiter(
+        'crossref', global_vars.default_crossref_rate_limit)
+    if offline_index is None:
+        _update_rate_limit(cr, rate_limiter, verbose)
+    # Share a single retry engine (and circuit breaker) between all the Crossref requests
+    retrier = get_retrier('Crossref')
     # If verbose logging is enabled, provide feedback
     if (verbose):
         print(
             f'\nNumber of files to process for suggested DOIs: {len(output_files)}')
-    # Loop through all the files with search results in our file list
-    for output_file in output_files:
-        # If verbose logging is enabled, provide feedback
-        if (verbose):
-            print(f'Obtaining suggested DOIs for {output_file.name}')
-        # Perform the queries to get the DOIs
-        _get_dois(output_file, cr, verbose)
+    # Run the lookups of all the files concurrently, with at most `concurrency`
+    # lookups in flight at a time
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        # Files whose lookups were submitted but whose results are not collected
+        # yet, and the number of lookups they contain
+        submitted = deque()
+        queued = 0
+        files = iter(output_files)
+        # Lookups submitted for each query string, so that the same publication
+        # is only looked up once across files
+        in_flight = InFlightLookups(
+            executor, lambda query: _lookup_doi(cr, query, rate_limiter, retrier))
+        # Loop through all the files with search results in our file list
+        while True:
+            # Submit the lookups of the next files, so lookups continue across
+            # files, while keeping a bounded number of files in memory
+            while queued < concurrency * global_vars.crossref_lookahead and \
+                    len(submitted) < concurrency * global_vars.crossref_lookahead:
+                output_file = next(files, None)
+                if output_file is None:
+                    break
+                file_lookups = _submit_dois(
+                    output_file, in_flight, doi_cache, offline_index)
+                # Skip the files which could not be processed
+                if file_lookups is not None:
+                    submitted.append((output_file, file_lookups))
+                    queued += sum(x is not None for x in file_lookups[1])
+            # Stop when every file has been processed
+            if not submitted:
+                break
+            output_file, file_lookups = submitted.popleft()
+            queued -= sum(x is not None for x in file_lookups[1])
+            # If verbose logging is enabled, provide feedback
+            if (verbose):
+                print(f'Obtaining suggested DOIs for {output_file.name}')
+            # Collect the results of the lookups to get the DOIs
+            _get_dois(output_file, in_flight, *file_lookups, verbose, doi_cache)
+
+    # If verbose logging is enabled, provide feedback on the use of the DOI
+    # cache and the retries
+    if (verbose):
+        _print_stats(doi_cache, retrier)
+
+
+def crossref_query_store(email, verbose, store,
+                         concurrency=global_vars.default_crossref_concurrency, doi_cache=None,
+                         offline_index=None, api_url=global_vars.crossref_api_url):
+    """Handler for performing the CrossRef queries to obtain the DOIs of every
+    result of a result store which was not looked up yet, in batches found
+    through its index of missing DOIs, saving the DOIs of each batch in a
+    single transaction"""
+    # The API URL and the user-provided polite pool email of the requests,
+    # the shared rate limiter, and the shared retry engine, as for files
+    cr = SimpleNamespace(base_url=api_url, mailto=email)
+    rate_limiter = get_rate_limiter(
+        'crossref', global_vars.default_crossref_rate_limit)
+    if offline_index is None:
+        _update_rate_limit(cr, rate_limiter, verbose)
+    retrier = get_retrier('Crossref')
+    # If verbose logging is enabled, provide feedback
+    if (verbose):
+        print(
+            f'\nNumber of stored results to process for suggested DOIs: {store.count_missing_dois()}')
+    processed = 0
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        # Lookups submitted for each query string, so that the same publication
+        # is only looked up once
+        in_flight = InFlightLookups(
+            executor, lambda query: _lookup_doi(cr, query, rate_limiter, retrier))
+        after_id = 0
+        while True:
+            batch = store.missing_dois(after_id)
+            if not batch:
+                break
+            after_id = batch[-1][0]
+            # Use the cached or offline DOI of each result if there is one,
+            # and submit the lookups of the others
+            entries = []
+            for (result_id, authors, year, title) in batch:
+                query = query_string(authors, year, title)
+                doi = doi_cache.get(query) if doi_cache is not None else None
+                if doi is None and offline_index is not None:
+                    doi = offline_index.match(authors, year, title) or ''
+                    get_metrics().increment('crossref_lookups', source='offline',
+                                            result='hit' if doi else 'miss')
+                entries.append((result_id, query,
+                                doi if doi is not None else in_flight.submit(query)[0]))
+            # Collect the DOIs of the batch, in order
+            found = []
+            failed = False
+            for (result_id, query, lookup) in entries:
+                if isinstance(lookup, str):
+                    doi = lookup
+                else:
+                    try:
+                        doi = lookup.result()
+                    except CancelledError:
+                        doi = None
+                # If we ran out of retry attempts, the results without a DOI
+                # are left to look up in a later run
+                if doi is None:
+                    failed = True
+                    continue
+                found.append((result_id, query, doi))
+            store.save_dois([(x, z) for (x, _, z) in found])
+            if doi_cache is not None:
+                doi_cache.put_many([(y, z) for (_, y, z) in found if z])
+            processed += len(found)
+            # If verbose logging was requested, provide feedback on progress
+            if (verbose):
+                print(f'{processed} DOIs processed.')
+            if failed:
+                print(
+                    'Error: Too many failed attempts querying DOIs for the result store. Saving current progress. Please run the program in DOI-only mode again to resume from this point.')
+                executor.shutdown(cancel_futures=True)
+                break
+
+    # If verbose logging is enabled, provide feedback on the use of the DOI
+    # cache and the retries
+    if (verbose):
+        _print_stats(doi_cache, retrier)
+
+
+def _print_stats(doi_cache, retrier):
+    """Print the hits and misses of the DOI cache, if any, and the retries of
+    the Crossref requests"""
+    if (doi_cache is not None):
+        print(
+            f'\nDOI cache: {doi_cache.hits} hits, {doi_cache.misses} misses')
+    stats = retrier.stats()
+    print(
+        f'\nCrossref retries: {stats['retries']} ({stats['sleep_time']} seconds waiting), {stats['permanent_errors']} permanent errors')
@@ -0,0 +1,62 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path as p
+from google_scholar_scraper.metrics import get_metrics
+
+
+class DoiCache:
+    """Persistent cache of the DOIs found on Crossref, stored in an SQLite
+    database and indexed on the normalised author, year and title query string
+    used for the Crossref lookups, so the same publication is only looked up
+    once across files and runs."""
+
+    def __init__(self, cache_dir, refresh=False):
+        # If refresh is set, cached DOIs are never returned, but newly found
+        # DOIs are still stored, replacing the old ones
+        self.refresh = refresh
+        # Counters of the lookups found and not found in the cache
+        self.hits = 0
+        self.misses = 0
+        # Create the cache directory recursively
+        p(cache_dir).mkdir(exist_ok=True, parents=True)
+        # A single connection shared between threads, protected by a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(p(cache_dir) / 'doi_cache.sqlite3'), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS dois (
+                query TEXT PRIMARY KEY,
+                doi TEXT NOT NULL,
+                created REAL NOT NULL)""")
+
+    def get(self, query):
+        """Return the cached DOI for the query string, or None if there is none"""
+        row = None
+        if not self.refresh:
+            with self._lock:
+                row = self._conn.execute(
+                    'SELECT doi FROM dois WHERE query = ?', (query,)).fetchone()
+        # Keep track of the hits and misses
+        if row is None:
+            self.misses += 1
+            get_metrics().increment('cache_lookups', cache='doi', result='miss')
+            return None
+        self.hits += 1
+        get_metrics().increment('cache_lookups', cache='doi', result='hit')
+        return row[0]
+
+    def put_many(self, entries, replace=True):
+        """Store a list of (query string, DOI) tuples in a single transaction.
+        If replace is not set, existing entries are kept."""
+        entries = [(query, doi, time.time()) for (query, doi) in entries if doi]
+        if not entries:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f'INSERT OR {"REPLACE" if replace else "IGNORE"} INTO dois VALUES (?, ?, ?)', entries)
+
+    def close(self):
+        """Close the connection to the cache database"""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,67 @@
+import csv
+import os
+import threading
+from pathlib import Path as p
+from google_scholar_scraper.result_files import file_format, write_columns
+
+
+class DoiJournal:
+    """Append-only sidecar journal of the DOIs found for a file of search
+    results, keyed on the normalised query string of each entry. DOIs are
+    appended as soon as they are found, or an empty DOI if the lookup found no
+    match, and the journal is compacted into the file of search results once
+    all its lookups are done. DOIs can be appended from several threads."""
+
+    def __init__(self, file_path):
+        self.file_path = p(file_path)
+        self.path = self.file_path.with_name(
+            f'{self.file_path.name}.doi-journal')
+        self._file = None
+        self._writer = None
+        # Lock protecting the journal file, and whether the journal was
+        # compacted, after which the DOIs appended are already in the file
+        self._lock = threading.Lock()
+        self._compacted = False
+
+    def read(self):
+        """Return a dictionary of the DOIs in the journal (empty for the
+        entries without a match), keyed on their query strings, so an
+        interrupted run can resume from them"""
+        if not self.path.is_file():
+            return {}
+        with open(str(self.path), 'r', newline='', encoding='utf-8') as journal_file:
+            # Skip any incomplete last line left by a crash
+            return {row[0]: row[1] for row in csv.reader(journal_file) if len(row) == 2}
+
+    def append(self, query, doi):
+        """Append the DOI found for a query to the journal, or an empty DOI if
+        there was no match. Nothing is appended once the journal is compacted"""
+        with self._lock:
+            if self._compacted:
+                return
+            if self._file is None:
+                # Line buffering, so every DOI reaches the file as soon as it
+                # is found
+                self._file = open(str(self.path), 'a', newline='',
+                                  encoding='utf-8', buffering=1)
+                self._writer = csv.writer(self._file, lineterminator='\n')
+            self._writer.writerow([query, doi])
+
+    def close(self):
+        """Close the journal file"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._writer = None
+
+    def compact(self, columns):
+        """Save the columns of the file of search results with all the DOIs into
+        it, in its format, replacing it atomically, and remove the journal"""
+        with self._lock:
+            self._compacted = True
+        self.close()
+        temp_path = self.file_path.with_name(f'{self.file_path.name}.tmp')
+        write_columns(columns, temp_path, file_format(self.file_path))
+        os.replace(str(temp_path), str(self.file_path))
+        self.path.unlink(missing_ok=True)
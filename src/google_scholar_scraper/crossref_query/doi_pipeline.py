@@ -0,0 +1,108 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.rate_limiter import get_rate_limiter
+from google_scholar_scraper.retry import get_retrier
+from google_scholar_scraper.crossref_query.crossref_query import InFlightLookups, query_string, \
+    _lookup_doi, _update_rate_limit, _submit_dois, _get_dois, _print_stats
+
+
+class DoiPipeline:
+    """Streaming DOI resolution, overlapped with the scrape. The rows of search
+    results are put in the pipeline as soon as their page is saved, and their
+    lookups go through a bounded queue to the Crossref workers, so a scrape
+    which outpaces Crossref blocks until the queue has room again. The same
+    publication is only looked up once across all the queries. Once a query is
+    scraped, its file is added to the pipeline, and its DOIs are collected and
+    saved into it in the background, in the order the files were added."""
+
+    def __init__(self, email, verbose, concurrency=global_vars.default_crossref_concurrency,
+                 doi_cache=None, offline_index=None, api_url=global_vars.crossref_api_url,
+                 queue_size=global_vars.pipeline_queue_size):
+        self.verbose = verbose
+        self.doi_cache = doi_cache
+        self.offline_index = offline_index
+        # The API URL and the user-provided polite pool email of the requests
+        self.cr = SimpleNamespace(base_url=api_url, mailto=email)
+        # Share a single rate limiter and retry engine between all the
+        # Crossref requests, as the DOI stage does
+        self.rate_limiter = get_rate_limiter(
+            'crossref', global_vars.default_crossref_rate_limit)
+        if offline_index is None:
+            _update_rate_limit(self.cr, self.rate_limiter, verbose)
+        self.retrier = get_retrier('Crossref')
+        # Workers performing the lookups, and a single worker saving the DOIs
+        # of each file in turn
+        self._executor = ThreadPoolExecutor(max_workers=max(concurrency, 1))
+        self._finisher = ThreadPoolExecutor(max_workers=1)
+        self.in_flight = InFlightLookups(self._executor, self._lookup)
+        # Free places in the queue of lookups put in by the scrape
+        self._queue_slots = threading.BoundedSemaphore(max(queue_size, 1))
+        # Files added, and the background tasks saving their DOIs
+        self._files = []
+
+    def _lookup(self, query):
+        """Look up the DOI of a query string, using the DOI cache if it has it"""
+        if self.doi_cache is not None:
+            cached_doi = self.doi_cache.get(query)
+            if cached_doi:
+                return cached_doi
+        return _lookup_doi(self.cr, query, self.rate_limiter, self.retrier)
+
+    def put(self, rows):
+        """Queue the lookups of rows of search results, as they are scraped,
+        blocking while the queue is full. Rows matched offline are left for
+        when their file is added"""
+        if self.offline_index is not None:
+            return
+        for row in rows:
+            query = query_string(row[global_vars.author_key], str(row[global_vars.pub_year_key]),
+                                 row[global_vars.title_key])
+            # Skip the publications already looked up, without waiting
+            if self.in_flight.get(query) is not None:
+                continue
+            self._queue_slots.acquire()
+            # The file of the rows waits for the lookup once it is added
+            (future, submitted) = self.in_flight.submit(query, wait=False)
+            # Free the place in the queue once the lookup is done
+            if submitted:
+                future.add_done_callback(lambda _: self._queue_slots.release())
+            else:
+                self._queue_slots.release()
+
+    def _finish_file(self, output_file):
+        """Collect the DOIs of a file of search results and save them into it"""
+        file_lookups = _submit_dois(output_file, self.in_flight, self.doi_cache,
+                                    self.offline_index)
+        # Skip the files which could not be processed
+        if file_lookups is None:
+            return
+        if (self.verbose):
+            print(f'Obtaining suggested DOIs for {output_file.name}')
+        _get_dois(output_file, self.in_flight, *file_lookups, self.verbose, self.doi_cache)
+
+    def add_file(self, output_file):
+        """Add the file of a query which finished scraping, to save its DOIs
+        into it once they are all looked up"""
+        self._files.append(self._finisher.submit(self._finish_file, output_file))
+
+    def close(self, cancel=False):
+        """Wait for the DOIs of every added file to be saved, and stop the
+        workers. If cancel is set (e.g. because the scrape failed), the
+        lookups which have not started yet are cancelled instead"""
+        if cancel:
+            self._finisher.shutdown(wait=False, cancel_futures=True)
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            return
+        try:
+            # Raise any unexpected error of the files
+            for future in self._files:
+                future.result()
+        finally:
+            self._finisher.shutdown()
+            self._executor.shutdown()
+        # If verbose logging is enabled, provide feedback on the use of the DOI
+        # cache and the retries
+        if (self.verbose):
+            _print_stats(self.doi_cache, self.retrier)
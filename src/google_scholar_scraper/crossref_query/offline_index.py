@@ -0,0 +1,335 @@
+import argparse
+import gzip
+import json
+import re
+import sqlite3
+import threading
+from pathlib import Path as p
+from google_scholar_scraper.config import global_vars
+
+# Regular expression to split text into alphanumeric tokens, compiled once
+_token_regex = re.compile(r'[^\W_]+')
+
+
+def _tokens(text):
+    """Split a text into its set of normalised title tokens"""
+    return {x for x in _token_regex.findall(str(text).lower())
+            if len(x) >= global_vars.offline_min_token_length}
+
+
+def _family_names(authors):
+    """Normalise a list of author names into a set of lowercase family names,
+    taken as the last word of each name"""
+    names = set()
+    for author in authors:
+        words = _token_regex.findall(str(author).lower())
+        if words:
+            names.add(words[-1])
+    return names
+
+
+class _JsonStream:
+    """Incremental parser of a JSON text file, read in chunks, so only the
+    value being parsed is kept in memory rather than the whole file"""
+
+    def __init__(self, text_file):
+        self._file = text_file
+        self._buffer = ''
+        self._pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Read the next chunk of the file, dropping the text already parsed.
+        Return False at the end of the file"""
+        chunk = self._file.read(global_vars.offline_read_size)
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        """Return the next character which is not whitespace, or an empty
+        string at the end of the file"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def expect(self, characters):
+        """Consume the next character which is not whitespace, which must be
+        one of the given characters, and return it"""
+        character = self.peek()
+        if not character or character not in characters:
+            raise json.JSONDecodeError(f'Expecting one of {characters}', self._buffer, self._pos)
+        self._pos += 1
+        return character
+
+    def value(self):
+        """Parse the next JSON value, reading more chunks until it is whole"""
+        self.peek()
+        while True:
+            try:
+                (value, end) = self._decoder.raw_decode(self._buffer, self._pos)
+                error = None
+            except json.JSONDecodeError as e:
+                (value, end, error) = (None, len(self._buffer), e)
+            # A value ending the buffer (e.g. a number) may go on in the next chunk
+            if end < len(self._buffer) or not self._fill():
+                break
+        if error is not None:
+            raise error
+        self._pos = end
+        return value
+
+    def array(self):
+        """Parse the next JSON array, yielding its values one at a time"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.expect(']')
+            return
+        yield self.value()
+        while self.expect(',]') == ',':
+            yield self.value()
+
+
+def _read_json(dump_file):
+    """Stream the works of a JSON dump file, parsed incrementally: either a
+    list of works, the works under the "items" key of an object, or a single
+    work"""
+    stream = _JsonStream(dump_file)
+    if stream.peek() == '[':
+        yield from stream.array()
+        return
+    # Go through the keys of the object, streaming the works under "items"
+    record = {}
+    has_items = False
+    stream.expect('{')
+    more = stream.peek() != '}'
+    if not more:
+        stream.expect('}')
+    while more:
+        key = stream.value()
+        stream.expect(':')
+        if key == 'items':
+            has_items = True
+            yield from stream.array()
+        else:
+            record[key] = stream.value()
+        more = stream.expect(',}') == ','
+    if not has_items:
+        yield record
+
+
+def _read_works(dump_path):
+    """Stream the works of a Crossref metadata dump file, which can either be a
+    JSON Lines file (one work, or one object with a list of works under
+    "items", per line) or a JSON file with a list of works, either on its own
+    or under "items". Both can be gzipped."""
+    opener = gzip.open if dump_path.suffix == '.gz' else open
+    # The suffix of the file without the compression extension
+    suffix = p(dump_path.stem).suffix if dump_path.suffix == '.gz' else dump_path.suffix
+    with opener(str(dump_path), 'rt', encoding='utf-8') as dump_file:
+        # A JSON file is parsed incrementally, as it can be larger than memory
+        if suffix == '.json':
+            yield from _read_json(dump_file)
+            return
+        for line in dump_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'items' in record:
+                yield from record['items']
+            else:
+                yield record
+
+
+def _dump_files(dump_paths):
+    """Find the dump files in a list of files and directories"""
+    for dump_path in dump_paths:
+        dump_path = p(dump_path)
+        if dump_path.is_dir():
+            yield from sorted(x for x in dump_path.glob('**/*')
+                              if x.is_file() and x.name.endswith(('.json', '.jsonl', '.gz')))
+        else:
+            yield dump_path
+
+
+def _work_year(work):
+    """Obtain the publication year of a Crossref work, if available"""
+    for date_key in ('issued', 'published', 'published-print', 'published-online', 'created'):
+        try:
+            return int(work[date_key]['date-parts'][0][0])
+        except (KeyError, IndexError, TypeError, ValueError):
+            continue
+    return None
+
+
+def build_index(dump_paths, index_path, verbose=False):
+    """Build the on-disk index of a Crossref metadata dump, streaming the dump
+    files so they are never loaded whole into memory"""
+    index_path = p(index_path)
+    index_path.parent.mkdir(exist_ok=True, parents=True)
+    # Always build a new index from scratch
+    index_path.unlink(missing_ok=True)
+    conn = sqlite3.connect(str(index_path))
+    conn.executescript("""
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE works (id INTEGER PRIMARY KEY, doi TEXT NOT NULL,
+            year INTEGER, authors TEXT NOT NULL, title TEXT NOT NULL);
+        CREATE TABLE tokens (id INTEGER PRIMARY KEY, token TEXT NOT NULL UNIQUE,
+            df INTEGER NOT NULL);
+        CREATE TABLE postings (token_id INTEGER NOT NULL, work_id INTEGER NOT NULL);
+    """)
+    # Vocabulary of the titles, mapping each token to its ID and the number of
+    # works containing it
+    vocabulary = {}
+    works, postings = [], []
+    work_id = 0
+
+    def _flush():
+        """Write the pending works and postings to the index"""
+        conn.executemany('INSERT INTO works VALUES (?, ?, ?, ?, ?)', works)
+        conn.executemany('INSERT INTO postings VALUES (?, ?)', postings)
+        works.clear()
+        postings.clear()
+
+    for dump_file in _dump_files(dump_paths):
+        if (verbose):
+            print(f'Indexing {dump_file.name}')
+        for work in _read_works(dump_file):
+            # Skip the works without a DOI or a title
+            title = ' '.join(work.get('title') or [])
+            tokens = _tokens(title)
+            if not work.get('DOI') or not tokens:
+                continue
+            work_id += 1
+            authors = _family_names(
+                [x.get('family') or x.get('name', '') for x in work.get('author') or []])
+            works.append((work_id, work['DOI'], _work_year(work),
+                          ' '.join(sorted(authors)), ' '.join(sorted(tokens))))
+            for token in tokens:
+                entry = vocabulary.setdefault(token, [len(vocabulary) + 1, 0])
+                entry[1] += 1
+                postings.append((entry[0], work_id))
+            if len(works) >= global_vars.offline_index_batch_size:
+                _flush()
+    _flush()
+
+    # Store the vocabulary and index the postings by token
+    conn.executemany('INSERT INTO tokens VALUES (?, ?, ?)',
+                     ((token_id, token, df) for (token, (token_id, df)) in vocabulary.items()))
+    conn.execute('CREATE INDEX postings_token ON postings (token_id, work_id)')
+    conn.commit()
+    conn.close()
+    if (verbose):
+        print(f'\nIndexed {work_id} works into {str(index_path)}')
+
+
+class OfflineIndex:
+    """Matcher of search results against an on-disk index of a Crossref
+    metadata dump, used to obtain DOIs without any network requests. It can be
+    used by several threads at a time, each with its own read-only connection
+    to the index"""
+
+    def __init__(self, index_path):
+        if not p(index_path).is_file():
+            raise FileNotFoundError(
+                f'No Crossref snapshot index found at {index_path}')
+        self._uri = f'file:{p(index_path).absolute()}?mode=ro'
+        # Connection of each thread, and every connection opened, to close them
+        self._local = threading.local()
+        self._conns = []
+        # Lock protecting the list of connections and the token cache
+        self._lock = threading.Lock()
+        # Cache of the token IDs and document frequencies already looked up
+        self._token_cache = {}
+
+    def _conn(self):
+        """Return the connection of the current thread, opening it if needed"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def _token_stats(self, tokens):
+        """Return the (ID, document frequency) of the given tokens, skipping
+        tokens not in the index"""
+        with self._lock:
+            missing = [x for x in tokens if x not in self._token_cache]
+        if missing:
+            stats = dict.fromkeys(missing)
+            for (token, token_id, df) in self._conn().execute(
+                    f'SELECT token, id, df FROM tokens WHERE token IN ({",".join("?" * len(missing))})', missing):
+                stats[token] = (token_id, df)
+            with self._lock:
+                self._token_cache.update(stats)
+        with self._lock:
+            return [self._token_cache[x] for x in tokens if self._token_cache[x] is not None]
+
+    def match(self, authors, year, title):
+        """Return the DOI of the best matching work for the given authors
+        (semicolon-separated), year and title, or None if there is no good
+        enough match"""
+        tokens = _tokens(title)
+        stats = self._token_stats(tokens)
+        if not stats:
+            return None
+        # Only look up the candidates of the rarest tokens
+        rarest = [x[0] for x in sorted(stats, key=lambda x: x[1])
+                  [:global_vars.offline_query_tokens]]
+        candidates = self._conn().execute(
+            f"""SELECT w.doi, w.year, w.authors, w.title FROM works w JOIN (
+                SELECT work_id, COUNT(*) AS hits FROM postings
+                WHERE token_id IN ({",".join("?" * len(rarest))})
+                GROUP BY work_id ORDER BY hits DESC LIMIT ?) c ON w.id = c.work_id""",
+            (*rarest, global_vars.offline_max_candidates)).fetchall()
+
+        try:
+            year = int(year)
+        except (TypeError, ValueError):
+            year = None
+        families = _family_names(str(authors).split(';'))
+
+        best_doi, best_score = None, 0
+        for (doi, work_year, work_authors, work_title) in candidates:
+            # Filter out the candidates published in a different year
+            if year is not None and work_year is not None and abs(year - work_year) > 1:
+                continue
+            # Filter out the candidates without any author in common
+            work_families = set(work_authors.split())
+            if families and work_families and not families & work_families:
+                continue
+            # Score the candidates on the similarity of their titles
+            work_tokens = set(work_title.split())
+            score = len(tokens & work_tokens) / len(tokens | work_tokens)
+            if score > best_score:
+                best_doi, best_score = doi, score
+        if best_score < global_vars.offline_match_threshold:
+            return None
+        return 'https://doi.org/' + best_doi
+
+    def close(self):
+        """Close the connections to the index"""
+        with self._lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+
+
+if __name__ == '__main__':
+    # Command line interface to build the index of a Crossref metadata dump
+    parser = argparse.ArgumentParser(prog='Crossref Snapshot Indexer',
+                                     description='Build the offline DOI matching index of a Crossref metadata dump.')
+    parser.add_argument('dump_paths', nargs='+',
+                        help='The Crossref metadata dump files (.json, .jsonl, optionally gzipped), or directories containing them.')
+    parser.add_argument('index_path',
+                        help='The path of the index file to create.')
+    parser.add_argument('-v', '--verbose',
+                        help='Verbose logging mode.',
+                        action='store_true')
+    args = parser.parse_args()
+    build_index(args.dump_paths, args.index_path, args.verbose)
@@ -0,0 +1,468 @@
+import argparse
+import csv
+import json
+import queue
+import threading
+import uuid
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path as p
+from sys import exit
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper import http_transport
+from google_scholar_scraper.serp_query import scrape_google_scholar, SerpCache
+from google_scholar_scraper.serp_query.credit_budget import CreditBudget
+from google_scholar_scraper.serp_query.key_pool import KeyPool, load_keys
+from google_scholar_scraper.crossref_query.crossref_query import crossref_query
+from google_scholar_scraper.crossref_query.doi_cache import DoiCache
+from google_scholar_scraper.crossref_query.doi_pipeline import DoiPipeline
+from google_scholar_scraper.scheduler import plan_queries, run_plan
+from google_scholar_scraper.utils import merge_search, parse_queries
+
+# The scraper as a long-running service: jobs are submitted to a local HTTP
+# JSON API, queued, and run by a pool of workers, which share the HTTP
+# connections, rate limiters, retry engines and local caches across jobs
+
+
+def _now():
+    """Return the current time as an ISO 8601 string"""
+    return datetime.now(timezone.utc).isoformat()
+
+
+class JobError(Exception):
+    """Error in the request of a job, returned to the client"""
+
+
+class ScraperDaemon:
+    """Queue of scrape and DOI-only jobs, run by a pool of worker threads with
+    the settings of the daemon. Jobs are kept in memory, and only the most
+    recent finished ones are remembered. Jobs with the same output directory
+    run one at a time. The API key can also be a pool of keys (a KeyPool)
+    shared by every job."""
+
+    def __init__(self, serp_api_key, email, base_output_dir, cache_dir=None,
+                 workers=global_vars.daemon_workers, concurrency=global_vars.default_concurrency,
+                 query_concurrency=global_vars.default_query_concurrency,
+                 serp_rate_limit=global_vars.default_serp_rate_limit,
+                 crossref_concurrency=global_vars.default_crossref_concurrency,
+                 output_format=global_vars.default_output_format, monthly_budget=None,
+                 serp_api_url=global_vars.serp_api_url,
+                 crossref_api_url=global_vars.crossref_api_url, verbose=False):
+        self.serp_api_key = serp_api_key
+        self.email = email
+        self.base_output_dir = p(base_output_dir)
+        self.concurrency = concurrency
+        self.query_concurrency = query_concurrency
+        self.serp_rate_limit = serp_rate_limit
+        self.crossref_concurrency = crossref_concurrency
+        self.output_format = output_format
+        self.serp_api_url = serp_api_url
+        self.crossref_api_url = crossref_api_url
+        self.verbose = verbose
+        # The local caches and the budget stay open for the life of the daemon,
+        # converting the TTL from hours to seconds and the size from MB to bytes
+        self.serp_cache = SerpCache(cache_dir, global_vars.default_cache_ttl * 3600,
+                                    global_vars.default_cache_max_size * 1024 * 1024) \
+            if cache_dir is not None else None
+        self.doi_cache = DoiCache(cache_dir) if cache_dir is not None else None
+        self.budget = CreditBudget(cache_dir, monthly_budget) \
+            if cache_dir is not None and monthly_budget is not None else None
+        # SerpApi requests in flight, shared by every job
+        self.request_slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._queue = queue.Queue()
+        # Output directories of the running jobs, and the jobs queued for them
+        # meanwhile, queued again once the running job is finished
+        self._busy_dirs = {}
+        self._workers = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(max(workers, 1))]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, request):
+        """Validate the request of a job and queue it. Return the job"""
+        if not isinstance(request, dict):
+            raise JobError('The request must be a JSON object')
+        job = {'id': uuid.uuid4().hex, 'status': 'queued', 'stage': None,
+               'created': _now(), 'started': None, 'finished': None,
+               'queries_total': 0, 'queries_done': 0, 'rows_scraped': 0,
+               'output_dir': None, 'output_files': [], 'merged_file': None, 'error': None}
+        # DOI-only jobs look up the DOIs of existing files of search results
+        if request.get('doi_only'):
+            job['kind'] = 'doi'
+            job['files'] = [str(x) for x in self._doi_only_files(
+                request['doi_only'], bool(request.get('recursive', False)))]
+        else:
+            job['kind'] = 'scrape'
+            job['queries'] = self._parse_queries(request)
+            job['queries_total'] = len(job['queries'])
+        job['doi'] = bool(request.get('doi', True))
+        job['merge'] = bool(request.get('merge', True))
+        # Jobs with the same output directory name resume each other's scrapes
+        output_dir_name = request.get('output_dir_name') or job['id']
+        if not isinstance(output_dir_name, str) or p(output_dir_name).name != output_dir_name:
+            raise JobError('output_dir_name must be a plain folder name')
+        job['output_dir'] = str(self.base_output_dir / output_dir_name)
+        with self._lock:
+            self._jobs[job['id']] = job
+            self._forget_old_jobs()
+        self._queue.put(job['id'])
+        return self.get(job['id'])
+
+    @staticmethod
+    def _parse_queries(request):
+        """Return the (query, max results, priority) tuples of a scrape job,
+        given either as a list of queries or as a query file on this machine"""
+        max_results = request.get('max_results', global_vars.default_max_results)
+        if not isinstance(max_results, int) or max_results < 1:
+            raise JobError('max_results must be a positive integer')
+        if request.get('query_file'):
+            try:
+                parsed_queries = parse_queries(None, max_results, str(request['query_file']),
+                                               False)
+            except (OSError, csv.Error) as e:
+                raise JobError(f'Could not read the query file: {e}')
+        else:
+            queries = request.get('queries') or \
+                ([request['query']] if request.get('query') else [])
+            if not isinstance(queries, list):
+                raise JobError('queries must be a list')
+            parsed_queries = []
+            for query in queries:
+                # Each query is either a string, or an object with its own
+                # maximum number of results and priority
+                if isinstance(query, str):
+                    query = {'query': query}
+                if not isinstance(query, dict) or not isinstance(query.get('query'), str) or \
+                        not query['query'].strip():
+                    raise JobError('Every query must be a non-empty string or an object with a query')
+                query_max_results = query.get('max_results', max_results)
+                priority = query.get('priority', 0)
+                if not isinstance(query_max_results, int) or query_max_results < 1 or \
+                        not isinstance(priority, int):
+                    raise JobError(
+                        f'Invalid max_results or priority for query "{query["query"]}"')
+                parsed_queries.append((query['query'].strip(), query_max_results, priority))
+        if not parsed_queries:
+            raise JobError('The job has no queries')
+        return parsed_queries
+
+    @staticmethod
+    def _doi_only_files(doi_only, recursive):
+        """Return the files of search results of a DOI-only job"""
+        path = p(str(doi_only))
+        if path.is_file():
+            return [path]
+        if path.is_dir():
+            return [x for extension in ('csv', 'parquet') for x in path.glob(
+                f'**/*.{extension}' if recursive else f'*.{extension}')]
+        raise JobError(f'No file or directory found for the DOI search ({doi_only})')
+
+    def _forget_old_jobs(self):
+        """Forget the oldest finished jobs beyond the number to remember"""
+        finished = [x for x in self._jobs.values() if x['status'] in ('done', 'failed', 'cancelled')]
+        for job in finished[:max(len(finished) - global_vars.daemon_max_finished_jobs, 0)]:
+            del self._jobs[job['id']]
+
+    def _public(self, job):
+        """Return the status of a job, without its internal fields"""
+        return {x: y for (x, y) in job.items() if x not in ('queries', 'files')}
+
+    def get(self, job_id):
+        """Return the status of a job, or None if there is no such job"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._public(job) if job is not None else None
+
+    def jobs(self):
+        """Return the status of every job"""
+        with self._lock:
+            return [self._public(x) for x in self._jobs.values()]
+
+    def cancel(self, job_id):
+        """Cancel a queued job. Return whether it was cancelled, or None if
+        there is no such job"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job['status'] != 'queued':
+                return False
+            job['status'] = 'cancelled'
+            job['finished'] = _now()
+            return True
+
+    def health(self):
+        """Return the number of jobs of each status"""
+        with self._lock:
+            statuses = [x['status'] for x in self._jobs.values()]
+        return {'status': 'ok', 'workers': len(self._workers),
+                'jobs': {x: statuses.count(x) for x in
+                         ('queued', 'running', 'done', 'failed', 'cancelled')}}
+
+    def _update(self, job, **fields):
+        """Update the fields of a job"""
+        with self._lock:
+            job.update(fields)
+
+    def _work(self):
+        """Run the queued jobs, one at a time"""
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                # Skip the jobs cancelled while they were queued
+                if job is None or job['status'] != 'queued':
+                    continue
+                # Wait for the running job with the same output directory, as
+                # their scrapes would write to the same files
+                if job['output_dir'] in self._busy_dirs:
+                    self._busy_dirs[job['output_dir']].append(job_id)
+                    continue
+                self._busy_dirs[job['output_dir']] = []
+                job['status'] = 'running'
+                job['started'] = _now()
+            try:
+                self._run(job)
+                self._update(job, status='done', stage=None, finished=_now())
+            # The scraper exits when it runs out of retry attempts or budget
+            except SystemExit as e:
+                self._update(job, status='failed', finished=_now(),
+                             error=f'The scraper exited with code {e.code}')
+            except Exception as e:
+                self._update(job, status='failed', finished=_now(), error=str(e))
+            finally:
+                with self._lock:
+                    waiting = self._busy_dirs.pop(job['output_dir'])
+                for waiting_id in waiting:
+                    self._queue.put(waiting_id)
+
+    def _run(self, job):
+        """Run a job: scrape its queries (looking up the DOIs as they are
+        scraped) or look up the DOIs of its files, and merge its files"""
+        output_dir = p(job['output_dir'])
+        output_dir.mkdir(exist_ok=True, parents=True)
+        if job['kind'] == 'doi':
+            output_files = [p(x) for x in job['files']]
+            self._update(job, stage='doi', output_files=[str(x) for x in output_files])
+            crossref_query(self.email, self.verbose, output_files, self.crossref_concurrency,
+                           self.doi_cache, api_url=self.crossref_api_url)
+        else:
+            self._update(job, stage='scrape')
+            plan = plan_queries(job['queries'], output_dir, self.serp_cache)
+            doi_pipeline = DoiPipeline(self.email, self.verbose, self.crossref_concurrency,
+                                       self.doi_cache, api_url=self.crossref_api_url) \
+                if job['doi'] else None
+
+            def on_rows(rows):
+                """Count the rows scraped, and pass them on to the DOI pipeline"""
+                with self._lock:
+                    job['rows_scraped'] += len(rows)
+                if doi_pipeline is not None:
+                    doi_pipeline.put(rows)
+
+            def scrape(query, max_results):
+                """Scrape a query, and save its DOIs into its file once they are
+                looked up"""
+                output_file = scrape_google_scholar(
+                    self.serp_api_key, query, max_results, output_dir, self.verbose,
+                    self.concurrency, self.serp_rate_limit, self.serp_cache,
+                    api_url=self.serp_api_url, output_format=self.output_format,
+                    budget=self.budget, request_slots=self.request_slots, on_rows=on_rows)
+                if doi_pipeline is not None:
+                    doi_pipeline.add_file(output_file)
+                with self._lock:
+                    job['queries_done'] += 1
+                    job['output_files'].append(str(output_file))
+                return output_file
+
+            try:
+                output_files = run_plan(plan, scrape, self.query_concurrency)
+            except BaseException:
+                if doi_pipeline is not None:
+                    doi_pipeline.close(cancel=True)
+                raise
+            # Keep the output files in the order of the queries
+            self._update(job, output_files=[str(x) for x in output_files])
+            if doi_pipeline is not None:
+                self._update(job, stage='doi')
+                doi_pipeline.close()
+        if job['merge'] and len(output_files) > 1:
+            self._update(job, stage='merge')
+            merged_file = merge_search(output_files, output_dir, self.verbose, self.output_format)
+            self._update(job, merged_file=str(merged_file))
+
+    def close(self):
+        """Close the local caches and the HTTP connections"""
+        for resource in (self.serp_cache, self.doi_cache, self.budget,
+                         self.serp_api_key if isinstance(self.serp_api_key, KeyPool) else None):
+            if resource is not None:
+                resource.close()
+        http_transport.close()
+
+
+class _DaemonHandler(BaseHTTPRequestHandler):
+    """Handler of the requests to the JSON API of the daemon:
+    POST /jobs to submit a job, GET /jobs and GET /jobs/{id} for their status,
+    DELETE /jobs/{id} to cancel a queued job, and GET /health"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        """Only log the requests in verbose mode"""
+        if (self.server.scraper.verbose):
+            super().log_message(format, *args)
+
+    def _send_json(self, status, body):
+        """Send a JSON response with the given status code"""
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job_id(self):
+        """Return the job ID of the path, or None if it is not a job path"""
+        parts = self.path.strip('/').split('/')
+        return parts[1] if len(parts) == 2 and parts[0] == 'jobs' else None
+
+    def do_GET(self):
+        """Return the status of the daemon, of every job, or of a job"""
+        scraper = self.server.scraper
+        if self.path.rstrip('/') == '/health':
+            self._send_json(200, scraper.health())
+        elif self.path.rstrip('/') == '/jobs':
+            self._send_json(200, {'jobs': scraper.jobs()})
+        elif self._job_id() is not None:
+            job = scraper.get(self._job_id())
+            if job is None:
+                self._send_json(404, {'error': 'Job not found'})
+            else:
+                self._send_json(200, job)
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        """Submit a job"""
+        if self.path.rstrip('/') != '/jobs':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}')
+            job = self.server.scraper.submit(request)
+        # Invalid requests, including query files which cannot be read or parsed
+        except (ValueError, JobError, csv.Error, OSError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        self._send_json(202, job)
+
+    def do_DELETE(self):
+        """Cancel a queued job"""
+        if self._job_id() is None:
+            self._send_json(404, {'error': 'Not found'})
+            return
+        cancelled = self.server.scraper.cancel(self._job_id())
+        if cancelled is None:
+            self._send_json(404, {'error': 'Job not found'})
+        elif not cancelled:
+            self._send_json(409, {'error': 'Only queued jobs can be cancelled'})
+        else:
+            self._send_json(200, self.server.scraper.get(self._job_id()))
+
+
+class DaemonServer(ThreadingHTTPServer):
+    """HTTP server of the JSON API of a scraper daemon"""
+    daemon_threads = True
+
+    def __init__(self, scraper, host=global_vars.daemon_host, port=global_vars.daemon_port):
+        super().__init__((host, port), _DaemonHandler)
+        self.scraper = scraper
+
+
+def main():
+    """Command line interface to run the scraper as a daemon"""
+    parser = argparse.ArgumentParser(prog='Google Scholar Scraper Daemon',
+                                     description='Run the scraper as a long-running service with a local HTTP JSON API to submit scrape and DOI-only jobs to.')
+    parser.add_argument(
+        'serp_api_key', help='The API key for your SerpApi account to use to scrape Google Scholar data, or a pool of keys: the path of a file with one key per line, or env:NAME for an environment variable with comma-separated keys.')
+    parser.add_argument(
+        'email', help='For faster Crossref API queries, we require an email address.')
+    parser.add_argument('--host',
+                        help=f'Set the address to listen on. Default = {global_vars.daemon_host}.',
+                        default=global_vars.daemon_host, type=str)
+    parser.add_argument('--port',
+                        help=f'Set the port to listen on. Default = {global_vars.daemon_port}.',
+                        default=global_vars.daemon_port, type=int)
+    parser.add_argument('-w', '--workers',
+                        help=f'Sets the number of jobs to run at the same time. Default = {global_vars.daemon_workers}.',
+                        default=global_vars.daemon_workers, type=int)
+    parser.add_argument('-b', '--base-output-dir',
+                        help="""Set the path for the base output directory, where
+                        each job gets a folder named after its ID (or its
+                        output_dir_name). By default, this is an 'output' folder
+                        in the current directory.""",
+                        default=str(p.cwd() / 'output'), type=str)
+    parser.add_argument('--cache-dir',
+                        help="""Set the path for the directory where the local caches
+                        of SerpApi responses and DOIs are stored. By default, this
+                        is a 'cache' folder in the current directory.""",
+                        default=str(p.cwd() / 'cache'), type=str)
+    parser.add_argument('--no-local-cache',
+                        help='Use this option to bypass the local caches of SerpApi responses and DOIs.',
+                        action='store_true')
+    parser.add_argument('-c', '--concurrency',
+                        help=f'Sets the maximum number of SerpApi result pages to request at the same time, across all jobs. Default = {global_vars.default_concurrency}.',
+                        default=global_vars.default_concurrency, type=int)
+    parser.add_argument('-Q', '--query-concurrency',
+                        help=f'Sets the maximum number of queries of a job to scrape at the same time. Default = {global_vars.default_query_concurrency}.',
+                        default=global_vars.default_query_concurrency, type=int)
+    parser.add_argument('--serp-rate-limit',
+                        help=f'Sets the maximum number of SerpApi requests per second, across all jobs. Default = {global_vars.default_serp_rate_limit}.',
+                        default=global_vars.default_serp_rate_limit, type=float)
+    parser.add_argument('-C', '--crossref-concurrency',
+                        help=f'Sets the maximum number of Crossref DOI lookups of a job to perform at the same time. Default = {global_vars.default_crossref_concurrency}.',
+                        default=global_vars.default_crossref_concurrency, type=int)
+    parser.add_argument('--monthly-budget',
+                        help='Sets the maximum number of SerpApi searches to use per calendar month, across all jobs. Needs the local cache.',
+                        type=int)
+    parser.add_argument('--output-format',
+                        help=f'Sets the format of the files of search results (csv or parquet). Default = {global_vars.default_output_format}.',
+                        choices=['csv', 'parquet'], default=global_vars.default_output_format)
+    parser.add_argument('-v', '--verbose',
+                        help='Verbose logging mode.',
+                        action='store_true')
+    args = parser.parse_args()
+
+    # Check that the numbers of workers, concurrency values and rate limit are positive
+    if min(args.workers, args.concurrency, args.query_concurrency, args.crossref_concurrency) < 1 \
+            or args.serp_rate_limit <= 0:
+        print('\nError: the workers, concurrency values and SerpApi rate limit must be greater than 0')
+        exit(406)
+
+    keys = load_keys(args.serp_api_key)
+    if not keys:
+        print(f'\nError: no SerpApi API key found in {args.serp_api_key}')
+        exit(404)
+    key_pool = KeyPool(keys, args.serp_rate_limit,
+                       None if args.no_local_cache else args.cache_dir, verbose=args.verbose)
+    scraper = ScraperDaemon(key_pool, args.email, args.base_output_dir,
+                            None if args.no_local_cache else args.cache_dir, args.workers,
+                            args.concurrency, args.query_concurrency, args.serp_rate_limit,
+                            args.crossref_concurrency, args.output_format, args.monthly_budget,
+                            verbose=args.verbose)
+    server = DaemonServer(scraper, args.host, args.port)
+    print(f'\nGoogle Scholar Scraper daemon listening on http://{args.host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scraper.close()
+
+
+if __name__ == '__main__':
+    main()
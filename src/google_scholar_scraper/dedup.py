@@ -0,0 +1,213 @@
+import re
+import numpy as np
+from pathlib import Path as p
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.result_files import read_fieldnames, read_rows, RowWriter
+
+# Regular expressions used to normalise titles and extract Google Scholar
+# cluster IDs, compiled once
+_non_alphanumeric_regex = re.compile(r'[\W_]+')
+_cluster_regex = re.compile(r'cluster=(\d+)')
+
+
+def _normalise_title(title):
+    """Normalise a title to lowercase alphanumeric words separated by spaces"""
+    return _non_alphanumeric_regex.sub(' ', str(title).lower()).strip()
+
+
+class _UnionFind:
+    """Disjoint sets of row indices, used to group rows into clusters"""
+
+    def __init__(self):
+        self.parents = []
+
+    def add(self):
+        """Add a new row in its own set"""
+        self.parents.append(len(self.parents))
+
+    def find(self, x):
+        """Return the representative row of the set of a row"""
+        while self.parents[x] != x:
+            # Halve the path to keep later lookups fast
+            self.parents[x] = self.parents[self.parents[x]]
+            x = self.parents[x]
+        return x
+
+    def union(self, x, y):
+        """Merge the sets of two rows, keeping the earliest row as representative"""
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            self.parents[max(x, y)] = min(x, y)
+
+
+class MinHasher:
+    """MinHash signatures of titles, based on their byte shingles, used to
+    estimate the Jaccard similarity of titles without comparing them pairwise"""
+
+    def __init__(self, num_perm=global_vars.minhash_permutations,
+                 shingle_size=global_vars.minhash_shingle_size, seed=1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        # Random multiply-add-shift hash functions, one per permutation
+        generator = np.random.default_rng(seed)
+        self._a = generator.integers(
+            1, 2**63, num_perm, dtype=np.uint64, endpoint=False) | np.uint64(1)
+        self._b = generator.integers(
+            0, 2**63, num_perm, dtype=np.uint64, endpoint=False)
+
+    def signatures(self, normalised_titles):
+        """Return the MinHash signatures of a list of non-empty normalised
+        titles, as an array with one row per title, computed for all the titles
+        at once"""
+        # Pad the short titles so every title has at least one shingle
+        encoded = [x.encode('utf-8').ljust(self.shingle_size)
+                   for x in normalised_titles]
+        lengths = np.fromiter((len(x) for x in encoded), dtype=np.int64,
+                              count=len(encoded))
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8).astype(np.uint64)
+        # Pack each run of shingle_size bytes into a single integer
+        shingles = np.zeros(len(data) - self.shingle_size + 1, dtype=np.uint64)
+        for i in range(self.shingle_size):
+            shingles = (shingles << np.uint64(8)) | \
+                data[i:len(data) - self.shingle_size + 1 + i]
+        # Only keep the shingles which do not cross from one title to the next
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        valid = np.ones(len(shingles), dtype=bool)
+        for i in range(1, self.shingle_size):
+            boundaries = ends[:-1] - i
+            valid[boundaries[boundaries >= 0]] = False
+        shingles = shingles[valid]
+        # Start of the shingles of each title once the invalid ones are removed
+        offsets = starts - np.arange(len(lengths)) * (self.shingle_size - 1)
+
+        signatures = np.empty((len(encoded), self.num_perm), dtype=np.uint32)
+        # Multiplication overflow wraps around, as intended for this hash family
+        hashes = np.empty_like(shingles)
+        with np.errstate(over='ignore'):
+            for perm in range(self.num_perm):
+                # Compute the hashes in place to avoid temporary arrays
+                np.multiply(shingles, self._a[perm], out=hashes)
+                np.add(hashes, self._b[perm], out=hashes)
+                np.right_shift(hashes, np.uint64(32), out=hashes)
+                signatures[:, perm] = np.minimum.reduceat(hashes, offsets)
+        return signatures
+
+
+def find_clusters(titles, years, scholar_clusters, bands=global_vars.minhash_bands,
+                  threshold=global_vars.near_duplicate_threshold):
+    """Group rows of search results into clusters of near duplicates, given
+    their normalised titles, years and Google Scholar cluster IDs (or None).
+    Rows are first grouped by their Google Scholar cluster ID, and then by
+    locality-sensitive hashing of the MinHash signatures of their titles, so
+    that only rows sharing a band of their signature are compared. Return a
+    list with the index of the representative row of each row's cluster."""
+    union_find = _UnionFind()
+    minhasher = MinHasher()
+    rows_per_band = minhasher.num_perm // bands
+    # First row seen for each Google Scholar cluster ID
+    first_rows = {}
+
+    for (idx, cluster) in enumerate(scholar_clusters):
+        union_find.add()
+        # Group the rows with the same Google Scholar cluster ID
+        if cluster is not None:
+            union_find.union(first_rows.setdefault(cluster, idx), idx)
+
+    # Only the rows with a title can be compared
+    titled = np.array([idx for (idx, x) in enumerate(titles) if x], dtype=np.int64)
+    years = np.array(years, dtype=str)
+    signatures = np.empty((len(titled), minhasher.num_perm), dtype=np.uint32)
+    # Compute the signatures in batches to bound memory use
+    for batch in range(0, len(titled), global_vars.minhash_batch_size):
+        signatures[batch:batch + global_vars.minhash_batch_size] = minhasher.signatures(
+            [titles[x] for x in titled[batch:batch + global_vars.minhash_batch_size]])
+
+    # Random multipliers to hash each band of the signatures into a single key
+    multipliers = np.random.default_rng(2).integers(
+        1, 2**63, rows_per_band, dtype=np.uint64)
+    for band in range(bands):
+        with np.errstate(over='ignore'):
+            keys = (signatures[:, band * rows_per_band:(band + 1) * rows_per_band]
+                    .astype(np.uint64) * multipliers).sum(axis=1)
+        # Sort the rows by key, keeping their order, so the first row of each
+        # group sharing the same key is the earliest one
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        group_starts = np.flatnonzero(
+            np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        firsts = order[np.repeat(group_starts, np.diff(
+            np.r_[group_starts, len(order)]))]
+        # Compare every row only with the first row sharing its band key
+        candidates = np.flatnonzero(firsts != order)
+        firsts, others = firsts[candidates], order[candidates]
+        # Check the estimated similarity of the titles, and that both rows were
+        # published in the same year (if known)
+        similarity = (signatures[firsts] == signatures[others]).mean(axis=1)
+        first_years, other_years = years[titled[firsts]], years[titled[others]]
+        matches = (similarity >= threshold) & ((first_years == '') | (other_years == '') |
+                                               (first_years == other_years))
+        for (first, other) in zip(titled[firsts[matches]], titled[others[matches]]):
+            union_find.union(int(first), int(other))
+
+    return [union_find.find(idx) for idx in range(len(years))]
+
+
+def dedup_search(file_path, verbose):
+    """Remove the near duplicates of a (merged) file of search results (in any
+    format), into a file of the same format, keeping
+    a single canonical record per cluster of near duplicates: the one with the
+    most non-empty fields, or the first one if there is a tie. The cluster of
+    each canonical record is stored in a new column. Return the path of the
+    file where the results were saved."""
+    file_path = p(file_path)
+    if (verbose):
+        print(f'\nRemoving near duplicates from {file_path.name}')
+
+    # First pass: read the fields needed to find the clusters of near
+    # duplicates, and the number of non-empty fields of each row
+    titles, years, scholar_clusters, completeness = [], [], [], []
+    for row in read_rows(file_path):
+        titles.append(_normalise_title(row.get(global_vars.title_key) or ''))
+        years.append(row.get(global_vars.pub_year_key) or '')
+        scholar_cluster = _cluster_regex.search(
+            row.get(global_vars.scholar_link_key) or '')
+        scholar_clusters.append(
+            scholar_cluster.group(1) if scholar_cluster else None)
+        completeness.append(sum(1 for x in row.values() if x))
+    clusters = find_clusters(titles, years, scholar_clusters)
+    del titles, years
+
+    # Find the most complete row of each cluster, and the Google Scholar
+    # cluster ID of any of its rows
+    canonical = {}
+    cluster_ids = {}
+    for (idx, cluster) in enumerate(clusters):
+        if cluster not in canonical or completeness[idx] > completeness[canonical[cluster]]:
+            canonical[cluster] = idx
+        if scholar_clusters[idx] is not None:
+            cluster_ids.setdefault(cluster, scholar_clusters[idx])
+    canonical_rows = {idx: cluster for (cluster, idx) in canonical.items()}
+
+    fieldnames = read_fieldnames(file_path)
+    if global_vars.cluster_id_key not in fieldnames:
+        fieldnames.append(global_vars.cluster_id_key)
+
+    # Second pass: write only the canonical rows, with their cluster ID, taken
+    # from Google Scholar when available, or from the first row of the cluster
+    output_file_path = file_path.with_name(
+        f'{file_path.stem}_dedup{file_path.suffix}')
+    with RowWriter(output_file_path, fieldnames) as writer:
+        for (idx, row) in enumerate(read_rows(file_path)):
+            if idx not in canonical_rows:
+                continue
+            cluster = canonical_rows[idx]
+            row[global_vars.cluster_id_key] = cluster_ids.get(
+                cluster, f'row-{cluster + 1}')
+            writer.writerow(row)
+
+    # If verbose, signal completion
+    if (verbose):
+        print(
+            f'\nNear duplicates removed: {len(clusters) - len(canonical)} of {len(clusters)} rows. File {str(output_file_path)} saved.')
+    return output_file_path
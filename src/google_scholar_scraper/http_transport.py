@@ -0,0 +1,58 @@
+import threading
+from google_scholar_scraper.config import global_vars
+
+# HTTP client shared by every SerpApi and Crossref request, so connections are
+# kept alive and reused across pages, queries and files. httpx is only
+# imported once the first request is made, so runs answered from the local
+# caches start faster
+_client = None
+_client_lock = threading.Lock()
+_settings = {'timeout': global_vars.default_http_timeout,
+             'max_connections': global_vars.default_http_max_connections}
+
+
+def configure(timeout=global_vars.default_http_timeout,
+              max_connections=global_vars.default_http_max_connections):
+    """Set the timeout (in seconds) and the size of the connection pool of the
+    shared HTTP client, replacing any existing client"""
+    global _client
+    with _client_lock:
+        _settings['timeout'] = timeout
+        _settings['max_connections'] = max_connections
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def get_client():
+    """Return the shared HTTP client, creating it if it does not exist yet. It
+    pools keep-alive connections and handles gzip/deflate compressed responses"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            import httpx
+            _client = httpx.Client(
+                timeout=_settings['timeout'],
+                limits=httpx.Limits(max_connections=_settings['max_connections'],
+                                    max_keepalive_connections=_settings['max_connections']),
+                headers={'Accept-Encoding': 'gzip, deflate'},
+                follow_redirects=True)
+        return _client
+
+
+def get_json(url, params=None, headers=None):
+    """Perform a GET request with the shared HTTP client and return a tuple of
+    its JSON response as a dictionary and the response headers. Raise an
+    httpx.HTTPStatusError if the request was not successful"""
+    response = get_client().get(url, params=params, headers=headers)
+    response.raise_for_status()
+    return (response.json(), response.headers)
+
+
+def close():
+    """Close the connections of the shared HTTP client"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
@@ -1,7 +1,9 @@
-from google_scholar_scraper.config import parse_args
-from google_scholar_scraper.serp_query import scrape_google_scholar
-from google_scholar_scraper.utils import merge_search, parse_queries, select_dir
-from google_scholar_scraper.crossref_query.crossref_query import crossref_query
+from google_scholar_scraper.config import parse_args, global_vars
+from google_scholar_scraper import http_transport
+from google_scholar_scraper.metrics import get_metrics
+from google_scholar_scraper.result_files import has_pyarrow
+import atexit
+import threading
 import time
 from pathlib import Path as p
 from sys import exit
@@ -17,13 +19,26 @@ def main():
     serp_api_key, email, query_file, query_string, interactive_query_file_picker, \
         max_results, base_output_dir, interactive_base_output_dir_picker, \
         custom_output_dir_name, no_merge, no_doi, doi_only, recursive_doi_only, \
-        verbose = \
+        verbose, concurrency, serp_rate_limit, no_local_cache, refresh_cache, \
+        cache_dir, cache_ttl, cache_max_size, crossref_concurrency, \
+        crossref_snapshot_index, fuzzy_dedup, http_timeout, http_max_connections, \
+        metrics, prometheus_textfile, profile, output_format, query_concurrency, \
+        monthly_budget, dry_run, pipeline, incremental, since_last_run, archive_dir, \
+        result_store, partition_years = \
         args.serp_api_key, args.email, args.query_file, \
         args.query_string, args.interactive_query_file_picker, \
         args.max_results, args.base_output_dir, \
         args.interactive_base_output_dir_picker, \
         args.custom_output_dir_name, args.no_merge, args.no_doi, args.doi_only, \
-        args.recursive_doi_only, args.verbose
+        args.recursive_doi_only, args.verbose, args.concurrency, \
+        args.serp_rate_limit, args.no_local_cache, args.refresh_cache, \
+        args.cache_dir, args.cache_ttl, args.cache_max_size, \
+        args.crossref_concurrency, args.crossref_snapshot_index, args.fuzzy_dedup, \
+        args.http_timeout, args.http_max_connections, args.metrics, \
+        args.prometheus_textfile, args.profile, args.output_format, \
+        args.query_concurrency, args.monthly_budget, args.dry_run, args.pipeline, \
+        args.incremental, args.since_last_run, args.archive_dir, args.result_store, \
+        args.partition_years
 
     if verbose:
         print('\nGoogle Scholar Scraper')
@@ -37,12 +52,70 @@ def main():
             f'\nError: max_results ("{max_results}") is not a valid positive integer')
         exit(406)
 
+    # Check that the concurrency values and rate limit are positive
+    if concurrency < 1 or query_concurrency < 1 or crossref_concurrency < 1 or serp_rate_limit <= 0:
+        print(
+            f'\nError: concurrency ("{concurrency}"), query concurrency ("{query_concurrency}"), Crossref concurrency ("{crossref_concurrency}") and SerpApi rate limit ("{serp_rate_limit}") must be greater than 0')
+        exit(406)
+
+    # Check that the monthly budget of SerpApi searches, if any, is not negative
+    if monthly_budget is not None and monthly_budget < 0:
+        print(
+            f'\nError: monthly budget ("{monthly_budget}") must not be negative')
+        exit(406)
+
+    # Check that the HTTP settings are positive, and apply them to the
+    # connections shared by the SerpApi and Crossref requests
+    if http_timeout <= 0 or http_max_connections < 1:
+        print(
+            f'\nError: HTTP timeout ("{http_timeout}") and HTTP max connections ("{http_max_connections}") must be greater than 0')
+        exit(406)
+    http_transport.configure(http_timeout, http_max_connections)
+
+    # Check that the optional package needed for Parquet files is installed
+    if output_format == 'parquet' and not has_pyarrow():
+        print(
+            '\nError: the parquet output format needs the pyarrow package. Install it with "pip install pyarrow"')
+        exit(406)
+
+    # Check that the year narrowing is only requested for incremental runs
+    if since_last_run and not incremental:
+        print('\nError: --since-last-run can only be used with --incremental')
+        exit(406)
+
+    # Check that the result store is not used with the pipeline, which saves
+    # the DOIs into the files of each query instead
+    if result_store and pipeline:
+        print('\nError: --result-store cannot be used with --pipeline')
+        exit(406)
+
+    # Check that the queries are only partitioned by year when their ranks
+    # and year ranges are not already used otherwise
+    if partition_years is not None and (incremental or result_store):
+        print('\nError: --partition-years cannot be used with --incremental or --result-store')
+        exit(406)
+    if partition_years is not None and not 0 < partition_years <= int(time.strftime('%Y')):
+        print(
+            f'\nError: the first year of the partitions ("{partition_years}") must be between 1 and the current year')
+        exit(406)
+
+    # Read the SerpApi API keys, which can be a pool of keys from a file or an
+    # environment variable. The modules of each stage are only imported when
+    # the run uses them, so the CLI starts fast
+    if (not doi_only):
+        from google_scholar_scraper.serp_query.key_pool import KeyPool, load_keys
+        serp_api_keys = load_keys(serp_api_key)
+        if not serp_api_keys:
+            print(f'\nError: no SerpApi API key found in {serp_api_key}')
+            exit(404)
+
     # Take the base output dir value and convert it to a Path object
     base_output_dir = p(base_output_dir)
 
     # If the user requested the use of the interactive directory picker,
     # run the method to get the chosen base output directory
     if (interactive_base_output_dir_picker):
+        from google_scholar_scraper.utils import select_dir
         base_output_dir = select_dir()
 
     # If the user did not specify a custom output directory name, specify
@@ -56,38 +129,229 @@ def main():
     if (verbose):
         print(f'\nOutput path: {str(output_dir)}')
 
+    # Record the metrics of the run, profiling each stage if requested, and
+    # save them when the run ends (even if it exits early with an error)
+    run_metrics = get_metrics()
+    if (profile):
+        run_metrics.profile_dir = output_dir / '.profile'
+    if (metrics or prometheus_textfile):
+        atexit.register(run_metrics.write_json, output_dir / 'metrics.json')
+        atexit.register(run_metrics.write_prometheus,
+                        prometheus_textfile or output_dir / 'metrics.prom')
+
+    # If we do want to get DOIs for search results (i.e. if nodoi was not set)
+    if (not no_doi):
+        from google_scholar_scraper.crossref_query.doi_cache import DoiCache
+        # Open the local cache of DOIs, unless it should be bypassed
+        doi_cache = None if no_local_cache else DoiCache(
+            cache_dir, refresh_cache)
+        # Open the index of the local Crossref metadata dump, if one was given
+        offline_index = None
+        if (crossref_snapshot_index):
+            from google_scholar_scraper.crossref_query.offline_index import OfflineIndex
+            try:
+                offline_index = OfflineIndex(crossref_snapshot_index)
+            except FileNotFoundError as e:
+                print(f'\nError: {e}')
+                exit(404)
+    # Pipeline looking up the DOIs while the queries are scraped, if requested
+    doi_pipeline = None
+    # Open the store of the search results of every run, if requested
+    store = None
+    if (result_store):
+        from google_scholar_scraper.result_store import ResultStore
+        store = ResultStore(result_store)
+
     # If we do not want to just get the DOI for existing search results
     if (not doi_only):
+        from google_scholar_scraper.serp_query import scrape_google_scholar, SerpCache
+        from google_scholar_scraper.scheduler import plan_queries, print_plan, run_plan
+        from google_scholar_scraper.utils import parse_queries
+        # Open the local cache of SerpApi responses, unless it should be bypassed,
+        # converting the TTL from hours to seconds and the size from MB to bytes.
+        # Incremental runs look for new search results, so they always
+        # request fresh pages
+        serp_cache = None if no_local_cache else SerpCache(
+            cache_dir, cache_ttl * 3600, cache_max_size * 1024 * 1024,
+            refresh_cache or incremental)
+        # Open the store of the search results seen by previous runs, if the
+        # scrape is incremental
+        seen = None
+        if (incremental):
+            from google_scholar_scraper.serp_query.seen_store import SeenStore
+            seen = SeenStore(cache_dir)
+        # Open the archive of raw SerpApi responses, if requested, finishing
+        # its segment when the run ends
+        archive = None
+        if (archive_dir):
+            from google_scholar_scraper.serp_query.response_archive import ResponseArchive
+            archive = ResponseArchive(archive_dir)
+            atexit.register(archive.close)
         # Get the list of queries to run
-        parsed_queries = parse_queries(
-            query_string, max_results, query_file, interactive_query_file_picker)
-        # Declare an array of output file paths
-        output_files = []
+        with run_metrics.stage('parse'):
+            parsed_queries = parse_queries(
+                query_string, max_results, query_file, interactive_query_file_picker)
 
         # If we want verbose logging, show the results of the query parsing
         if (verbose):
             print(f'\nNumber of queries: {len(parsed_queries)}')
             print('\nQueries parsed:')
-            for (query, max_results) in parsed_queries:
-                print(f'query: {query}: {max_results} desired results.')
+            for (query, max_results, priority) in parsed_queries:
+                print(
+                    f'query: {query}: {max_results} desired results, priority {priority}.')
+
+        # Open the ledger of the monthly budget of SerpApi searches, if any
+        budget = None
+        if (monthly_budget is not None):
+            from google_scholar_scraper.serp_query.credit_budget import CreditBudget
+            budget = CreditBudget(cache_dir, monthly_budget)
+        # Requests in flight, shared by all the queries scraped at the same time
+        request_slots = threading.BoundedSemaphore(concurrency)
+        # Spread the searches across the keys of the pool, reading their
+        # searches left from SerpApi (or the cache) if there are several
+        key_pool = KeyPool(serp_api_keys, serp_rate_limit, cache_dir, verbose=verbose)
+        atexit.register(key_pool.close)
+        # Plan the scrape: merge the duplicate queries, order them by priority,
+        # and count the SerpApi searches they will cost
+        plan = plan_queries(parsed_queries, output_dir, serp_cache)
+        # Split the queries beyond the cap of Google Scholar into ranges of
+        # publication years, if requested, and count the searches of each
+        # range. The search results of each range are counted with its first
+        # page, which its scrape then uses. At first, they are only counted
+        # from the local cache, so no search is made before the dry run
+        # stops or the budget is checked, and the queries whose ranges are
+        # not all in the cache keep the estimate of their plain scrape
+        partition_plans = {}
+        uncounted = []
+        if (partition_years is not None):
+            from google_scholar_scraper.serp_query.partition import plan_partitioned, \
+                scrape_partitioned, partitions_dir
+            from google_scholar_scraper.scheduler import plan_partitions_cost
+
+            def plan_partitions(entry, offline):
+                """Split a query into ranges of publication years, and count
+                their searches. Return whether every range was counted"""
+                partitions = plan_partitioned(
+                    key_pool, entry['query'], entry['max_results'], output_dir, verbose,
+                    partition_years, query_concurrency, serp_rate_limit, serp_cache,
+                    budget=budget, request_slots=request_slots, archive=archive,
+                    offline=offline)
+                if (partitions is None):
+                    return False
+                partition_plans[entry['query']] = partitions
+                plan_partitions_cost(entry, partitions, partitions_dir(output_dir), serp_cache)
+                return True
+
+            for entry in plan:
+                if (entry['max_results'] > global_vars.scholar_result_cap and
+                        not plan_partitions(entry, True)):
+                    uncounted.append(entry)
+        if (verbose or dry_run):
+            print_plan(plan, budget)
+            if (incremental):
+                print('Incremental run: the searches are a maximum, as each query stops at its first page without new search results')
+            if (partition_plans):
+                print('Partitioned run: the searches of the queries split by year are an estimate from the number of search results of each range, counted with its first page')
+            if (uncounted):
+                print(f'Partitioned run: the search results of {len(uncounted)} queries split by year are not counted yet, so their searches are estimated from their maximum number of results. Counting them costs about a search per range')
+        # Warn about the search results which cannot be reached without
+        # partitioning the query
+        if (partition_years is None):
+            for entry in plan:
+                if entry['max_results'] > global_vars.scholar_result_cap:
+                    print(f'\nWarning: Google Scholar returns at most {global_vars.scholar_result_cap} search results per query. Use --partition-years to scrape more: {entry["query"]}')
+        # If we only wanted the plan, stop here
+        if (dry_run):
+            exit(0)
+        # If the planned searches do not fit in the remaining budget, refuse
+        # to start the run, rather than stopping halfway through it. The
+        # searches of incremental runs are only a maximum, so they are not
+        # refused, and stop if the budget runs out mid-run instead
+        def check_budget():
+            """Exit if the planned searches exceed the remaining budget"""
+            planned_credits = sum(x['credits'] for x in plan)
+            if (budget is not None and not incremental and planned_credits > budget.remaining()):
+                print(
+                    f'\nError: the planned {planned_credits} SerpApi searches exceed the {budget.remaining()} remaining in the monthly budget')
+                exit(402)
 
-        # For each query, run the google scholar scraper, and store its return
-        # value (the path of the output file) in the array of output files
-        for query, max_results in parsed_queries:
+        check_budget()
+        # Count the search results of the ranges which were not in the cache,
+        # and check the budget again with their searches
+        if (uncounted):
+            for entry in uncounted:
+                plan_partitions(entry, False)
+            check_budget()
+
+        if (verbose and len(key_pool) > 1):
+            key_pool.refresh()
+            print(f'\nSerpApi key pool: {len(key_pool.active())} of {len(key_pool)} keys usable')
+
+        # If requested, look up the DOIs of the search results while the
+        # queries are being scraped
+        if (pipeline and not no_doi):
+            from google_scholar_scraper.crossref_query.doi_pipeline import DoiPipeline
+            doi_pipeline = DoiPipeline(email, verbose, crossref_concurrency, doi_cache,
+                                       offline_index)
+
+        def scrape(query, max_results):
+            """Run the google scholar scraper for a query, and return the path
+            of its output file"""
             if (verbose):
                 print(f'\nStarting Google Scholar scrape: {query}')
-            output_files.append(
-                scrape_google_scholar(serp_api_key, query, max_results, output_dir, verbose))
+            # Split the queries beyond the cap of Google Scholar into ranges of
+            # publication years, if requested
+            if (query in partition_plans):
+                output_file = scrape_partitioned(
+                    key_pool, query, max_results, output_dir, verbose, partition_years,
+                    concurrency, query_concurrency, serp_rate_limit, serp_cache,
+                    output_format=output_format, budget=budget, request_slots=request_slots,
+                    on_rows=doi_pipeline.put if doi_pipeline is not None else None,
+                    archive=archive, partitions=partition_plans[query])
+            else:
+                output_file = scrape_google_scholar(
+                    key_pool, query, max_results, output_dir, verbose, concurrency,
+                    serp_rate_limit, serp_cache, output_format=output_format, budget=budget,
+                    request_slots=request_slots,
+                    on_rows=doi_pipeline.put if doi_pipeline is not None else None,
+                    seen=seen, narrow_years=since_last_run, archive=archive, store=store)
+            # Save the DOIs of the query into its file once they are looked up
+            if (doi_pipeline is not None):
+                doi_pipeline.add_file(output_file)
+            return output_file
+
+        # Run the google scholar scraper for the queries, several at a time,
+        # and store the paths of their output files in the array of output files
+        with run_metrics.stage('scrape'):
+            try:
+                output_files = run_plan(plan, scrape, query_concurrency)
+            # If the scrape fails, do not look up any more DOIs
+            except BaseException:
+                if (doi_pipeline is not None):
+                    doi_pipeline.close(cancel=True)
+                raise
+        # If we want verbose logging, show how many SerpApi requests were retried
+        if (verbose):
+            from google_scholar_scraper.retry import get_retrier
+            stats = get_retrier('SerpApi').stats()
+            print(
+                f'\nSerpApi retries: {stats['retries']} ({stats['sleep_time']} seconds waiting), {stats['permanent_errors']} permanent errors')
     # If we do want to perform the DOI search
     else:
+        from google_scholar_scraper.result_store import ResultStore, is_result_store
+        output_files = []
+        # If the specified value is a result store, look up the DOIs of its
+        # results instead of files
+        if (is_result_store(doi_only)):
+            store = ResultStore(doi_only)
         # If the specified value is a file, add it to the output files array
-        if (p(doi_only).absolute().is_file()):
+        elif (p(doi_only).absolute().is_file()):
             output_files = [p(doi_only)]
-        # If it is a directory, add all the .csv files in the directory,
-        # recursively, if specified as such
+        # If it is a directory, add all the .csv and .parquet files in the
+        # directory, recursively, if specified as such
         elif (p(doi_only).absolute().is_dir()):
-            output_files = [x for x in p(doi_only).glob(
-                '**/*.csv' if recursive_doi_only else '*.csv')]
+            output_files = [x for extension in ('csv', 'parquet') for x in p(doi_only).glob(
+                f'**/*.{extension}' if recursive_doi_only else f'*.{extension}')]
         # If the doi-only argument is not an existing file nor directory, print
         # an error and exit
         else:
@@ -96,12 +360,58 @@ def main():
             exit(404)
 
     # If we do want to get DOIs for search results (i.e. if nodoi was not set)
-    # run the crossref queries with
+    # run the crossref queries, unless they already ran in the pipeline, in
+    # which case wait for the last ones to finish
     if (not no_doi):
-        crossref_query(email, verbose, output_files)
+        from google_scholar_scraper.crossref_query.crossref_query import crossref_query, \
+            crossref_query_store
+        with run_metrics.stage('doi'):
+            if (doi_pipeline is not None):
+                doi_pipeline.close()
+            # If there is a result store, look up the DOIs of every stored
+            # result still missing one, rather than the ones of the files
+            elif (store is not None):
+                crossref_query_store(email, verbose, store, crossref_concurrency,
+                                     doi_cache, offline_index)
+                # The DOIs are only saved into the store, so export the file
+                # of each query again from it, with their DOIs
+                if (not doi_only):
+                    for (entry, output_file) in zip(sorted(plan, key=lambda x: x['index']),
+                                                    output_files):
+                        store.export(output_file, [entry['query']])
+            else:
+                crossref_query(email, verbose, output_files,
+                               crossref_concurrency, doi_cache, offline_index)
 
+    # If there is a result store and we do want to merge, export the results
+    # of the queries of the run (or of every stored query for DOI-only runs)
+    # with their DOIs from the store, even for a single query
+    merged_file = None
+    if (store is not None and not no_merge):
+        with run_metrics.stage('merge'):
+            timestamp = time.strftime('%Y-%m-%dT%H%M%S', time.localtime(time.time()))
+            merged_file = p(output_dir / f'merged_{timestamp}.{output_format}')
+            size = store.export(merged_file, None if doi_only else [
+                x['query'] for x in sorted(plan, key=lambda x: x['index'])], output_format)
+        if (verbose):
+            print(f'\nExport complete: {size} results saved in {str(merged_file)}.')
     # If we are not just performing DOI queries or do want to merge
     # (i.e. if nomerge was not set), and we have more than one output file,
     # we should merge these into one file
-    if (not doi_only and len(output_files) > 1 or not no_merge and len(output_files) > 1):
-        merge_search(output_files, output_dir, verbose)
+    elif (not doi_only and len(output_files) > 1 or not no_merge and len(output_files) > 1):
+        from google_scholar_scraper.utils import merge_search
+        with run_metrics.stage('merge'):
+            merged_file = merge_search(
+                output_files, output_dir, verbose, output_format)
+    if (merged_file is not None):
+        # If requested, also remove the near duplicates of the merged file
+        if (fuzzy_dedup):
+            # Only import numpy, which the near duplicate search needs, when used
+            from google_scholar_scraper.dedup import dedup_search
+            with run_metrics.stage('dedup'):
+                dedup_search(merged_file, verbose)
+
+    # If verbose logging is enabled, show how long each stage took
+    if (verbose):
+        print('\nStage wall times: ' + ', '.join(
+            f'{x} {y:.2f} s' for (x, y) in run_metrics.stages.items()))
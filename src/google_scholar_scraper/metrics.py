@@ -0,0 +1,264 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path as p
+from google_scholar_scraper.config import global_vars
+
+# Descriptions of the counters, used in the Prometheus textfile
+_counter_help = {
+    'requests': 'HTTP requests performed',
+    'serpapi_credits': 'SerpApi searches consumed',
+    'cache_lookups': 'Lookups in the local caches',
+    'retries': 'Requests retried after a transient error',
+    'crossref_lookups': 'DOI lookups, by source and outcome',
+    'rows_scraped': 'Rows of search results saved',
+}
+
+
+def _labels_key(labels):
+    """Return the labels of a metric as a hashable, ordered tuple"""
+    return tuple(sorted((x, str(y)) for (x, y) in labels.items()))
+
+
+def _prometheus_labels(labels, extra=()):
+    """Format the labels of a metric for the Prometheus text format"""
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    escaped = [(x, y.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for (x, y) in labels]
+    return '{' + ','.join(f'{x}="{y}"' for (x, y) in escaped) + '}'
+
+
+class Metrics:
+    """Counters, latency histograms and stage timings of a run, shared by all
+    the concurrent workers. Counters are kept for the whole run and for the
+    query being scraped, if any, and can be exported as a JSON report or a
+    Prometheus textfile. If a profile directory is set, every stage is also
+    profiled with cProfile, including the worker threads it runs."""
+
+    def __init__(self, buckets=global_vars.metrics_latency_buckets,
+                 max_entries=global_vars.metrics_max_entries):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.started = time.time()
+        self._start_time = time.perf_counter()
+        # Counters and histograms, keyed on their name and labels
+        self.counters = {}
+        self.histograms = {}
+        # Accumulated wall time of each stage
+        self.stages = {}
+        # Counters and wall time of each query, and DOI counts of each file,
+        # only keeping the most recent ones (e.g. in the daemon, which runs
+        # for the life of the process)
+        self.max_entries = max_entries
+        self.queries = {}
+        self.files = {}
+        # Query being scraped in the current context (i.e. thread, or task
+        # submitted with a copy of the context), which counters are attributed to
+        self._current_query = contextvars.ContextVar('current_query', default=None)
+        # Directory to save the cProfile statistics of each stage into
+        self.profile_dir = None
+
+    def increment(self, name, value=1, **labels):
+        """Increment a counter, for the run and for the current query. The
+        counters of a query are named after the counter and its label values
+        (e.g. cache_lookups_serpapi_hit)"""
+        current_query = self._current_query.get()
+        with self._lock:
+            key = (name, _labels_key(labels))
+            self.counters[key] = self.counters.get(key, 0) + value
+            if current_query is not None:
+                query = self.queries.setdefault(current_query, {})
+                query_key = '_'.join([name] + [y for (_, y) in key[1]])
+                query[query_key] = query.get(query_key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record a value (e.g. a latency in seconds) in a histogram"""
+        with self._lock:
+            key = (name, _labels_key(labels))
+            if key not in self.histograms:
+                self.histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0,
+                                        'count': 0}
+            histogram = self.histograms[key]
+            for (idx, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][idx] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def record_request(self, service, seconds, success):
+        """Record an HTTP request to a service, its latency, and the SerpApi
+        credit it consumed, if any"""
+        self.increment('requests', service=service,
+                       status='success' if success else 'error')
+        self.observe('request_duration_seconds', seconds, service=service)
+        if success and service == 'serpapi':
+            self.increment('serpapi_credits')
+
+    def record_file(self, file_name, found, missing, existing):
+        """Record the DOIs of a file of search results: found by the lookups,
+        still missing, and not looked up because they were already known (in
+        the file, journal or cache) or matched offline"""
+        with self._lock:
+            self._remember(self.files, file_name)
+            self.files[file_name] = {'dois_found': found, 'dois_missing': missing,
+                                     'dois_existing': existing}
+
+    def _remember(self, entries, key):
+        """Move the entry of a query or file to the end of its dictionary,
+        forgetting the oldest entries beyond the number to keep. Return the
+        entry"""
+        entry = entries.pop(key, {})
+        while entries and len(entries) >= self.max_entries:
+            del entries[next(iter(entries))]
+        entries[key] = entry
+        return entry
+
+    @contextmanager
+    def query(self, search_query):
+        """Attribute the counters incremented in this context to a query, and
+        record its wall time"""
+        with self._lock:
+            self._remember(self.queries, search_query)
+        token = self._current_query.set(search_query)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                query = self.queries.setdefault(search_query, {})
+                query['wall_time'] = query.get('wall_time', 0.0) + \
+                    time.perf_counter() - start_time
+            self._current_query.reset(token)
+
+    @staticmethod
+    def _profile_threads(profilers, lock):
+        """Return a profile function for the threads started during a stage,
+        which replaces itself with a profiler of the thread on its first call,
+        added to the list of profilers of the stage"""
+        import cProfile
+
+        def start(frame, event, arg):
+            profiler = cProfile.Profile()
+            with lock:
+                profilers.append(profiler)
+            profiler.enable()
+        return start
+
+    @contextmanager
+    def stage(self, name):
+        """Record the wall time of a stage of the run (e.g. parse, scrape, doi,
+        merge), profiling it if a profile directory is set"""
+        profilers = []
+        start_time = time.perf_counter()
+        if self.profile_dir is not None:
+            # Only import the profiler when it is used
+            import cProfile
+            import pstats
+            profilers.append(cProfile.Profile())
+            profilers[0].enable()
+            # Before Python 3.12, cProfile only profiles the thread enabling
+            # it, so the threads started during the stage (e.g. the workers of
+            # the scrape and the DOI lookups) get profilers of their own, whose
+            # statistics are merged. Later versions profile every thread
+            if sys.version_info < (3, 12):
+                threading.setprofile(self._profile_threads(profilers, threading.Lock()))
+        try:
+            yield
+        finally:
+            if profilers:
+                if sys.version_info < (3, 12):
+                    threading.setprofile(None)
+                profilers[0].disable()
+                stats = pstats.Stats(profilers[0])
+                for profiler in profilers[1:]:
+                    stats.add(profiler)
+                self.profile_dir.mkdir(exist_ok=True, parents=True)
+                stats.dump_stats(str(self.profile_dir / f'{name}.prof'))
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + \
+                    time.perf_counter() - start_time
+
+    def report(self):
+        """Return all the metrics of the run as a dictionary"""
+        with self._lock:
+            return {
+                'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                'wall_time': round(time.perf_counter() - self._start_time, 6),
+                'stages': {x: round(y, 6) for (x, y) in self.stages.items()},
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for ((name, labels), value) in sorted(self.counters.items())],
+                'histograms': [{'name': name, 'labels': dict(labels),
+                                'buckets': dict(zip([str(x) for x in self.buckets], histogram['buckets'])),
+                                'sum': round(histogram['sum'], 6), 'count': histogram['count']}
+                               for ((name, labels), histogram) in sorted(self.histograms.items())],
+                'queries': {x: dict(y) for (x, y) in self.queries.items()},
+                'files': {x: dict(y) for (x, y) in self.files.items()},
+            }
+
+    def write_json(self, file_path):
+        """Save the JSON report of the run"""
+        _write_atomically(p(file_path), json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, file_path):
+        """Save the run-level metrics in the Prometheus text format, to be
+        collected e.g. by the textfile collector of the node exporter"""
+        prefix = global_vars.metrics_prefix
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            stages = sorted(self.stages.items())
+        for name in sorted({x for ((x, _), _) in counters}):
+            lines.append(f'# HELP {prefix}_{name}_total {_counter_help.get(name, name)}')
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            for ((counter, labels), value) in counters:
+                if counter == name:
+                    lines.append(f'{prefix}_{name}_total{_prometheus_labels(labels)} {value}')
+        for name in sorted({x for ((x, _), _) in histograms}):
+            lines.append(f'# TYPE {prefix}_{name} histogram')
+            for ((histogram_name, labels), histogram) in histograms:
+                if histogram_name != name:
+                    continue
+                # Prometheus buckets are cumulative
+                cumulative = 0
+                for (bound, count) in zip(self.buckets, histogram['buckets']):
+                    cumulative += count
+                    lines.append(
+                        f'{prefix}_{name}_bucket{_prometheus_labels(labels, [("le", str(bound))])} {cumulative}')
+                lines.append(
+                    f'{prefix}_{name}_bucket{_prometheus_labels(labels, [("le", "+Inf")])} {histogram["count"]}')
+                lines.append(f'{prefix}_{name}_sum{_prometheus_labels(labels)} {histogram["sum"]}')
+                lines.append(f'{prefix}_{name}_count{_prometheus_labels(labels)} {histogram["count"]}')
+        lines.append(f'# TYPE {prefix}_stage_duration_seconds gauge')
+        for (stage, seconds) in stages:
+            lines.append(
+                f'{prefix}_stage_duration_seconds{_prometheus_labels([("stage", stage)])} {seconds}')
+        lines.append(f'# TYPE {prefix}_last_run_timestamp_seconds gauge')
+        lines.append(f'{prefix}_last_run_timestamp_seconds {self.started}')
+        _write_atomically(p(file_path), '\n'.join(lines) + '\n')
+
+
+def _write_atomically(file_path, text):
+    """Write a file through a temporary file, so readers never see it half written"""
+    file_path.parent.mkdir(exist_ok=True, parents=True)
+    temp_path = file_path.with_name(f'{file_path.name}.tmp')
+    with open(str(temp_path), 'w', encoding='utf-8') as temp_file:
+        temp_file.write(text)
+    os.replace(str(temp_path), str(file_path))
+
+
+# Metrics of the current run, shared by every module
+_metrics = Metrics()
+
+
+def get_metrics():
+    """Return the metrics of the current run"""
+    return _metrics
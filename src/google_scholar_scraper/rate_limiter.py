@@ -0,0 +1,56 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """Thread-safe limiter allowing at most a set number of requests per
+    interval of time (in seconds), shared between all concurrent workers"""
+
+    def __init__(self, limit, interval=1.0):
+        # Lock protecting the internal state of the limiter
+        self._lock = threading.Lock()
+        # The time at which the next request will be allowed
+        self._next_slot = time.monotonic()
+        self.update(limit, interval)
+
+    def update(self, limit, interval=1.0):
+        """Change the number of requests allowed per interval"""
+        with self._lock:
+            self.limit = max(float(limit), 0.001)
+            self.interval = max(float(interval), 0.0)
+
+    def delay(self):
+        """Return how many seconds a new request would have to wait"""
+        with self._lock:
+            return max(self._next_slot - time.monotonic(), 0.0)
+
+    def acquire(self):
+        """Block until a new request is allowed to be performed"""
+        with self._lock:
+            now = time.monotonic()
+            # Reserve the next free slot, which is never in the past
+            slot = max(self._next_slot, now)
+            # Space out the requests evenly within the interval
+            self._next_slot = slot + self.interval / self.limit
+        # Sleep outside of the lock so other workers can reserve their slots
+        wait = slot - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Registry of rate limiters, so that every worker using the same key (e.g. the
+# same SerpApi API key) shares the same limiter
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key, limit, interval=1.0):
+    """Return the rate limiter shared by every request made with the given key,
+    creating it if it does not exist yet, or updating it to the given rate if
+    it does (e.g. for a later run of the daemon with another rate limit)"""
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(limit, interval)
+        else:
+            _limiters[key].update(limit, interval)
+        return _limiters[key]
@@ -0,0 +1,186 @@
+import csv
+import os
+from pathlib import Path as p
+from google_scholar_scraper.config import global_vars
+
+# Files of search results are either CSV or Parquet files. Parquet files need
+# the optional pyarrow package, which is only imported when used
+
+# Columns stored as integers in Parquet files. Every other column is a string
+_integer_keys = (global_vars.pub_year_key,
+                 global_vars.gs_rank_key, global_vars.num_citations_key,
+                 global_vars.num_versions_key)
+
+
+def has_pyarrow():
+    """Return whether the pyarrow package needed for Parquet files is installed"""
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+def file_format(file_path):
+    """Return the format of a file of search results, based on its extension"""
+    return 'parquet' if p(file_path).suffix.lower() == '.parquet' else 'csv'
+
+
+def result_schema(fieldnames):
+    """Return the Arrow schema of a Parquet file of search results with the
+    given columns, with the year, rank and number of citations as integers"""
+    import pyarrow as pa
+    return pa.schema([pa.field(x, pa.int32() if x in _integer_keys else pa.string())
+                      for x in fieldnames])
+
+
+def _to_integer(value):
+    """Convert a value of an integer column to an integer, or None if it is
+    empty or not a valid integer"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_fieldnames(file_path):
+    """Return the column names of a file of search results"""
+    if file_format(file_path) == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(str(file_path)).names
+    with open(str(file_path), 'r', newline='', encoding='utf-8') as csvfile:
+        return next(csv.reader(csvfile), [])
+
+
+def _string_columns(batch):
+    """Convert the columns of an Arrow record batch or table to strings, with
+    empty strings for missing values"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    return [pc.fill_null(x.cast(pa.string()), '') for x in batch.columns]
+
+
+def read_rows(file_path):
+    """Stream the rows of a file of search results as dictionaries of strings,
+    whatever its format, with empty strings for missing values"""
+    if file_format(file_path) == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(str(file_path))
+        for batch in parquet_file.iter_batches(batch_size=global_vars.parquet_row_group_size):
+            # Convert the values in Arrow, rather than one by one
+            yield from pa.RecordBatch.from_arrays(_string_columns(batch),
+                                                  names=batch.schema.names).to_pylist()
+        return
+    with open(str(file_path), 'r', newline='', encoding='utf-8') as csvfile:
+        yield from csv.DictReader(csvfile)
+
+
+def read_columns(file_path):
+    """Read a file of search results into a dictionary of columns of strings,
+    whatever its format, with empty strings for missing values"""
+    if file_format(file_path) == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(str(file_path))
+        return {x: y.to_pylist() for (x, y) in zip(table.column_names, _string_columns(table))}
+    with open(str(file_path), 'r', newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        fieldnames = next(reader, [])
+        columns = {x: [] for x in fieldnames}
+        for row in reader:
+            # Skip the empty lines, and pad or cut the rows with the wrong
+            # number of values
+            if not row:
+                continue
+            row = (row + [''] * len(fieldnames))[:len(fieldnames)]
+            for (values, value) in zip(columns.values(), row):
+                values.append(value)
+    return columns
+
+
+def write_columns(columns, file_path, output_format=None):
+    """Write a dictionary of columns of strings to a file of search results, in
+    the given format or else the format of its extension. Parquet files have
+    the fixed schema of their columns"""
+    if (output_format or file_format(file_path)) != 'parquet':
+        with open(str(file_path), 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.writer(csvfile, lineterminator=os.linesep)
+            writer.writerow(list(columns))
+            writer.writerows(zip(*columns.values()))
+        return
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = result_schema(list(columns))
+    table = pa.table({x: [_to_integer(y) for y in values] if x in _integer_keys else
+                      [y if y != '' else None for y in values]
+                      for (x, values) in columns.items()}, schema=schema)
+    pq.write_table(table, str(file_path),
+                   compression=global_vars.parquet_compression)
+
+
+class RowWriter:
+    """Writer of the rows of a file of search results, given as dictionaries of
+    strings, in either format. Missing columns are left empty and extra ones
+    are ignored. Parquet rows are buffered and written in row groups."""
+
+    def __init__(self, file_path, fieldnames, output_format=None):
+        self.file_path = p(file_path)
+        self.fieldnames = list(fieldnames)
+        self.output_format = output_format or file_format(file_path)
+        self._rows = []
+        if self.output_format == 'parquet':
+            import pyarrow.parquet as pq
+            self._schema = result_schema(self.fieldnames)
+            self._writer = pq.ParquetWriter(str(self.file_path), self._schema,
+                                            compression=global_vars.parquet_compression)
+        else:
+            self._file = open(str(self.file_path), 'w', newline='', encoding='utf-8')
+            self._writer = csv.DictWriter(self._file, fieldnames=self.fieldnames,
+                                          restval='', extrasaction='ignore',
+                                          lineterminator=os.linesep)
+            self._writer.writeheader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _flush(self):
+        """Write the buffered rows to the Parquet file as a row group"""
+        import pyarrow as pa
+        if not self._rows:
+            return
+        columns = [[_to_integer(row.get(x)) for row in self._rows] if x in _integer_keys else
+                   [row.get(x) or None for row in self._rows] for x in self.fieldnames]
+        self._writer.write_batch(pa.record_batch(columns, schema=self._schema))
+        self._rows = []
+
+    def writerow(self, row):
+        """Write a single row"""
+        if self.output_format == 'parquet':
+            self._rows.append(row)
+            if len(self._rows) >= global_vars.parquet_row_group_size:
+                self._flush()
+        else:
+            self._writer.writerow(row)
+
+    def writerows(self, rows):
+        """Write several rows"""
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        """Write any buffered rows and close the file"""
+        if self.output_format == 'parquet':
+            self._flush()
+            self._writer.close()
+        else:
+            self._file.close()
+
+
+def convert(file_path, output_path):
+    """Convert a file of search results to the format of the output path,
+    keeping its columns"""
+    with RowWriter(output_path, read_fieldnames(file_path)) as writer:
+        writer.writerows(read_rows(file_path))
@@ -0,0 +1,237 @@
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path as p
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.result_files import RowWriter
+
+# Cluster ID in a Google Scholar publication page link
+_cluster_regex = re.compile(r'cluster=(\d+)')
+# Characters ignored when comparing titles
+_non_alphanumeric_regex = re.compile(r'[\W_]+')
+
+# Columns of the files exported from the store
+export_fieldnames = [global_vars.author_key, global_vars.pub_year_key, global_vars.title_key,
+                     global_vars.scholar_link_key, global_vars.pub_url_key,
+                     global_vars.gs_rank_key, global_vars.num_citations_key, global_vars.doi_key]
+
+
+def is_result_store(file_path):
+    """Return whether a file is an SQLite database (e.g. a result store)"""
+    try:
+        with open(str(file_path), 'rb') as db_file:
+            return db_file.read(16) == b'SQLite format 3\x00'
+    except OSError:
+        return False
+
+
+def normalise_title(title):
+    """Normalise a title to detect duplicates: only its letters and digits are
+    kept, separated by single spaces, and it is made lowercase"""
+    return _non_alphanumeric_regex.sub(' ', title.casefold()).strip()
+
+
+class ResultStore:
+    """Store of the search results of every run in an SQLite database, as an
+    alternative to finding them in the files of each run. Each publication is
+    stored once, identified by its cluster ID (or by its normalised title if it
+    has none), with its rank in each query which found it, and its DOI once it
+    was looked up. The pages of search results are stored in batches, with a
+    transaction per batch. The results still missing a DOI are found through
+    an index, and merged files are exported with a single query."""
+
+    def __init__(self, db_path):
+        p(db_path).parent.mkdir(exist_ok=True, parents=True)
+        # A single connection shared by all the concurrent queries, protected
+        # by a lock. Other processes are handled by SQLite's own locking
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), timeout=30, check_same_thread=False)
+        with self._lock:
+            # Write-ahead logging, so readers (e.g. an export) do not block the
+            # scrape, and every page is committed without a full sync
+            self._conn.execute('PRAGMA journal_mode = WAL')
+            self._conn.execute('PRAGMA synchronous = NORMAL')
+            with self._conn:
+                self._conn.execute("""CREATE TABLE IF NOT EXISTS queries (
+                    id INTEGER PRIMARY KEY,
+                    query TEXT NOT NULL UNIQUE,
+                    last_run REAL NOT NULL)""")
+                self._conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                    id INTEGER PRIMARY KEY,
+                    cluster_id TEXT,
+                    norm_title TEXT NOT NULL,
+                    author TEXT NOT NULL,
+                    pub_year TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    scholar_link TEXT NOT NULL,
+                    pub_url TEXT NOT NULL,
+                    num_citations INTEGER,
+                    doi_pending INTEGER NOT NULL DEFAULT 1)""")
+                # A publication is unique on its cluster ID, or on its
+                # normalised title if it has no cluster ID
+                self._conn.execute("""CREATE UNIQUE INDEX IF NOT EXISTS results_cluster_id
+                    ON results (cluster_id) WHERE cluster_id IS NOT NULL""")
+                self._conn.execute("""CREATE UNIQUE INDEX IF NOT EXISTS results_norm_title
+                    ON results (norm_title) WHERE cluster_id IS NULL""")
+                # Index of the results whose DOI was not looked up yet
+                self._conn.execute("""CREATE INDEX IF NOT EXISTS results_missing_doi
+                    ON results (id) WHERE doi_pending = 1""")
+                self._conn.execute("""CREATE TABLE IF NOT EXISTS ranks (
+                    query_id INTEGER NOT NULL REFERENCES queries (id),
+                    result_id INTEGER NOT NULL REFERENCES results (id),
+                    rank INTEGER NOT NULL,
+                    PRIMARY KEY (query_id, result_id)) WITHOUT ROWID""")
+                self._conn.execute("""CREATE TABLE IF NOT EXISTS dois (
+                    result_id INTEGER PRIMARY KEY REFERENCES results (id),
+                    doi TEXT NOT NULL,
+                    looked_up REAL NOT NULL)""")
+        # Pages of search results added but not stored yet, as (query, rows)
+        # tuples, and their number of rows
+        self._pending = []
+        self._pending_rows = 0
+
+    def add_rows(self, search_query, rows):
+        """Add the rows of a page of search results of a query. The pages are
+        buffered, and stored in a single transaction once they add up to a
+        batch of rows (or when flushed). Return whether the rows were stored"""
+        with self._lock:
+            self._pending.append((search_query, rows))
+            self._pending_rows += len(rows)
+            if self._pending_rows < global_vars.result_store_write_batch:
+                return False
+            self._write()
+        return True
+
+    def begin_query(self, search_query):
+        """Forget the ranks of a query from its previous runs, as it is scraped
+        again from its first page"""
+        with self._lock:
+            self._write()
+            with self._conn:
+                self._conn.execute("""DELETE FROM ranks
+                    WHERE query_id = (SELECT id FROM queries WHERE query = ?)""",
+                                   (search_query,))
+
+    def flush(self):
+        """Store the pages of search results still buffered"""
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        """Store the buffered pages of search results in a single transaction.
+        Publications already stored get their number of citations updated, and
+        their rank in the query. The lock must be held"""
+        if not self._pending:
+            return
+        now = time.time()
+        query_ids = {}
+        ranks = []
+        with self._conn:
+            for (search_query, rows) in self._pending:
+                if search_query not in query_ids:
+                    query_ids[search_query] = self._conn.execute(
+                        """INSERT INTO queries (query, last_run) VALUES (?, ?)
+                        ON CONFLICT (query) DO UPDATE SET last_run = excluded.last_run
+                        RETURNING id""", (search_query, now)).fetchone()[0]
+                self._add_rows(query_ids[search_query], rows, ranks)
+            self._conn.executemany('INSERT OR REPLACE INTO ranks VALUES (?, ?, ?)', ranks)
+        self._pending = []
+        self._pending_rows = 0
+
+    def _add_rows(self, query_id, rows, ranks):
+        """Insert the rows of a page of search results of a query, appending
+        their ranks to the given list"""
+        for row in rows:
+            cluster_id = _cluster_regex.search(row[global_vars.scholar_link_key])
+            # Publications are matched on the unique index which applies
+            conflict = '(cluster_id) WHERE cluster_id IS NOT NULL' if cluster_id \
+                else '(norm_title) WHERE cluster_id IS NULL'
+            result_id = self._conn.execute(f"""INSERT INTO results (cluster_id, norm_title,
+                    author, pub_year, title, scholar_link, pub_url, num_citations)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT {conflict} DO UPDATE SET num_citations = excluded.num_citations
+                RETURNING id""", (
+                cluster_id.group(1) if cluster_id else None,
+                normalise_title(row[global_vars.title_key]), row[global_vars.author_key],
+                str(row[global_vars.pub_year_key]), row[global_vars.title_key],
+                row[global_vars.scholar_link_key], row[global_vars.pub_url_key],
+                row[global_vars.num_citations_key])).fetchone()[0]
+            ranks.append((query_id, result_id, row[global_vars.gs_rank_key]))
+
+    def missing_dois(self, after_id=0, limit=global_vars.result_store_batch_size):
+        """Return the (ID, authors, year, title) tuples of the next results
+        after the given ID whose DOI was not looked up yet"""
+        with self._lock:
+            self._write()
+            return self._conn.execute("""SELECT id, author, pub_year, title FROM results
+                WHERE doi_pending = 1 AND id > ? ORDER BY id LIMIT ?""",
+                                      (after_id, limit)).fetchall()
+
+    def count_missing_dois(self):
+        """Return the number of results whose DOI was not looked up yet"""
+        with self._lock:
+            self._write()
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM results WHERE doi_pending = 1').fetchone()[0]
+
+    def save_dois(self, entries):
+        """Store a list of (ID, DOI) tuples of looked up results in a single
+        transaction. An empty DOI means none was found"""
+        now = time.time()
+        with self._lock:
+            self._write()
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO dois VALUES (?, ?, ?)',
+                                       [(x, y, now) for (x, y) in entries])
+                self._conn.executemany('UPDATE results SET doi_pending = 0 WHERE id = ?',
+                                       [(x,) for (x, _) in entries])
+
+    def export(self, output_path, queries=None, output_format=None):
+        """Export the results of the given queries (by default, of every query)
+        to a file of search results, as merging their files would: each
+        publication once, in the order of the queries and then of their rank,
+        with its rank in the first query which found it. Return the number of
+        rows exported"""
+        # Store the pages still buffered first
+        self.flush()
+        # The queries to export and their order
+        if queries is None:
+            with self._lock:
+                queries = [x[0] for x in self._conn.execute('SELECT query FROM queries ORDER BY id')]
+        if not queries:
+            return 0
+        with self._lock:
+            # Put the queries in a temporary table of the connection, as there
+            # can be more of them than the parameters of a statement
+            with self._conn:
+                self._conn.execute("""CREATE TEMP TABLE IF NOT EXISTS selected (
+                    position INTEGER PRIMARY KEY,
+                    query TEXT NOT NULL)""")
+                self._conn.execute('DELETE FROM selected')
+                self._conn.executemany('INSERT INTO selected VALUES (?, ?)', enumerate(queries))
+            size = 0
+            with RowWriter(output_path, export_fieldnames, output_format) as writer:
+                for row in self._conn.execute("""WITH ranked AS (
+                        SELECT k.result_id, k.rank, s.position, ROW_NUMBER() OVER (
+                            PARTITION BY k.result_id ORDER BY s.position, k.rank) AS occurrence
+                        FROM selected s
+                        JOIN queries q ON q.query = s.query
+                        JOIN ranks k ON k.query_id = q.id)
+                    SELECT r.author, r.pub_year, r.title, r.scholar_link, r.pub_url, x.rank,
+                        r.num_citations, COALESCE(d.doi, '')
+                    FROM ranked x
+                    JOIN results r ON r.id = x.result_id
+                    LEFT JOIN dois d ON d.result_id = r.id
+                    WHERE x.occurrence = 1
+                    ORDER BY x.position, x.rank"""):
+                    writer.writerow(dict(zip(export_fieldnames, row)))
+                    size += 1
+        return size
+
+    def close(self):
+        """Store the pages of search results still buffered, and close the
+        database connection"""
+        with self._lock:
+            self._write()
+            self._conn.close()
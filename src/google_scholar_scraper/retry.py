@@ -0,0 +1,181 @@
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.client import IncompleteRead
+from urllib.error import URLError
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.metrics import get_metrics
+
+# HTTP status codes of errors which are worth retrying
+_transient_status_codes = {408, 425, 429, 500, 502, 503, 504}
+
+
+class PermanentError(Exception):
+    """Error which will not be solved by retrying the request"""
+
+
+def _status_code(error):
+    """Obtain the HTTP status code of an error raised by urllib or httpx, if
+    any"""
+    for attribute in ('code', 'status_code'):
+        if isinstance(getattr(error, attribute, None), int):
+            return getattr(error, attribute)
+    return getattr(getattr(error, 'response', None), 'status_code', None)
+
+
+def _retry_after(error):
+    """Obtain the number of seconds to wait from the Retry-After header of the
+    response of an error, if any"""
+    headers = getattr(error, 'headers', None) or \
+        getattr(getattr(error, 'response', None), 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    # The header can either be a number of seconds or an HTTP date
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient(error):
+    """Classify an error as transient (worth retrying) or permanent"""
+    if isinstance(error, PermanentError):
+        return False
+    status_code = _status_code(error)
+    if status_code is not None:
+        return status_code in _transient_status_codes
+    # Network errors (e.g. DNS failures, timeouts, dropped connections), and
+    # truncated responses. Other errors (e.g. a missing file or a bug) are not
+    # solved by retrying
+    if isinstance(error, (URLError, socket.timeout, ConnectionError, IncompleteRead,
+                          json.JSONDecodeError)):
+        return True
+    # httpx errors can only happen if it was imported for the shared client
+    httpx = sys.modules.get('httpx')
+    return httpx is not None and isinstance(error, (httpx.TransportError, httpx.DecodingError))
+
+
+class Retrier:
+    """Retry engine with exponential backoff with jitter, which honours
+    Retry-After headers, fails fast on permanent errors, and has a circuit
+    breaker shared by all the concurrent workers using it, which pauses every
+    request after too many consecutive failures"""
+
+    def __init__(self, name, max_attempts=global_vars.max_attempts,
+                 base_delay=global_vars.retry_base_delay, max_delay=global_vars.retry_max_delay,
+                 breaker_threshold=global_vars.breaker_threshold,
+                 breaker_cooldown=global_vars.breaker_cooldown):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._lock = threading.Lock()
+        # Number of consecutive failures, and the time until which the circuit
+        # breaker stops every request
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        # Counters of the retries, the time spent sleeping, and the errors
+        # which were not retried
+        self.retries = 0
+        self.sleep_time = 0.0
+        self.permanent_errors = 0
+
+    def _sleep(self, seconds):
+        """Sleep, keeping track of the time spent sleeping"""
+        if seconds <= 0:
+            return
+        with self._lock:
+            self.sleep_time += seconds
+        time.sleep(seconds)
+
+    def _wait_for_breaker(self):
+        """Wait until the circuit breaker lets requests through"""
+        with self._lock:
+            wait = self._open_until - time.monotonic()
+        self._sleep(wait)
+
+    def _record(self, success):
+        """Record the outcome of a request, opening the circuit breaker after
+        too many consecutive failures"""
+        with self._lock:
+            if success:
+                self._consecutive_failures = 0
+                return
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= self.breaker_threshold and \
+                    self._open_until <= time.monotonic():
+                self._open_until = time.monotonic() + self.breaker_cooldown
+                print(
+                    f'\nWarning: Too many consecutive {self.name} errors. Pausing {self.name} requests for {self.breaker_cooldown} seconds.')
+
+    def _delay(self, attempt, error):
+        """Compute how long to wait before the next attempt"""
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # Exponential backoff with equal jitter
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, function, *args, **kwargs):
+        """Call a function performing a request, retrying it on transient
+        errors. Raise the last error if it is permanent or if we ran out of
+        retry attempts"""
+        for attempt in range(self.max_attempts):
+            self._wait_for_breaker()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                transient = is_transient(e)
+                # Only transient errors count towards the circuit breaker
+                self._record(not transient)
+                if not transient:
+                    with self._lock:
+                        self.permanent_errors += 1
+                    raise
+                if attempt + 1 >= self.max_attempts:
+                    raise
+                delay = self._delay(attempt, e)
+                print(f'\n{e}')
+                print(
+                    f'There was a problem with a {self.name} request. Retrying in {delay:.1f} seconds. Attempt {attempt + 1} of {self.max_attempts}')
+                with self._lock:
+                    self.retries += 1
+                get_metrics().increment('retries', service=self.name.lower())
+                self._sleep(delay)
+                continue
+            self._record(True)
+            return result
+
+    def stats(self):
+        """Return the counters of the retry engine"""
+        with self._lock:
+            return {'retries': self.retries, 'sleep_time': round(self.sleep_time, 3),
+                    'permanent_errors': self.permanent_errors}
+
+
+# Registry of retry engines, so every worker of the same service shares the
+# same circuit breaker and counters
+_retriers = {}
+_retriers_lock = threading.Lock()
+
+
+def get_retrier(name):
+    """Return the retry engine shared by every request to the given service,
+    creating it if it does not exist yet"""
+    with _retriers_lock:
+        if name not in _retriers:
+            _retriers[name] = Retrier(name)
+        return _retriers[name]
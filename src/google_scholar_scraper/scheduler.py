@@ -0,0 +1,140 @@
+import contextvars
+import math
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path as p
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.metrics import get_metrics
+from google_scholar_scraper.serp_query.manifest import ScrapeManifest
+from google_scholar_scraper.serp_query.serp_query import manifest_key, page_params
+
+# Google Scholar search operators, which are case sensitive
+_operators = {'OR', 'AND'}
+
+
+def normalise_query(query):
+    """Normalise a query to detect duplicates: whitespace is collapsed and the
+    query is made lowercase, except for its search operators"""
+    return ' '.join(x if x in _operators else x.casefold() for x in query.split())
+
+
+def _pages(search_query, max_results, output_dir, year_range=None):
+    """Return the (start, num) parameters of the pages of search results of a
+    query (or of one of its year ranges) which still need to be scraped,
+    skipping the pages already saved by a previous scrape of the query in the
+    output directory"""
+    manifest = ScrapeManifest(output_dir, manifest_key(search_query, year_range))
+    start = 0
+    # Only a previous scrape whose output file still exists is resumed
+    if manifest.output_file_name and (p(output_dir) / manifest.output_file_name).is_file():
+        if manifest.ended:
+            return []
+        start = manifest.next_start()
+    return [(i * global_vars.default_serp_max_results,
+             min(max_results - i * global_vars.default_serp_max_results,
+                 global_vars.default_serp_max_results))
+            for i in range(start // global_vars.default_serp_max_results,
+                           math.ceil(max_results / global_vars.default_serp_max_results))]
+
+
+def _cached_pages(search_query, pages, cache, year_range=(None, None)):
+    """Count the pages in the local cache of SerpApi responses, which cost
+    no searches"""
+    return sum(1 for (start, num) in pages if cache is not None and
+               cache.contains(page_params(search_query, start, num, year_range)))
+
+
+def plan_queries(parsed_queries, output_dir, cache=None):
+    """Plan the scrape of the parsed queries (tuples of each query, its
+    maximum number of results and its priority). Duplicate queries (once
+    normalised) are only scraped once, with the largest maximum number of
+    results and priority of their duplicates. Return a list with a
+    dictionary per query, in the order they should run (highest priority
+    first, then in the order of the query file), with its number of pages to
+    scrape, how many of them are in the local cache, and how many SerpApi
+    searches (credits) it will cost."""
+    plan = {}
+    for (query, max_results, priority) in parsed_queries:
+        key = normalise_query(query)
+        # Keep the first spelling of a duplicate query
+        if key in plan:
+            entry = plan[key]
+            entry['max_results'] = max(entry['max_results'], max_results)
+            entry['priority'] = max(entry['priority'], priority)
+            entry['duplicates'] += 1
+            continue
+        plan[key] = {'query': query, 'max_results': max_results, 'priority': priority,
+                     'index': len(plan), 'duplicates': 0}
+
+    for entry in plan.values():
+        pages = _pages(entry['query'], entry['max_results'], output_dir)
+        # Pages in the local cache of SerpApi responses cost no searches
+        cached = _cached_pages(entry['query'], pages, cache)
+        entry['pages'] = len(pages)
+        entry['cached_pages'] = cached
+        entry['credits'] = len(pages) - cached
+
+    return sorted(plan.values(), key=lambda x: (-x['priority'], x['index']))
+
+
+def plan_partitions_cost(entry, partitions, partition_dir, cache=None):
+    """Count the pages and SerpApi searches of a planned query split into
+    ranges of publication years, given as (year range, number of search
+    results, response of its first page) tuples, from the pages of each range
+    still to be scraped in the partitions directory and the pages of each
+    range in the local cache. The first page of a range was already obtained
+    to count its search results, so it costs no search"""
+    entry['partitions'] = partitions
+    entry['pages'] = 0
+    entry['cached_pages'] = 0
+    for (year_range, max_results, first_page) in partitions:
+        pages = _pages(entry['query'], max_results, partition_dir, year_range)
+        entry['pages'] += len(pages)
+        if first_page is not None and pages and pages[0][0] == 0:
+            entry['cached_pages'] += 1
+            pages = pages[1:]
+        entry['cached_pages'] += _cached_pages(entry['query'], pages, cache, year_range)
+    entry['credits'] = entry['pages'] - entry['cached_pages']
+
+
+def print_plan(plan, budget=None):
+    """Print the plan of the scrape, with the cost of each query and the total
+    cost, compared with the remaining monthly budget, if any"""
+    print('\nScrape plan (priority, max results, pages, cached pages, searches, query):')
+    for entry in plan:
+        duplicates = f' ({entry["duplicates"]} duplicates merged)' if entry['duplicates'] else ''
+        print(f'{entry["priority"]:>4} {entry["max_results"]:>6} {entry["pages"]:>5} '
+              f'{entry["cached_pages"]:>5} {entry["credits"]:>5}  {entry["query"]}{duplicates}')
+    print(f'\nTotal: {len(plan)} queries, {sum(x["pages"] for x in plan)} pages, '
+          f'{sum(x["credits"] for x in plan)} SerpApi searches')
+    if budget is not None:
+        print(
+            f'Monthly budget: {budget.used()} of {budget.monthly_budget} searches used, {budget.remaining()} remaining')
+
+
+def run_plan(plan, scrape, query_concurrency=global_vars.default_query_concurrency):
+    """Run the scrape of the planned queries, with at most query_concurrency
+    queries at a time, starting them in the order of the plan. The scrape
+    function is called with each query and its maximum number of results, and
+    must return its output file. Return the output files in the order the
+    queries first appear in the query file"""
+    metrics = get_metrics()
+
+    def _run(entry):
+        """Scrape a query, attributing its metrics to it"""
+        with metrics.query(entry['query']):
+            return scrape(entry['query'], entry['max_results'])
+
+    with ThreadPoolExecutor(max_workers=max(query_concurrency, 1)) as executor:
+        # Each query runs with a copy of the context, so its metrics are kept apart
+        futures = [(entry['index'], executor.submit(contextvars.copy_context().run, _run, entry))
+                   for entry in plan]
+        output_files = {}
+        try:
+            for (index, future) in futures:
+                output_files[index] = future.result()
+        # If a query fails (e.g. the budget was exhausted), do not start any
+        # other query, and let the running ones finish saving their progress
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+    return [output_files[x] for x in sorted(output_files)]
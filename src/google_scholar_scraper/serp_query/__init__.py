@@ -1,3 +1,4 @@
 from .serp_query import scrape_google_scholar
+from .serp_cache import SerpCache
 
-__all__ = ['scrape_google_scholar']
+__all__ = ['scrape_google_scholar', 'SerpCache']
@@ -0,0 +1,68 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path as p
+from google_scholar_scraper.retry import PermanentError
+
+
+class BudgetExhausted(PermanentError):
+    """Error raised when a SerpApi search would exceed the monthly budget"""
+
+
+class CreditBudget:
+    """Monthly budget of SerpApi searches (credits), with the searches used in
+    each calendar month stored in an SQLite database, so it holds across runs
+    and concurrent processes. A credit is reserved before every search and
+    released if the search fails, so the budget is never exceeded mid-run."""
+
+    def __init__(self, cache_dir, monthly_budget):
+        self.monthly_budget = monthly_budget
+        p(cache_dir).mkdir(exist_ok=True, parents=True)
+        # A single connection shared by all the concurrent requests, protected
+        # by a lock. Other processes are handled by SQLite's own locking
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(p(cache_dir) / 'serp_credits.sqlite3'),
+                                     timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS usage (
+                month TEXT PRIMARY KEY,
+                used INTEGER NOT NULL)""")
+
+    @staticmethod
+    def _month():
+        """Return the current calendar month, e.g. 2025-01"""
+        return time.strftime('%Y-%m')
+
+    def used(self):
+        """Return the number of searches used this month"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT used FROM usage WHERE month = ?', (self._month(),)).fetchone()
+        return row[0] if row else 0
+
+    def remaining(self):
+        """Return the number of searches left this month"""
+        return max(self.monthly_budget - self.used(), 0)
+
+    def reserve(self):
+        """Reserve a search, returning False if the budget is exhausted"""
+        month = self._month()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO usage (month, used) VALUES (?, 0)', (month,))
+            # Only increment the usage if it stays within the budget
+            cursor = self._conn.execute(
+                'UPDATE usage SET used = used + 1 WHERE month = ? AND used < ?',
+                (month, self.monthly_budget))
+        return cursor.rowcount == 1
+
+    def release(self):
+        """Release a reserved search which was not charged (e.g. it failed)"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE usage SET used = MAX(used - 1, 0) WHERE month = ?', (self._month(),))
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._conn.close()
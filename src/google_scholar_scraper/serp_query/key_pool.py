@@ -0,0 +1,300 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path as p
+from urllib import parse
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.rate_limiter import get_rate_limiter
+from google_scholar_scraper.retry import PermanentError, _status_code
+from google_scholar_scraper import http_transport
+
+
+class KeysExhausted(PermanentError):
+    """Error raised when no SerpApi API key of the pool has searches left"""
+
+
+class KeysRejected(PermanentError):
+    """Error raised when every SerpApi API key of the pool was rejected (e.g.
+    because it is invalid or its account is disabled)"""
+
+
+def load_keys(value):
+    """Return the list of SerpApi API keys given on the command line: a single
+    key, the path of a file with one key per line, or env:NAME for an
+    environment variable with comma or whitespace separated keys. Empty lines
+    and lines starting with # are ignored, as are repeated keys"""
+    if value.startswith('env:'):
+        keys = os.environ.get(value[4:], '').replace(',', ' ').split()
+    elif p(value).is_file():
+        with open(value, encoding='utf-8') as key_file:
+            keys = [x.strip() for x in key_file
+                    if x.strip() and not x.strip().startswith('#')]
+    else:
+        keys = [value]
+    return list(dict.fromkeys(keys))
+
+
+def _error_message(error):
+    """Obtain the error message of a failed SerpApi response, if any"""
+    try:
+        return str(error.response.json().get('error', ''))
+    except Exception:
+        return ''
+
+
+class _ApiKey:
+    """State of an API key of the pool"""
+
+    def __init__(self, key, rate_limit):
+        self.key = key
+        # Identifies the key in the local cache, without storing the key itself
+        self.key_id = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+        # Every request with this key shares the same rate limiter
+        self.rate_limiter = get_rate_limiter(key, rate_limit)
+        # Searches left in the month and in the hour, as last read from the
+        # account endpoint minus the searches made since (None if unknown)
+        self.searches_left = None
+        self.hour_left = None
+        # When the account was last read, why the key was dropped, if it was,
+        # and whether it was dropped because SerpApi rejected it rather than
+        # because it ran out of searches
+        self.checked = 0.0
+        self.dropped = None
+        self.rejected = False
+        # Whether its account is being read
+        self.reading = False
+
+
+class KeyPool:
+    """Pool of SerpApi API keys (e.g. of several accounts) sharing the searches
+    of a run. Each search uses the key whose rate limiter has the earliest free
+    slot, and then the one with the most searches left (in turn, if they are
+    even), so the requests are spread across the keys and their allowances
+    are used evenly. Searches wait for the first reading of the keys. The searches
+    left of each key are read from the SerpApi account endpoint (which is not
+    charged), cached in the cache directory, if any, and counted down locally
+    until they are read again. A key is taken out of the pool when SerpApi
+    rejects it or it runs out of searches, and paused until its next reading
+    when it reaches its hourly limit, so the run goes on with the other keys.
+    The account endpoint is only read for pools of more than one key."""
+
+    def __init__(self, keys, rate_limit=global_vars.default_serp_rate_limit, cache_dir=None,
+                 api_url=global_vars.serp_api_url, verbose=False):
+        self.verbose = verbose
+        self._keys = [_ApiKey(x, rate_limit) for x in keys]
+        # The account endpoint is next to the search endpoint
+        self.account_url = parse.urljoin(api_url, 'account.json')
+        self._lock = threading.Lock()
+        # Notified when the account of a key was read
+        self._read = threading.Condition(self._lock)
+        # Position of the key to use next among the keys which are even
+        self._turn = 0
+        # Single keys do not need to be balanced, so their account is not read
+        self._read_accounts = len(self._keys) > 1
+        self._conn = None
+        if cache_dir is not None and self._read_accounts:
+            p(cache_dir).mkdir(exist_ok=True, parents=True)
+            # A single connection shared by all the concurrent requests,
+            # protected by a lock. Other processes are handled by SQLite's own locking
+            self._conn = sqlite3.connect(str(p(cache_dir) / 'serp_keys.sqlite3'),
+                                         timeout=30, check_same_thread=False)
+            with self._lock, self._conn:
+                self._conn.execute("""CREATE TABLE IF NOT EXISTS accounts (
+                    key_id TEXT PRIMARY KEY,
+                    searches_left INTEGER,
+                    hour_left INTEGER,
+                    checked REAL NOT NULL)""")
+                # Start from the cached readings
+                for api_key in self._keys:
+                    row = self._conn.execute(
+                        'SELECT searches_left, hour_left, checked FROM accounts WHERE key_id = ?',
+                        (api_key.key_id,)).fetchone()
+                    if row:
+                        api_key.searches_left, api_key.hour_left, api_key.checked = row
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _read_account(self, api_key):
+        """Read the searches left of a key from the account endpoint, dropping
+        the key if SerpApi rejects it. The key is left as it was if the
+        endpoint cannot be reached"""
+        try:
+            account = http_transport.get_json(
+                f'{self.account_url}?' + parse.urlencode({'api_key': api_key.key}))[0]
+        except Exception as e:
+            with self._lock:
+                if _status_code(e) in (401, 403):
+                    self._drop(api_key, _error_message(e) or 'invalid API key', rejected=True)
+                # Try again once the cached reading expires
+                api_key.checked = time.time()
+            return
+        searches_left = account.get('total_searches_left', account.get('plan_searches_left'))
+        hour_limit = account.get('account_rate_limit_per_hour')
+        with self._lock:
+            api_key.searches_left = int(searches_left) if searches_left is not None else None
+            api_key.hour_left = int(hour_limit) - int(account.get('this_hour_searches', 0)) \
+                if hour_limit is not None else None
+            api_key.checked = time.time()
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?)',
+                                       (api_key.key_id, api_key.searches_left,
+                                        api_key.hour_left, api_key.checked))
+        if (self.verbose):
+            print(f'\nSerpApi key {api_key.key_id[:8]}: {api_key.searches_left} searches left')
+
+    def refresh(self, force=False):
+        """Read the searches left of the keys whose cached reading expired (or
+        of every key, if forced) from the account endpoint. Without readings,
+        the keys paused at their hourly limit are resumed once it expires"""
+        now = time.time()
+        with self._lock:
+            if not self._read_accounts:
+                for api_key in self._keys:
+                    if api_key.hour_left == 0 and now - api_key.checked >= global_vars.key_account_ttl:
+                        api_key.hour_left = None
+                return
+            stale = [x for x in self._keys if x.dropped is None and not x.reading and
+                     (force or now - x.checked >= global_vars.key_account_ttl)]
+            # Mark them as read, so concurrent requests do not read them too
+            for api_key in stale:
+                api_key.checked = now
+                api_key.reading = True
+        for api_key in stale:
+            try:
+                self._read_account(api_key)
+            finally:
+                with self._lock:
+                    api_key.reading = False
+                    self._read.notify_all()
+
+    def _drop(self, api_key, reason, rejected=False):
+        """Take a key out of the pool, either rejected by SerpApi or out of
+        searches. The lock must be held"""
+        if api_key.dropped is None:
+            api_key.dropped = reason
+            api_key.rejected = rejected
+            print(f'\nWarning: SerpApi key {api_key.key_id[:8]} taken out of the pool ({reason}). {len(self.active())} keys left.')
+
+    def active(self):
+        """Return the keys still in the pool"""
+        return [x for x in self._keys if x.dropped is None]
+
+    def acquire(self):
+        """Choose the key for the next search and count the search down from
+        its allowances. If no key is left, raise KeysRejected if every key was
+        rejected, and KeysExhausted otherwise. Wait if every key left reached
+        its hourly limit"""
+        while True:
+            self.refresh()
+            with self._lock:
+                active = self.active()
+                if not active:
+                    rejected = '; '.join(f'{x.key_id[:8]} ({x.dropped})'
+                                         for x in self._keys if x.rejected)
+                    exhausted = '; '.join(f'{x.key_id[:8]} ({x.dropped})'
+                                          for x in self._keys if not x.rejected)
+                    if not exhausted:
+                        raise KeysRejected(
+                            f'Every SerpApi API key of the pool was rejected: {rejected}')
+                    raise KeysExhausted(f'No SerpApi API key of the pool has searches left: {exhausted}' +
+                                        (f'. Rejected keys: {rejected}' if rejected else ''))
+                # Wait for the first reading of the keys, as they would all
+                # look even without it
+                if any(x.reading and x.searches_left is None for x in active):
+                    self._read.wait()
+                    continue
+                available = [x for x in active if x.hour_left is None or x.hour_left > 0]
+                if available:
+                    # The keys with searches left first (the ones counted
+                    # down to none are only tried once there are no others,
+                    # as their count may be out of date), then the earliest
+                    # free rate limit slot, then the most searches left
+                    # (unknown ones last), and then in turn
+                    api_key = min(available, key=lambda x: (
+                        x.searches_left is not None and x.searches_left <= 0,
+                        x.rate_limiter.delay(),
+                        -(x.searches_left if x.searches_left is not None else -1),
+                        (self._keys.index(x) - self._turn) % len(self._keys)))
+                    self._turn = self._keys.index(api_key) + 1
+                    if api_key.searches_left is not None:
+                        api_key.searches_left -= 1
+                    if api_key.hour_left is not None:
+                        api_key.hour_left -= 1
+                    return api_key
+                # Every key reached its hourly limit, so wait for the next reading
+                wait = min(x.checked for x in active) + global_vars.key_account_ttl - time.time()
+            if (self.verbose):
+                print(f'\nEvery SerpApi key reached its hourly limit. Waiting {max(wait, 0):.0f} seconds.')
+            time.sleep(max(wait, 0))
+
+    def release(self, api_key):
+        """Give back the search counted down for a search which failed, as
+        SerpApi does not charge for it"""
+        with self._lock:
+            if api_key.searches_left is not None:
+                api_key.searches_left += 1
+            if api_key.hour_left is not None:
+                api_key.hour_left += 1
+
+    def charged(self, api_key):
+        """Record a search made with a key in the local cache"""
+        if self._conn is None:
+            return
+        with self._lock, self._conn:
+            self._conn.execute("""UPDATE accounts SET searches_left = searches_left - 1,
+                hour_left = hour_left - 1 WHERE key_id = ?""", (api_key.key_id,))
+
+    def _handle_error(self, api_key, error):
+        """Take the key out of the pool (or pause it) if the error is about the
+        key itself, i.e. it was rejected or ran out of searches. Return whether
+        it was, in which case the search should be made with another key"""
+        status_code = _status_code(error)
+        if status_code not in (401, 403, 429):
+            return False
+        message = _error_message(error)
+        with self._lock:
+            # The hourly limit is lifted within the hour, so the key is only
+            # paused until its next reading
+            if status_code == 429 and 'hour' in message.lower():
+                api_key.hour_left = 0
+                api_key.checked = time.time()
+                print(f'\nWarning: SerpApi key {api_key.key_id[:8]} reached its hourly limit. Pausing it.')
+            # A 429 without a message is a plain rate limit, which is retried
+            elif status_code == 429 and not message:
+                return False
+            # Out of searches
+            elif status_code == 429:
+                api_key.searches_left = 0
+                self._drop(api_key, message)
+            # Rejected, e.g. invalid
+            else:
+                self._drop(api_key, message or f'HTTP {status_code}', rejected=True)
+        return True
+
+    def call(self, request):
+        """Perform a request with the keys of the pool, where request is a
+        function of the API key and its rate limiter. If the key is rejected or
+        out of searches, it is taken out of the pool and the request is made
+        again with another key, so only other errors reach the caller"""
+        while True:
+            api_key = self.acquire()
+            try:
+                result = request(api_key.key, api_key.rate_limiter)
+            except Exception as e:
+                self.release(api_key)
+                if self._handle_error(api_key, e):
+                    continue
+                raise
+            self.charged(api_key)
+            return result
+
+    def close(self):
+        """Close the database connection, if any"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
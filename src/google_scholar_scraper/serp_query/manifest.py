@@ -0,0 +1,91 @@
+import hashlib
+import json
+from pathlib import Path as p
+from google_scholar_scraper.config import global_vars
+
+
+class ScrapeManifest:
+    """Append-only manifest of the pages of search results of a query which
+    were already saved to its output file, so an interrupted scrape can resume
+    from the first missing page. Each line is a JSON object: a header with the
+    query and output file name, then one line per saved page with its start
+    offset, the size of the output file after saving it, and whether it was the
+    last page with search results, and a line with the new output file name if
+    it was converted to another format once finished."""
+
+    def __init__(self, output_dir, search_query):
+        self.search_query = search_query
+        # The manifests are stored in a hidden folder of the output directory,
+        # named after a hash of the query
+        query_hash = hashlib.sha1(search_query.encode('utf-8')).hexdigest()[:16]
+        self.path = p(output_dir) / '.manifests' / f'{query_hash}.jsonl'
+        # Name of the output file of the query
+        self.output_file_name = None
+        # The start offsets of the pages already saved
+        self.completed = []
+        # Size of the output file after the last saved page
+        self.offset = 0
+        # Whether the search results ran out
+        self.ended = False
+        self._read()
+
+    def _read(self):
+        """Read the state of a previous scrape of the query, if any"""
+        if not self.path.is_file():
+            return
+        with open(str(self.path), 'r', encoding='utf-8') as manifest_file:
+            for line in manifest_file:
+                # Skip any incomplete last line left by a crash
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'query' in entry:
+                    # Ignore manifests of other queries with the same hash
+                    if entry['query'] != self.search_query:
+                        return
+                    self.output_file_name = entry['output_file']
+                # The output file of a finished scrape may be converted to
+                # another format
+                elif 'output_file' in entry:
+                    self.output_file_name = entry['output_file']
+                elif 'start' in entry:
+                    self.completed.append(entry['start'])
+                    self.offset = entry['offset']
+                    self.ended = self.ended or entry.get('end', False)
+
+    def next_start(self):
+        """Return the start offset of the first page not saved yet"""
+        return max(self.completed) + global_vars.default_serp_max_results \
+            if self.completed else 0
+
+    def _append(self, entry):
+        """Append an entry to the manifest"""
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        with open(str(self.path), 'a', encoding='utf-8') as manifest_file:
+            manifest_file.write(json.dumps(entry) + '\n')
+
+    def begin(self, output_file_name):
+        """Record the name of the output file of a new scrape of the query"""
+        self.output_file_name = output_file_name
+        self.completed = []
+        self.offset = 0
+        self.ended = False
+        # Overwrite any manifest of another query with the same hash
+        self.path.unlink(missing_ok=True)
+        self._append({'query': self.search_query,
+                      'output_file': output_file_name})
+
+    def converted(self, output_file_name):
+        """Record that the output file of the query was converted to another
+        format"""
+        self.output_file_name = output_file_name
+        self._append({'output_file': output_file_name})
+
+    def page_saved(self, start, offset, end=False):
+        """Record that a page of search results was saved to the output file,
+        and whether it was the last page with search results"""
+        self.completed.append(start)
+        self.offset = offset
+        self.ended = self.ended or end
+        self._append({'start': start, 'offset': offset, 'end': end})
@@ -0,0 +1,265 @@
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path as p
+from urllib import parse
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.retry import get_retrier
+from google_scholar_scraper.metrics import get_metrics
+from google_scholar_scraper.result_files import read_rows, RowWriter
+from google_scholar_scraper.serp_query.manifest import ScrapeManifest
+from google_scholar_scraper.serp_query.seen_store import seen_key
+from google_scholar_scraper.serp_query.key_pool import KeyPool
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar, _fetch_json, \
+    _new_output_file, _finalise, year_range_label, page_params, exit_on_errors
+
+# Columns of the file of a partitioned query: the columns of the scraped
+# files, with the rank of each search result within its partition, and the
+# year range of its partition
+partitioned_fieldnames = [global_vars.author_key, global_vars.pub_year_key, global_vars.title_key,
+                          global_vars.scholar_link_key, global_vars.pub_url_key,
+                          global_vars.gs_rank_key, global_vars.num_citations_key,
+                          global_vars.partition_key]
+
+
+def partitioned_manifest_key(search_query):
+    """Return the key of the manifest of the merged file of a partitioned
+    query, apart from the one of the query scraped without partitions"""
+    return f'{search_query} [partitioned]'
+
+
+def _count_results(key_pool, search_query, year_range, cache=None,
+                   api_url=global_vars.serp_api_url, budget=None, request_slots=None,
+                   archive=None, offline=False):
+    """Return the number of search results of a query in a year range, as
+    reported with its first page, and the response of the first page, which
+    the scrape of the range uses instead of requesting it again. If offline
+    is set, the first page is only read from the local cache, and (None,
+    None) is returned if it is not there"""
+    params = page_params(search_query, 0, global_vars.default_serp_max_results, year_range)
+    cached = cache.get(params) if cache is not None else None
+    if cache is not None:
+        get_metrics().increment('cache_lookups', cache='serpapi',
+                                result='miss' if cached is None else 'hit')
+    if cached is not None:
+        response = cached[0]
+    elif offline:
+        return (None, None)
+    else:
+        def request(key, rate_limiter):
+            """Request the page with a key of the pool"""
+            url = f'{api_url}?' + parse.urlencode({**params, 'api_key': key})
+            return _fetch_json(url, rate_limiter, budget, request_slots)
+        # Perform the request, retrying it on transient errors
+        response = get_retrier('SerpApi').call(key_pool.call, request)
+        if cache is not None:
+            cache.put(params, response)
+        if archive is not None:
+            archive.append(params, response)
+    results = len(response.get('organic_results', []))
+    # A page which is not full has every search result of the range
+    if results < global_vars.default_serp_max_results:
+        return (results, response)
+    return (int(response.get('search_information', {}).get('total_results', results)),
+            response)
+
+
+def plan_partitions(count_results, first_year, last_year,
+                    concurrency=global_vars.default_query_concurrency, verbose=False):
+    """Split the publication years of a query into ranges whose search results
+    are all reachable, i.e. fewer than Google Scholar's cap. The years from
+    first_year to last_year are bisected adaptively: a range whose number of
+    search results (from count_results, a function of a year range) is near
+    the cap is split in two halves, which are counted concurrently, until
+    every range is below it or is a single year. The publications before
+    first_year are a range of their own, which is not split. Return a list of
+    (year range, number of search results) tuples, newest range first. Ranges
+    which could not be counted (count_results returned None) are not split,
+    and have None search results"""
+    threshold = global_vars.scholar_result_cap * global_vars.partition_split_ratio
+    ranges = [(first_year, last_year), (None, first_year - 1)]
+    partitions = []
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        while ranges:
+            # Each range is counted with a copy of the context, so its metrics
+            # are attributed to the query
+            futures = [executor.submit(contextvars.copy_context().run, count_results, x)
+                       for x in ranges]
+            split = []
+            for (year_range, future) in zip(ranges, futures):
+                results = future.result()
+                if results is None:
+                    partitions.append((year_range, None))
+                    continue
+                (year_low, year_high) = year_range
+                if results >= threshold and year_low is not None and year_low < year_high:
+                    middle = (year_low + year_high) // 2
+                    split += [(year_low, middle), (middle + 1, year_high)]
+                    continue
+                if results >= threshold:
+                    print(
+                        f'\nWarning: the years {year_range_label(year_range)} have about {results} search results, which cannot be split further. Only the first {global_vars.scholar_result_cap} can be scraped.')
+                elif (verbose):
+                    print(f'\nPartition {year_range_label(year_range)}: about {results} search results')
+                partitions.append((year_range, results))
+            ranges = split
+    return sorted(partitions, key=lambda x: x[0][0] or 0, reverse=True)
+
+
+def partitions_dir(base_output_dir):
+    """Return the folder of the output directory where the ranges of the
+    partitioned queries are scraped"""
+    return p(base_output_dir) / 'partitions'
+
+
+def _scraped(base_output_dir, search_query):
+    """Return the manifest of the partitioned scrape of a query in an output
+    directory, and whether the scrape already finished"""
+    manifest = ScrapeManifest(base_output_dir, partitioned_manifest_key(search_query))
+    return (manifest, manifest.ended and manifest.output_file_name is not None and
+            (p(base_output_dir) / manifest.output_file_name).is_file())
+
+
+def plan_partitioned(serp_api_key, search_query, max_results, base_output_dir, verbose,
+                     first_year=global_vars.partition_first_year,
+                     partition_concurrency=global_vars.default_query_concurrency,
+                     rate_limit=global_vars.default_serp_rate_limit, cache=None,
+                     api_url=global_vars.serp_api_url, budget=None, request_slots=None,
+                     archive=None, offline=False):
+    """Plan the partitioned scrape of a query (see plan_partitions), and
+    return a list of (year range, number of search results to scrape,
+    response of its first page) tuples, newest range first, up to max_results
+    search results in total. The list is empty if the query was already
+    scraped in the output directory. If offline is set, no search is made:
+    the search results are only counted from the first pages in the local
+    cache, and None is returned if any range could not be counted. If the
+    search results cannot be counted, inform the user and exit, as the scrape
+    of a query does"""
+    if _scraped(base_output_dir, search_query)[1]:
+        return []
+
+    # Share the keys (and their rate limiters) between all the ranges
+    key_pool = serp_api_key if isinstance(serp_api_key, KeyPool) \
+        else KeyPool([serp_api_key], rate_limit)
+
+    # Response of the first page of each range, once counted
+    first_pages = {}
+
+    def count_results(year_range):
+        """Count the search results of the query in a year range"""
+        (results, first_pages[year_range]) = _count_results(
+            key_pool, search_query, year_range, cache, api_url, budget, request_slots, archive,
+            offline)
+        return results
+
+    if (verbose and not offline):
+        print(f'\nPartitioning the query by publication year: {search_query}')
+    try:
+        ranges = plan_partitions(count_results, first_year, int(time.strftime('%Y')),
+                                 partition_concurrency, verbose)
+    # If the searches ran out, the keys were rejected, or we ran out of retry
+    # attempts, inform the user and exit
+    except Exception as e:
+        print(f'\n{e}')
+        print(
+            f'\nThere was a problem counting the search results of the query by publication year: {search_query}')
+        exit_on_errors([e])
+    if any(x is None for (_, x) in ranges):
+        return None
+    # Share out the search results wanted, newest range first
+    partitions = []
+    remaining = max_results
+    for (year_range, results) in ranges:
+        if remaining <= 0:
+            break
+        if results == 0:
+            continue
+        partitions.append((year_range, min(results, global_vars.scholar_result_cap, remaining),
+                           first_pages[year_range]))
+        remaining -= partitions[-1][1]
+    if (verbose):
+        print(f'\n{len(partitions)} partitions to scrape: ' + ', '.join(
+            f'{year_range_label(x)} ({y})' for (x, y, _) in partitions))
+    return partitions
+
+
+def scrape_partitioned(serp_api_key, search_query, max_results, base_output_dir, verbose,
+                       first_year=global_vars.partition_first_year,
+                       concurrency=global_vars.default_concurrency,
+                       partition_concurrency=global_vars.default_query_concurrency,
+                       rate_limit=global_vars.default_serp_rate_limit, cache=None,
+                       api_url=global_vars.serp_api_url,
+                       output_format=global_vars.default_output_format, budget=None,
+                       request_slots=None, on_rows=None, archive=None, partitions=None):
+    """Scrape a query beyond the cap of Google Scholar's search results, by
+    splitting it into ranges of publication years (see plan_partitioned,
+    unless the planned partitions are given), and return the path of the file
+    where the results were saved. The ranges are scraped concurrently
+    (partition_concurrency at a time), newest first, each into its own file in
+    a partitions folder of the output directory, so an interrupted scrape
+    resumes every range. Their files are then merged into the file of the
+    query, without the publications found in several ranges (identified by
+    their cluster), keeping the rank of each search result within its range,
+    and the range in a PARTITION column"""
+    base_output_dir = p(base_output_dir)
+    # If the partitioned scrape of the query already finished in this output
+    # directory, we are done
+    (manifest, scraped) = _scraped(base_output_dir, search_query)
+    if scraped:
+        if (verbose):
+            print(f'\nQuery already scraped in {manifest.output_file_name}. Skipping.')
+        return base_output_dir / manifest.output_file_name
+
+    # Share the keys (and their rate limiters) between all the ranges
+    key_pool = serp_api_key if isinstance(serp_api_key, KeyPool) \
+        else KeyPool([serp_api_key], rate_limit)
+    if partitions is None:
+        partitions = plan_partitioned(key_pool, search_query, max_results, base_output_dir,
+                                      verbose, first_year, partition_concurrency, rate_limit,
+                                      cache, api_url, budget, request_slots, archive)
+
+    # Scrape the ranges concurrently, sharing the request slots with every other query
+    partition_dir = partitions_dir(base_output_dir)
+    partition_dir.mkdir(exist_ok=True, parents=True)
+
+    def scrape(year_range, wanted, first_page):
+        """Scrape the query in a year range, and return the path of its file"""
+        return scrape_google_scholar(
+            key_pool, search_query, wanted, partition_dir, verbose, concurrency, rate_limit,
+            cache, api_url, 'csv', budget, request_slots, on_rows, archive=archive,
+            year_range=year_range, first_page=first_page)
+
+    with ThreadPoolExecutor(max_workers=max(partition_concurrency, 1)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, scrape, *x)
+                   for x in partitions]
+        try:
+            partition_files = [x.result() for x in futures]
+        # If a range fails (e.g. the budget was exhausted), do not start any
+        # other range, and let the running ones finish saving their progress
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    # Merge the files of the ranges into the file of the query, newest range
+    # first, keeping each publication once
+    output_file_path = _new_output_file(base_output_dir, search_query, '_partitioned')
+    manifest.begin(output_file_path.name)
+    seen = set()
+    size = 0
+    with RowWriter(output_file_path, partitioned_fieldnames) as writer:
+        for ((year_range, *_), partition_file) in zip(partitions, partition_files):
+            for row in read_rows(partition_file):
+                key = seen_key(row)
+                if key in seen:
+                    continue
+                seen.add(key)
+                row[global_vars.partition_key] = year_range_label(year_range)
+                writer.writerow(row)
+                size += 1
+    # Record the end of the scrape of the query, so it is skipped when resumed
+    manifest.page_saved(0, output_file_path.stat().st_size, True)
+    if (verbose):
+        print(f'\n{size} search results from {len(partitions)} partitions saved in {output_file_path.name}')
+    # Return the file path where we stored the results, converted to the
+    # output format
+    return _finalise(output_file_path, manifest, output_format)
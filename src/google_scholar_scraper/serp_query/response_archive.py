@@ -0,0 +1,257 @@
+import argparse
+import gzip
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path as p
+from sys import exit
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.result_files import RowWriter, has_pyarrow
+from google_scholar_scraper.serp_query.serp_query import _parse_result
+
+# Columns of the scraped files, parsed from a search result by _parse_result
+_result_keys = (global_vars.author_key, global_vars.pub_year_key, global_vars.title_key,
+                global_vars.scholar_link_key, global_vars.pub_url_key, global_vars.gs_rank_key,
+                global_vars.num_citations_key)
+
+# Extractors of the other columns a rebuild can output, from a search result
+_extractors = {
+    global_vars.snippet_key: lambda x: x.get('snippet', ''),
+    global_vars.summary_key: lambda x: x.get('publication_info', {}).get('summary', ''),
+    global_vars.result_id_key: lambda x: x.get('result_id', ''),
+    global_vars.result_type_key: lambda x: x.get('type', ''),
+    global_vars.cluster_id_key: lambda x: x.get('inline_links', {}).get(
+        'versions', {}).get('cluster_id', ''),
+    global_vars.cites_id_key: lambda x: x.get('inline_links', {}).get(
+        'cited_by', {}).get('cites_id', ''),
+    global_vars.num_versions_key: lambda x: x.get('inline_links', {}).get(
+        'versions', {}).get('total', ''),
+    global_vars.resources_key: lambda x: '; '.join(
+        y.get('link', '') for y in x.get('resources', [])),
+}
+
+# Every column a rebuild can output: the query (or cited publication) of the
+# page, the columns of the scraped files, and the other extracted ones
+archive_fields = [global_vars.query_key, *_result_keys, *_extractors]
+
+
+class ResponseArchive:
+    """Append-only archive of the raw SerpApi responses, so the search results
+    can be parsed again offline (e.g. with more fields) without paying for the
+    same searches again. Each response is appended as a JSON line to a gzip
+    compressed segment file, flushed after every response so a crash only
+    loses the line being written. A new segment is started once a segment
+    reaches its maximum size, and every process writes its own segments."""
+
+    def __init__(self, archive_dir, segment_size=global_vars.archive_segment_size):
+        self.archive_dir = p(archive_dir)
+        self.segment_size = segment_size
+        self.archive_dir.mkdir(exist_ok=True, parents=True)
+        # The segment being written, shared by all the concurrent requests and
+        # protected by a lock
+        self._lock = threading.Lock()
+        self._raw_file = None
+        self._file = None
+        self._segments = 0
+
+    def _open_segment(self):
+        """Start a new segment, named after the current timestamp and process
+        so it never clashes with another one"""
+        timestamp = time.strftime('%Y-%m-%dT%H%M%S', time.localtime(time.time()))
+        while True:
+            self._segments += 1
+            segment_path = self.archive_dir / \
+                f'{timestamp}_{os.getpid()}_{self._segments:04d}.jsonl.gz'
+            try:
+                self._raw_file = open(str(segment_path), 'xb')
+                break
+            except FileExistsError:
+                continue
+        self._file = gzip.GzipFile(fileobj=self._raw_file, mode='wb')
+
+    def _close_segment(self):
+        """Finish the segment being written"""
+        if self._file is not None:
+            self._file.close()
+            self._raw_file.close()
+            self._file = None
+
+    def append(self, params, response, uncached=False):
+        """Append a response to the archive, with its request parameters (which
+        must not include the API key) and whether it was an uncached search"""
+        line = json.dumps({'time': time.time(), 'params': params, 'uncached': uncached,
+                           'response': response}) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._open_segment()
+            self._file.write(line.encode('utf-8'))
+            # Make the response readable from the segment right away
+            self._file.flush()
+            if self._raw_file.tell() >= self.segment_size:
+                self._close_segment()
+
+    def close(self):
+        """Finish the segment being written"""
+        with self._lock:
+            self._close_segment()
+
+
+def segments(archive_dir):
+    """Return the paths of the segments of an archive, oldest first"""
+    return sorted(p(archive_dir).glob('*.jsonl.gz'))
+
+
+def read_segment(segment_path):
+    """Yield the (time, request parameters, response) tuples of a segment,
+    stopping at the end of a segment cut short by a crash"""
+    try:
+        with gzip.open(str(segment_path), 'rb') as segment_file:
+            for line in segment_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                yield (entry['time'], entry['params'], entry['response'])
+    except (EOFError, gzip.BadGzipFile, zlib.error):
+        return
+
+
+def _row(result, start, query, fields):
+    """Parse a search result of a page starting at the start offset into a
+    row with the given fields"""
+    row = _parse_result(result, start) if any(x in _result_keys for x in fields) else {}
+    row[global_vars.query_key] = query
+    for x in fields:
+        if x in _extractors:
+            row[x] = _extractors[x](result)
+    return row
+
+
+def _page_key(params):
+    """Return the key of a page of search results, from its request parameters
+    other than its start and number of results, and its start"""
+    return (json.dumps({x: y for (x, y) in params.items() if x not in ('start', 'num')},
+                       sort_keys=True), int(params.get('start', 0)))
+
+
+def _index_segment(segment_path):
+    """Index the search results of every response of a segment, without
+    parsing them. Return a list of (key, time, entry) tuples, where the key
+    identifies the search result across responses (the key of its page and
+    its rank), and the entry is the number of its response in the segment"""
+    indexed = []
+    for (entry, (entry_time, params, response)) in enumerate(read_segment(segment_path)):
+        (page_key, start) = _page_key(params)
+        for result in response.get('organic_results', []):
+            indexed.append(((page_key, start + result.get('position', 0)), entry_time, entry))
+    return indexed
+
+
+def _parse_segment(segment_path, kept, fields, rows_path):
+    """Parse the search results of a segment kept by a rebuild (a dictionary
+    of their keys to the entry of their response) and write their [key, row]
+    pairs, sorted on their key, as JSON lines into a file"""
+    parsed = []
+    for (entry, (_, params, response)) in enumerate(read_segment(segment_path)):
+        (page_key, start) = _page_key(params)
+        # Pages of the publications citing another one have no query
+        query = params.get('q') or f'cites:{params.get("cites", "")}'
+        for result in response.get('organic_results', []):
+            key = [page_key, start + result.get('position', 0)]
+            if kept.get(tuple(key)) == entry:
+                parsed.append((key, _row(result, start, query, fields)))
+    parsed.sort(key=lambda x: x[0])
+    with open(rows_path, 'w', encoding='utf-8') as rows_file:
+        for x in parsed:
+            rows_file.write(json.dumps(x) + '\n')
+
+
+def _read_parsed(rows_path):
+    """Yield the [key, row] pairs written by _parse_segment"""
+    with open(rows_path, encoding='utf-8') as rows_file:
+        for line in rows_file:
+            yield json.loads(line)
+
+
+def rebuild(archive_dir, output_path, fields=None, processes=None, output_format=None):
+    """Parse every search result of an archive into a file of search results
+    with the given fields (by default, the query and the columns of the
+    scraped files), spreading the segments across a pool of processes.
+    Search results archived several times (e.g. by a refreshed scrape) are
+    only kept from their latest response. Only an index of the search results
+    is kept in memory: each segment then parses the ones it keeps into a
+    sorted temporary file, and the files are merged into the output file.
+    Return the number of rows written"""
+    fields = fields or [global_vars.query_key, *_result_keys]
+    segment_paths = segments(archive_dir)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # Find the latest response of every search result
+        latest = {}
+        for (segment, indexed) in enumerate(executor.map(_index_segment, segment_paths)):
+            for (key, entry_time, entry) in indexed:
+                if key not in latest or entry_time >= latest[key][0]:
+                    latest[key] = (entry_time, segment, entry)
+        kept = [{} for _ in segment_paths]
+        for (key, (_, segment, entry)) in latest.items():
+            kept[segment][key] = entry
+        rows = len(latest)
+        del latest
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rows_paths = [p(temp_dir) / f'{x}.jsonl' for x in range(len(segment_paths))]
+            list(executor.map(_parse_segment, segment_paths, kept,
+                              [fields] * len(segment_paths), rows_paths))
+            del kept
+            # Write the search results of each page in the order of their rank
+            with RowWriter(output_path, fields, output_format) as writer:
+                for (_, row) in heapq.merge(*(_read_parsed(x) for x in rows_paths),
+                                            key=lambda x: x[0]):
+                    writer.writerow(row)
+    return rows
+
+
+def main():
+    """Command line interface to rebuild files of search results from an
+    archive of SerpApi responses"""
+    parser = argparse.ArgumentParser(prog='Google Scholar Scraper Archive Rebuild',
+                                     description='Parse the SerpApi responses archived by the scraper into a file of search results, offline.')
+    parser.add_argument('archive_dir', help='The directory of the archive (the --archive-dir of the scraper).')
+    parser.add_argument('output_file', help='The path of the file to save the search results into (.csv or .parquet).')
+    parser.add_argument('-F', '--fields',
+                        help=f"""Set the comma-separated columns to output, out of
+                        {', '.join(archive_fields)}. By default, the query and
+                        the columns of the scraped files.""",
+                        type=str)
+    parser.add_argument('-p', '--processes',
+                        help='Sets the number of processes parsing the segments of the archive. Default = the number of CPUs.',
+                        type=int)
+    args = parser.parse_args()
+
+    # Check that the archive exists and the fields are known
+    if not p(args.archive_dir).is_dir():
+        print(f'\nError: no archive found at {args.archive_dir}')
+        exit(404)
+    fields = [x.strip() for x in args.fields.split(',')] if args.fields else None
+    unknown = [x for x in fields or [] if x not in archive_fields]
+    if unknown:
+        print(f'\nError: unknown fields {", ".join(unknown)}. Valid fields: {", ".join(archive_fields)}')
+        exit(406)
+    if args.processes is not None and args.processes < 1:
+        print(f'\nError: processes ("{args.processes}") must be greater than 0')
+        exit(406)
+    if p(args.output_file).suffix.lower() == '.parquet' and not has_pyarrow():
+        print(
+            '\nError: Parquet files need the pyarrow package. Install it with "pip install pyarrow"')
+        exit(406)
+
+    start_time = time.perf_counter()
+    rows = rebuild(args.archive_dir, args.output_file, fields, args.processes)
+    print(f'\n{rows} search results from {len(segments(args.archive_dir))} segments saved in {args.output_file} ({time.perf_counter() - start_time:.2f} s)')
+
+
+if __name__ == '__main__':
+    main()
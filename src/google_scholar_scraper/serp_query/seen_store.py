@@ -0,0 +1,77 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path as p
+from google_scholar_scraper.config import global_vars
+
+
+def seen_key(row):
+    """Return the key identifying a scraped row across runs: its Google Scholar
+    cluster link, or else its publication link, or else its title"""
+    return row[global_vars.scholar_link_key] or row[global_vars.pub_url_key] or \
+        f'title:{row[global_vars.title_key].casefold()}'
+
+
+class SeenStore:
+    """Persistent state of the incremental scrapes, stored in an SQLite
+    database: the search results (cluster ids or links) already seen for each
+    query, and the year each query was last scraped, so a later run of the
+    same query only keeps the new search results."""
+
+    def __init__(self, cache_dir):
+        # Create the directory recursively
+        p(cache_dir).mkdir(exist_ok=True, parents=True)
+        # A single connection shared by all the concurrent requests, protected
+        # by a lock. Other processes are handled by SQLite's own locking
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(p(cache_dir) / 'serp_seen.sqlite3'),
+                                     timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS seen (
+                query TEXT NOT NULL,
+                key TEXT NOT NULL,
+                first_seen REAL NOT NULL,
+                PRIMARY KEY (query, key))""")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS runs (
+                query TEXT PRIMARY KEY,
+                last_run REAL NOT NULL,
+                last_year INTEGER NOT NULL)""")
+
+    def known(self, search_query, keys):
+        """Return the set of keys already seen for the query"""
+        known = set()
+        keys = list(keys)
+        with self._lock:
+            # Look the keys up in chunks, within SQLite's limit of parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                known.update(x[0] for x in self._conn.execute(
+                    f'SELECT key FROM seen WHERE query = ? AND key IN ({", ".join("?" * len(chunk))})',
+                    (search_query, *chunk)))
+        return known
+
+    def add(self, search_query, keys):
+        """Record keys as seen for the query, in a single transaction"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?, ?)',
+                                   [(search_query, x, now) for x in keys])
+
+    def last_run_year(self, search_query):
+        """Return the year the query was last scraped in full, or None if it
+        never was"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT last_year FROM runs WHERE query = ?', (search_query,)).fetchone()
+        return row[0] if row else None
+
+    def finish_run(self, search_query):
+        """Record that the query was scraped in full now"""
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?)',
+                               (search_query, time.time(), int(time.strftime('%Y'))))
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path as p
+
+
+class SerpCache:
+    """Persistent on-disk cache of SerpApi responses, stored in an SQLite
+    database. Entries expire after a time-to-live (in seconds), and the least
+    recently used entries are evicted when the cache grows beyond its maximum
+    size (in bytes)."""
+
+    def __init__(self, cache_dir, ttl, max_size, refresh=False):
+        self.ttl = ttl
+        self.max_size = max_size
+        # If refresh is set, cached responses are never returned, but new
+        # responses are still stored, replacing the old ones
+        self.refresh = refresh
+        # Create the cache directory recursively
+        p(cache_dir).mkdir(exist_ok=True, parents=True)
+        # A single connection shared by all the concurrent requests, protected
+        # by a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(p(cache_dir) / 'serp_cache.sqlite3'), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                size INTEGER NOT NULL,
+                uncached INTEGER NOT NULL,
+                body BLOB NOT NULL)""")
+            # Index used to find the least recently used entries to evict
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+    @staticmethod
+    def _key(params):
+        """Build the cache key from the request parameters (query, start, num,
+        engine and any other parameter), which must not include the API key"""
+        return hashlib.sha256(json.dumps(
+            params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get(self, params):
+        """Return a tuple of the cached response for the request parameters and
+        whether it was obtained with an uncached search, or None if there is no
+        valid entry"""
+        if self.refresh:
+            return None
+        key = self._key(params)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT created, uncached, body FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            # If the entry has expired, remove it
+            if now - row[0] > self.ttl:
+                self._conn.execute(
+                    'DELETE FROM responses WHERE key = ?', (key,))
+                return None
+            # Mark the entry as recently used
+            self._conn.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        return (json.loads(zlib.decompress(row[2])), bool(row[1]))
+
+    def contains(self, params):
+        """Return whether there is a valid cached response for the request
+        parameters, without marking it as used"""
+        if self.refresh:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT created FROM responses WHERE key = ?', (self._key(params),)).fetchone()
+        return row is not None and time.time() - row[0] <= self.ttl
+
+    def put(self, params, response, uncached=False):
+        """Store a response for the request parameters, replacing any previous
+        entry, and whether it was obtained with an uncached search. Responses
+        reporting an error are not stored."""
+        if 'error' in response:
+            return
+        key = self._key(params)
+        body = zlib.compress(json.dumps(response).encode('utf-8'))
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, now, now, len(body), int(uncached), body))
+            self._evict()
+
+    def _evict(self):
+        """Remove expired entries, and then the least recently used entries
+        until the cache is within its maximum size"""
+        self._conn.execute('DELETE FROM responses WHERE created < ?',
+                           (time.time() - self.ttl,))
+        total_size = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        # Walk through the entries from the least recently used one, and
+        # remove them until enough space has been freed
+        to_delete = []
+        for (key, size) in self._conn.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            if total_size <= self.max_size:
+                break
+            to_delete.append((key,))
+            total_size -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', to_delete)
+
+    def close(self):
+        """Close the connection to the cache database"""
+        with self._lock:
+            self._conn.close()
@@ -3,196 +3,611 @@ import time
 import re
 from pathlib import Path as p
 from google_scholar_scraper.config import global_vars
-from urllib import request, parse
-import json
+from urllib import parse
 import math
+import threading
+import contextvars
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from sys import exit
+from google_scholar_scraper.retry import get_retrier
+from google_scholar_scraper import http_transport
+from google_scholar_scraper.metrics import get_metrics
+from google_scholar_scraper.serp_query.manifest import ScrapeManifest
+from google_scholar_scraper.result_files import convert, file_format
+from google_scholar_scraper.serp_query.credit_budget import BudgetExhausted
+from google_scholar_scraper.serp_query.seen_store import seen_key
+from google_scholar_scraper.serp_query.key_pool import KeyPool, KeysExhausted, KeysRejected
 
+# There is no actual property for the year, so it is parsed from the
+# publication info summary with a regex matching what would likely be the year
+_year_regex = re.compile(r'.*, (\d{4}) - .*')
+# Characters left out of the names of the output files
+_non_letter_regex = re.compile('[^a-zA-Z]')
 
-def scrape_google_scholar(serp_api_key, search_query, max_results, base_output_dir, verbose):
+
+class ScrapeCancelled(Exception):
+    """Error raised when a scrape was cancelled before it finished (e.g. its
+    worker lost the lease of the query)"""
+
+
+def _fetch_json(url, rate_limiter, budget=None, request_slots=None):
+    """Perform a request once the rate limiter allows it, and return its JSON
+    response as a dictionary. If a credit budget is given, a search is
+    reserved from it first, and released if the request fails. If request
+    slots (a semaphore) are given, the request waits for a free slot"""
+    # Reserve the search first, so the budget is never exceeded
+    if budget is not None and not budget.reserve():
+        raise BudgetExhausted(
+            f'The monthly budget of {budget.monthly_budget} SerpApi searches is exhausted.')
+    try:
+        with request_slots or nullcontext():
+            # Wait for our turn so we do not exceed the rate limit
+            rate_limiter.acquire()
+            # Perform the request over the shared keep-alive connections,
+            # recording its latency, and return the JSON response as a dictionary
+            start_time = time.perf_counter()
+            try:
+                response = http_transport.get_json(url)[0]
+            except Exception:
+                get_metrics().record_request(
+                    'serpapi', time.perf_counter() - start_time, False)
+                raise
+    # Failed searches are not charged
+    except Exception:
+        if budget is not None:
+            budget.release()
+        raise
+    get_metrics().record_request(
+        'serpapi', time.perf_counter() - start_time, True)
+    return response
+
+
+def _parse_result(result, start):
+    """Parse a search result of a page starting at the start offset into a
+    row of the output file"""
+    # Parse the response object into string variables
+    title = result['title']
+    # From the array of authors, if any, make a single semicolon-separated string
+    authors = '; '.join(
+        [x['name'] for x in result['publication_info'].get('authors', [])])
+    # Parse the year from the publication info summary
+    pub_year = _year_regex.match(result['publication_info']['summary'])
+    pub_year = '' if pub_year is None else pub_year.groups(
+    )[-1]
+
+    # If the search result does not have an external link, the index
+    # will not be accessible, so add it to the object with an empty string as value
+    if (not ('link' in result)):
+        result['link'] = ''
+    # Generate the Google Scholar publication page link from the cluster ID value if available
+    g_scholar_link = f'https://scholar.google.com/scholar?cluster={result['inline_links']['versions']['cluster_id']}' \
+        if 'inline_links' in result and 'versions' in result['inline_links'] and 'cluster_id' in result['inline_links']['versions'] \
+        else ''
+    # Generate the number of citations from the respective property if available
+    num_citations = result['inline_links']['cited_by']['total'] \
+        if 'inline_links' in result and 'cited_by' in result['inline_links'] and 'total' in result['inline_links']['cited_by'] \
+        else 0
+
+    # Return the variables as a row, using the global variables for the
+    # column names
+    return {
+        global_vars.author_key: authors,
+        global_vars.pub_year_key: pub_year,
+        global_vars.title_key: title,
+        global_vars.scholar_link_key: g_scholar_link,
+        global_vars.pub_url_key: result['link'],
+        global_vars.gs_rank_key: start + result['position'],
+        global_vars.num_citations_key: num_citations
+    }
+
+
+def exit_on_errors(errors, saved=''):
+    """Inform the user of the errors which stopped the scrape of a query, and
+    exit: with code 402 if the SerpApi searches ran out, 401 if SerpApi
+    rejected every API key, and 500 otherwise. saved says where the results
+    obtained so far were saved, if anywhere"""
+    saved = f' {saved}' if saved else ''
+    if any(isinstance(x, BudgetExhausted) for x in errors):
+        print(
+            f'\nThe monthly SerpApi search budget was reached.{saved} Run the scraper again with the same output directory to resume.')
+        exit(402)
+    if any(isinstance(x, KeysExhausted) for x in errors):
+        print(
+            f'\nNo SerpApi API key has searches left.{saved} Run the scraper again with the same output directory to resume.')
+        exit(402)
+    if any(isinstance(x, KeysRejected) for x in errors):
+        print(f'\nSerpApi rejected every API key. Please check your API keys.{saved}')
+        exit(401)
+    print(
+        'Too many failed attempts at scraping Google Scholar. Please check your API key and try again.')
+    print(f'{saved.strip()} Run the scraper again with the same output directory to resume.'.strip())
+    exit(500)
+
+
+def year_range_label(year_range):
+    """Return the label of a (first year, last year) range of publication
+    years, either of which may be open (None), e.g. 1990-1999 or -1899"""
+    (year_low, year_high) = year_range
+    return f'{year_low or ""}-{year_high or ""}'
+
+
+def manifest_key(search_query, year_range=None):
+    """Return the key of the manifest of the scrape of a query, or of one of
+    its ranges of publication years, which is scraped apart"""
+    return search_query if year_range is None \
+        else f'{search_query} [{year_range_label(year_range)}]'
+
+
+def page_params(search_query, start, num_results, year_range=(None, None)):
+    """Return the SerpApi parameters identifying a page of search results of
+    a query, in a range of publication years, either of which may be open"""
+    (year_low, year_high) = year_range
+    params = {'engine': 'google_scholar', 'q': search_query,
+              'start': start, 'num': num_results}
+    if year_low is not None:
+        params['as_ylo'] = year_low
+    if year_high is not None:
+        params['as_yhi'] = year_high
+    return params
+
+
+def _first_results(response, num_results):
+    """Return a response of SerpApi with only its first search results"""
+    if 'organic_results' not in response:
+        return response
+    return {**response, 'organic_results': response['organic_results'][:num_results]}
+
+
+def _new_output_file(base_output_dir, search_query, label=''):
+    """Create a new, empty output file for a query, named after the current
+    timestamp and the letters of the query (and the label, if any), with a
+    numbered suffix if another query (e.g. running concurrently) already has
+    that name"""
+    # Generate a timestamp string
+    timestamp = time.strftime('%Y-%m-%dT%H%M%S', time.localtime(time.time()))
+    # Clean out any non-alphanumeric characters in the query string to use as
+    # part of the output CSV file path
+    name = f'{timestamp}_{_non_letter_regex.sub('', search_query.lower())[:15]}{label}'
+    suffix = 1
+    while True:
+        output_file_path = p(base_output_dir /
+                             (f'{name}.csv' if suffix == 1 else f'{name}_{suffix}.csv'))
+        # Create the file only if it does not exist yet, atomically
+        try:
+            open(str(output_file_path), 'x').close()
+            return output_file_path
+        except FileExistsError:
+            suffix += 1
+
+
+def _finalise(output_file_path, manifest, output_format):
+    """Convert the CSV file of a finished scrape to the output format, if it is
+    another one, recording it in the manifest. Return the path of the output file"""
+    if output_format == 'csv' or file_format(output_file_path) == output_format:
+        return output_file_path
+    final_path = output_file_path.with_suffix(f'.{output_format}')
+    convert(output_file_path, final_path)
+    manifest.converted(final_path.name)
+    output_file_path.unlink()
+    return final_path
+
+
+def _reopen_as_csv(output_file_path, manifest):
+    """Convert the output file of a finished scrape back to CSV, so the pages
+    of the search results which are now also wanted can be appended to it.
+    Return the path of the CSV file"""
+    csv_path = output_file_path.with_suffix('.csv')
+    next_start = manifest.next_start()
+    convert(output_file_path, csv_path)
+    # Start a new manifest, keeping where the scrape should resume from
+    manifest.begin(csv_path.name)
+    if next_start > 0:
+        manifest.page_saved(next_start - global_vars.default_serp_max_results,
+                            csv_path.stat().st_size)
+    output_file_path.unlink()
+    return csv_path
+
+
+def scrape_google_scholar(serp_api_key, search_query, max_results, base_output_dir, verbose,
+                          concurrency=global_vars.default_concurrency,
+                          rate_limit=global_vars.default_serp_rate_limit, cache=None,
+                          api_url=global_vars.serp_api_url,
+                          output_format=global_vars.default_output_format, budget=None,
+                          request_slots=None, on_rows=None, seen=None, narrow_years=False,
+                          archive=None, store=None, year_range=None, cancel=None,
+                          first_page=None):
     """Method to scrape Google Scholar via a query using SerpApi and return the
-    path of the file where the results were saved."""
-    # Pre-allocate an array of size max_results for better performance
-    results = [None] * max_results
-
-    def _process_queries():
-        """Process the queries"""
-        # The maximum number of search results returnable by SerpApi is set in a global variable,
-        # so divide the desired total number of search results for the query into
-        # batches of at most the maximum results of a SerpApi query.
-        for i in range(math.ceil(max_results / global_vars.default_serp_max_results)):
-            # We define which search results we want based on the batch index
-            # and the number of maximum results for SerpApi
-            start = i * global_vars.default_serp_max_results
-            # Also specify how many results we actually want to request from SerpApi,
-            # which is normally the maximum, except when the last batch is smaller
-            # than the maximum
-            num_results = min(max_results - start,
-                              global_vars.default_serp_max_results)
-
-            # Set up a variable to check if we should run a Serp API query with
-            # the cache disabled
-            no_cache = False
-
-            attempt = 0
-
-            # Attempt the query as many times as we have set
-            while attempt < global_vars.max_attempts:
-                def perform_no_cache_query(no_cache, fewer=False):
-                    """Handle the performance of a no cache query,
-                    providing warning error messages to the users"""
-                    # If we had already tried with no cache, there are no
-                    # more search results, so inform the user
-                    if no_cache:
-                        print(
-                            '\nWarning! No more search results found with the uncached query. Terminating search')
-                        print(
-                            f'Query: {search_query}. Total results found: {len([x for x in results if x is not None])}')
-                        # Return that we should stop attempting more searches
-                        return True
-                    # Inform the user
+    path of the file where the results were saved. Each page of results is
+    saved to a CSV file as soon as it is available, so an interrupted scrape
+    resumes from the first missing page when run again with the same output
+    directory, and the file is converted to the output format once finished.
+    The SerpApi search URL can be replaced (e.g. by a local stand-in server).
+    Searches are reserved from the credit budget, if any, and the requests
+    wait for the request slots shared with other queries, if any. If on_rows is
+    given, it is called with the rows of every page once they are saved (e.g.
+    to look up their DOIs while the scrape goes on). If a store of seen search
+    results is given, the scrape is incremental: only the search results not
+    seen by a previous run of the query are saved, to a delta file, and the
+    paging stops at the first page without new search results. If
+    narrow_years is also set, only publications from the year of the last run
+    of the query onwards are searched. If an archive is given, the raw
+    SerpApi responses are appended to it. If a result store is given, the
+    rows of every page are also stored in it, in batches of pages, replacing
+    the ranks of any previous run of the query. The API key can also be a
+    pool of keys (a KeyPool) to spread the searches across, which goes on with
+    the other keys when one of them is rejected or runs out of searches. If a
+    year range is given (a tuple of the first and last year, either of which
+    may be None), only the publications of those years are searched, and the
+    scrape has its own manifest and output file, apart from the other ranges
+    of the same query. If a cancel event is given and gets set, no more pages
+    are requested or saved, and ScrapeCancelled is raised once the requests in
+    flight finish. If first_page is given (the response of the first page of
+    the query, already requested, e.g. to count its search results), it is
+    used instead of requesting the first page again."""
+    # Read the manifest of any previous scrape of this query (and year range)
+    # in the output directory
+    manifest = ScrapeManifest(base_output_dir, manifest_key(search_query, year_range))
+    output_file_path = p(base_output_dir / manifest.output_file_name) \
+        if manifest.output_file_name else None
+
+    # If there is no previous scrape to resume, start a new output file
+    if (output_file_path is None or not output_file_path.is_file()):
+        output_file_path = _new_output_file(
+            base_output_dir, search_query, '_delta' if seen is not None
+            else f'_{year_range_label(year_range)}' if year_range is not None else '')
+        manifest.begin(output_file_path.name)
+        # The ranks of a previous run of the query no longer apply
+        if store is not None:
+            store.begin_query(search_query)
+    # If the previous scrape already obtained all the search results, we are done
+    elif (manifest.ended or manifest.next_start() >= max_results):
+        if (verbose):
+            print(
+                f'\nQuery already scraped in {output_file_path.name}. Skipping.')
+        if seen is not None:
+            seen.finish_run(search_query)
+        return _finalise(output_file_path, manifest, output_format)
+    else:
+        if (verbose):
+            print(
+                f'\nResuming the scrape in {output_file_path.name} from result {manifest.next_start()}')
+        # Pages can only be appended to CSV files
+        if (file_format(output_file_path) != 'csv'):
+            output_file_path = _reopen_as_csv(output_file_path, manifest)
+
+    # Open the CSV file to save the results into, discarding anything written
+    # after the last page recorded in the manifest (e.g. if there was a crash)
+    csvfile = open(str(output_file_path), 'a+', newline='', encoding='utf-8')
+    csvfile.truncate(manifest.offset)
+    # Set the field names as defined in global variables
+    fieldnames = [global_vars.author_key, global_vars.pub_year_key,
+                  global_vars.title_key, global_vars.scholar_link_key, global_vars.pub_url_key, global_vars.gs_rank_key, global_vars.num_citations_key]
+    # A new writer object to handle the writing of the file
+    writer = csv.DictWriter(
+        csvfile, fieldnames=fieldnames, delimiter=',')
+    # Write the header of the CSV first, if it is a new file
+    if manifest.offset == 0:
+        writer.writeheader()
+
+    # In incremental mode, only search the publications from the year of the
+    # last run of the query onwards, if requested
+    year_low = seen.last_run_year(search_query) \
+        if seen is not None and narrow_years else None
+    if (verbose and year_low is not None):
+        print(f'\nSearching publications from {year_low} onwards: {search_query}')
+    # Otherwise, only search the publications of the year range, if any
+    year_high = None
+    if year_range is not None:
+        (year_low, year_high) = year_range
+
+    # Spread the requests across the keys of the pool, each with a single
+    # rate limiter shared between all the requests using it
+    key_pool = serp_api_key if isinstance(serp_api_key, KeyPool) \
+        else KeyPool([serp_api_key], rate_limit)
+    # Share a single retry engine (and circuit breaker) between all the SerpApi requests
+    retrier = get_retrier('SerpApi')
+
+    # Lock protecting the state shared between the concurrent batches
+    state_lock = threading.Lock()
+    # Condition passing the saved rows on in order, outside the state lock
+    handoff = threading.Condition()
+    # Start of the first batch that ran out of search results. Any batch
+    # starting after it does not need to be requested. The saved pages not
+    # recorded in the manifest yet, and the number of handoffs of saved rows
+    # numbered and done (the latter protected by the handoff condition)
+    state = {'end_start': max_results, 'failed': False, 'errors': [], 'scraped': 0,
+             'unrecorded': [], 'handoffs': 0, 'next_handoff': 0,
+             'next_start': manifest.next_start()}
+    # Pages of search results obtained but not saved yet, because an earlier
+    # page is still being requested. Pages are saved strictly in order
+    pages = {}
+
+    def _record_pages():
+        """Record the saved pages not recorded yet in the manifest. The state
+        lock must be held"""
+        for (start, offset, end) in state['unrecorded']:
+            manifest.page_saved(start, offset, end)
+        state['unrecorded'].clear()
+
+    def _should_skip(start):
+        """Check whether a batch no longer needs to be requested because
+        search results ran out earlier or another batch failed"""
+        with state_lock:
+            return state['failed'] or start > state['end_start'] or \
+                (cancel is not None and cancel.is_set())
+
+    def _stop_at(start):
+        """Record that there are no more search results after this batch"""
+        with state_lock:
+            state['end_start'] = min(state['end_start'], start)
+
+    def _save_page(start, rows, end=False):
+        """Store the rows of a page of search results, and save every page
+        which is now next in order to the output file. The saved rows are then
+        passed on (e.g. to the DOI pipeline, which may block) without holding
+        the state lock, in the order of the pages"""
+        saved = []
+        with state_lock:
+            # Once cancelled, the output file may belong to someone else
+            if cancel is not None and cancel.is_set():
+                return
+            pages[start] = (rows, end)
+            state['scraped'] += len(rows)
+            get_metrics().increment('rows_scraped', len(rows))
+            while state['next_start'] in pages:
+                rows, end = pages.pop(state['next_start'])
+                # Write the results row-by-row
+                writer.writerows(rows)
+                csvfile.flush()
+                # Remember the saved search results for the next incremental run
+                if seen is not None:
+                    seen.add(search_query, [seen_key(x) for x in rows])
+                # Record the page in the manifest once its rows are saved. With
+                # a result store, which stores the pages in batches, the pages
+                # are only recorded once they are stored, so an interrupted
+                # scrape requests the others again
+                state['unrecorded'].append((state['next_start'], csvfile.tell(), end))
+                if store is None or store.add_rows(search_query, rows):
+                    _record_pages()
+                # Collect the saved rows to pass them on
+                if on_rows is not None:
+                    saved.append(rows)
+                state['next_start'] += global_vars.default_serp_max_results
+                # No page after the one where search results ran out is saved
+                if end:
+                    break
+            # Number the saved pages passed on, so they are passed on in order
+            if saved:
+                sequence = state['handoffs']
+                state['handoffs'] += 1
+            # If verbose logging was requested, provide constant information
+            if (verbose):
+                print(f'\n{state['scraped']} {"new " if seen is not None else ""}entries scraped')
+        if not saved:
+            return
+        # Pass the saved rows on once the earlier pages were passed on
+        with handoff:
+            handoff.wait_for(lambda: state['next_handoff'] == sequence)
+        try:
+            for rows in saved:
+                on_rows(rows)
+        finally:
+            with handoff:
+                state['next_handoff'] += 1
+                handoff.notify_all()
+
+    def _process_batch(start, num_results):
+        """Process a single batch of search results. Return False if we ran
+        out of retry attempts (or hit a permanent error) and True otherwise"""
+        # Set up a variable to check if we should run a Serp API query with
+        # the cache disabled
+        no_cache = False
+
+        # Keep querying until we obtain the page, possibly after an uncached
+        # search. Retries of failed requests are handled by the retry engine
+        while True:
+            # If search results ran out in an earlier batch, or another batch
+            # failed, there is no point in requesting this one
+            if _should_skip(start):
+                return True
+
+            def perform_no_cache_query(no_cache, fewer=False):
+                """Handle the performance of a no cache query,
+                providing warning error messages to the users"""
+                # If we had already tried with no cache, there are no
+                # more search results, so inform the user
+                if no_cache:
                     print(
-                        f'\nSerpApi returned {"fewer results than required" if fewer else "no results"}. Trying an uncached search.')
+                        '\nWarning! No more search results found with the uncached query. Terminating search')
                     print(
-                        f'Query: {search_query}. Total results found: {len([x for x in results if x is not None])}')
-                    # Return that we should not stop attempting more searches
-                    return False
-
-                # Try to query the API
-                try:
-                    # URL encode the search query we want to use to search Google Scholar with
-                    clean_query = parse.quote_plus(search_query)
-                    # Build the query URL
-                    url = f'https://serpapi.com/search?engine=google_scholar&api_key={serp_api_key}' +\
-                        f'&start={start}&num={num_results}&q={clean_query}'
-                    url = f'{url}&no_cache=true' if no_cache else url
-                    # Process the response
-                    with request.urlopen(url) as response:
-                        # Store the JSON response into a dictionary
-                        search_results = json.loads(response.read())
-                        # If there were no results returned, try again once with
-                        # an uncached query
-                        if ('organic_results' not in search_results):
-                            no_more_attempts = perform_no_cache_query(no_cache)
-                            # If we should not attempt again, exit the method
-                            if no_more_attempts:
-                                return
-                            # Otherwise, set the next search to be uncached
-                            no_cache = True
-                            # Continue to the next attempt without increasing
-                            # the number of attempts
-                            continue
-                        no_cache = False
-                        # We only care about the 'organic_results' property, so
-                        # overwrite the search_results variable with it
-                        search_results = search_results['organic_results']
-
-                        # Loop through the search results, keeping track of the index
-                        for (idx, result) in enumerate(search_results):
-                            # Parse the response object into string variables
-                            title = result['title']
-                            # From the array of authors, make a single semicolon-separated string
-                            authors = '; '.join(
-                                [x['name'] for x in result['publication_info']['authors'][:]])
-                            # There is no actual property for the year, we need to
-                            # awkwardly parse it from the publication info summary
-                            # by using a regex search for what would likely be the year
-                            regex = re.compile(r'.*, (\d{4}) - .*')
-                            pub_year = re.match(regex,
-                                                result['publication_info']['summary'])
-                            pub_year = '' if pub_year is None else pub_year.groups(
-                            )[-1]
-
-                            # If the search result does not have an external link, the index
-                            # will not be accessible, so add it to the object with an empty string as value
-                            if (not ('link' in result)):
-                                result['link'] = ''
-                            # Generate the Google Scholar publication page link from the cluster ID value if available
-                            g_scholar_link = f'https://scholar.google.com/scholar?cluster={result['inline_links']['versions']['cluster_id']}' \
-                                if 'inline_links' in result and 'versions' in result['inline_links'] and 'cluster_id' in result['inline_links']['versions'] \
-                                else ''
-                            # Generate the number of citations from the respective property if available
-                            num_citations = result['inline_links']['cited_by']['total'] \
-                                if 'inline_links' in result and 'cited_by' in result['inline_links'] and 'total' in result['inline_links']['cited_by'] \
-                                else 0
-
-                            # Store the variables in the search results array
-                            # using the global variables for the column names
-                            results[start + idx] = {
-                                global_vars.author_key: authors,
-                                global_vars.pub_year_key: pub_year,
-                                global_vars.title_key: title,
-                                global_vars.scholar_link_key: g_scholar_link,
-                                global_vars.pub_url_key: result['link'],
-                                global_vars.gs_rank_key: start + result['position'],
-                                global_vars.num_citations_key: num_citations
-                            }
-
-                        # If verbose logging was requested, provide constant information
+                        f'Query: {search_query}. Total results found: {state['scraped']}')
+                    # Return that we should stop attempting more searches
+                    return True
+                # Inform the user
+                print(
+                    f'\nSerpApi returned {"fewer results than required" if fewer else "no results"}. Trying an uncached search.')
+                print(
+                    f'Query: {search_query}. Total results found: {state['scraped']}')
+                # Return that we should not stop attempting more searches
+                return False
+
+            # Try to query the API
+            try:
+                # The parameters identifying the requested page of search results
+                params = page_params(search_query, start, num_results, (year_low, year_high))
+                # Use the first page already requested, if any, keeping only
+                # the search results wanted
+                if start == 0 and first_page is not None and not no_cache:
+                    cached = (_first_results(first_page, num_results), False)
+                # Use the locally cached response for these parameters if there
+                # is one, unless we are specifically performing an uncached search
+                else:
+                    cached = cache.get(params) \
+                        if cache is not None and not no_cache else None
+                    if cache is not None and not no_cache:
+                        get_metrics().increment('cache_lookups', cache='serpapi',
+                                                result='miss' if cached is None else 'hit')
+                # If the cached response was itself obtained with an uncached
+                # search, treat it as such so missing results are not retried
+                if cached is not None:
+                    search_results, no_cache = cached
+                # Otherwise, query SerpApi
+                else:
+                    def request(key, rate_limiter, no_cache=no_cache):
+                        """Request the page with a key of the pool"""
+                        # Build the query URL, URL encoding the search query we want
+                        # to use to search Google Scholar with
+                        url = f'{api_url}?' + \
+                            parse.urlencode({**params, 'api_key': key})
+                        url = f'{url}&no_cache=true' if no_cache else url
+                        return _fetch_json(url, rate_limiter, budget, request_slots)
+                    # Perform the request, retrying it on transient errors
+                    search_results = retrier.call(key_pool.call, request)
+                    # Store the response locally, replacing any previous entry
+                    # (e.g. when this was an uncached search)
+                    if cache is not None:
+                        cache.put(params, search_results, no_cache)
+                    # Keep the raw response, to parse it again offline
+                    if archive is not None:
+                        archive.append(params, search_results, no_cache)
+                # If there were no results returned, try again once with
+                # an uncached query
+                if ('organic_results' not in search_results):
+                    no_more_attempts = perform_no_cache_query(no_cache)
+                    # If we should not attempt again, stop any later
+                    # batches and exit the method
+                    if no_more_attempts:
+                        _stop_at(start)
+                        _save_page(start, [], end=True)
+                        return True
+                    # Otherwise, set the next search to be uncached
+                    no_cache = True
+                    # Continue to the next attempt without increasing
+                    # the number of attempts
+                    continue
+                # We only care about the 'organic_results' property, so
+                # overwrite the search_results variable with it
+                search_results = search_results['organic_results']
+
+                # Parse the search results into the rows of this page
+                rows = [_parse_result(result, start) for result in search_results]
+
+                # In incremental mode, only keep the search results not seen
+                # by a previous run, and stop paging at the first page
+                # without any new ones
+                if seen is not None:
+                    page_keys = [seen_key(x) for x in rows]
+                    known = seen.known(search_query, page_keys)
+                    new_rows = []
+                    for (key, row) in zip(page_keys, rows):
+                        if key not in known:
+                            new_rows.append(row)
+                            # Skip the duplicates within the page
+                            known.add(key)
+                    get_metrics().increment('rows_known', len(rows) - len(new_rows))
+                    if rows and not new_rows:
                         if (verbose):
                             print(
-                                f'\n{len([x for x in results if x is not None])} entries scraped')
-
-                        # In the rare case that we ran out of search results before
-                        # reaching our desired number of results, try to perform
-                        if idx + 1 < num_results:
-                            no_more_attempts = perform_no_cache_query(
-                                no_cache, fewer=True)
-                            # If we should not attempt again, exit the method
-                            if no_more_attempts:
-                                return
-                            # Otherwise, set the next search to be uncached
-                            no_cache = True
-                            # Continue to the next attempt without increasing
-                            # the number of attempts
-                            continue
-
-                        # If we reach this point, the query was successful, so break from
-                        # the for loop, since we do not need to attempt the process again
-                        # and continue with the next batch
-                        break
-                # If there was an issue performing the query, inform the user and try again after 15 seconds
-                except Exception as e:
-                    print(f'\n{e}')
-                    print(
-                        f'\nThere was a problem scraping Google Scholar publications. Retrying in 15 seconds. Attempt {attempt + 1} of {global_vars.max_attempts}')
-                    attempt += 1
-                    time.sleep(15)
+                                f'\nNo new search results from result {start}. Stopping the incremental scrape: {search_query}')
+                        _stop_at(start)
+                        _save_page(start, [], end=True)
+                        return True
+                    rows = new_rows
+
+                # In the rare case that we ran out of search results before
+                # reaching our desired number of results, try to perform
+                if len(search_results) < num_results:
+                    no_more_attempts = perform_no_cache_query(
+                        no_cache, fewer=True)
+                    # If we should not attempt again, stop any later
+                    # batches and exit the method
+                    if no_more_attempts:
+                        _stop_at(start)
+                        _save_page(start, rows, end=True)
+                        return True
+                    # Otherwise, set the next search to be uncached
+                    no_cache = True
+                    # Continue to the next attempt without increasing
+                    # the number of attempts
                     continue
-            # If we finished the for loop, we ran out of retry attempts. Inform the user and exit
-            else:
+
+                # Save the rows of the page
+                _save_page(start, rows)
+
+                # If we reach this point, the query was successful, so break from
+                # the loop, since we do not need to attempt the process again
+                # and continue with the next batch
+                break
+            # If there was a permanent issue performing the query, or we ran
+            # out of retry attempts, inform the user and signal every other
+            # batch to stop
+            except Exception as e:
+                print(f'\n{e}')
                 print(
-                    'Too many failed attempts at scraping Google Scholar. Please check your API key and try again.')
-                exit(500)
+                    f'\nThere was a problem scraping Google Scholar publications (results {start} to {start + num_results}).')
+                with state_lock:
+                    state['failed'] = True
+                    state['errors'].append(e)
+                return False
 
-    # Run the method to process the queries
-    _process_queries()
+        # The batch was processed successfully
+        return True
 
-    # Remove any empty elements in the results array
-    # (present if the search results obtained were fewer than the max desired)
-    results = [x for x in results if x is not None]
+    # The maximum number of search results returnable by SerpApi is set in a global variable,
+    # so divide the desired total number of search results for the query into
+    # batches of at most the maximum results of a SerpApi query.
+    # Pages already saved by a previous scrape of the query are skipped.
+    batches = []
+    for i in range(manifest.next_start() // global_vars.default_serp_max_results,
+                   math.ceil(max_results / global_vars.default_serp_max_results)):
+        # We define which search results we want based on the batch index
+        # and the number of maximum results for SerpApi
+        start = i * global_vars.default_serp_max_results
+        # Also specify how many results we actually want to request from SerpApi,
+        # which is normally the maximum, except when the last batch is smaller
+        # than the maximum
+        num_results = min(max_results - start,
+                          global_vars.default_serp_max_results)
+        batches.append((start, num_results))
 
-    # Generate a timestamp string
-    timestamp = time.strftime('%Y-%m-%dT%H%M%S', time.localtime(time.time()))
-    # Clean out any non-alphanumeric characters in the query string to use as
-    # part of the output CSV file path
-    regex = re.compile('[^a-zA-Z]')
-    output_file_path = p(base_output_dir /
-                         f'{timestamp}_{regex.sub('', search_query.lower())[:15]}.csv')
-
-    # Create this CSV file and save the results into it
-    with open(str(output_file_path), 'w', newline='', encoding='utf-8') as csvfile:
-        # Set the field names as defined in global variables
-        fieldnames = [global_vars.author_key, global_vars.pub_year_key,
-                      global_vars.title_key, global_vars.scholar_link_key, global_vars.pub_url_key, global_vars.gs_rank_key, global_vars.num_citations_key]
-        # A new writer object to handle the writing of the file
-        writer = csv.DictWriter(
-            csvfile, fieldnames=fieldnames, delimiter=',')
-        # Write the header of the CSV first
-        writer.writeheader()
-        # Write the results row-by-row
-        for i in range(len(results)):
-            writer.writerow(results[i])
+    # Process the batches concurrently, with at most `concurrency` requests in
+    # flight at a time. Pages are saved to the output file in order as they
+    # complete. Incremental scrapes request their pages one at a time, so no
+    # searches are spent on pages after the first one without new results
+    try:
+        with ThreadPoolExecutor(max_workers=1 if seen is not None else max(concurrency, 1)) as executor:
+            # Each batch runs with a copy of the context, so its metrics are
+            # attributed to this query
+            futures = [executor.submit(contextvars.copy_context().run, _process_batch,
+                                       start, num_results)
+                       for (start, num_results) in batches]
+            # Wait for all the batches to finish, raising any unexpected error
+            for future in futures:
+                future.result()
+    finally:
+        csvfile.close()
+        # Store the pages still buffered by the result store, and record them,
+        # unless the output file may belong to someone else
+        if store is not None and not (cancel is not None and cancel.is_set()):
+            store.flush()
+            with state_lock:
+                _record_pages()
+
+    # If the scrape was cancelled, the pages saved so far are left as they are
+    if cancel is not None and cancel.is_set():
+        raise ScrapeCancelled(f'The scrape was cancelled: {search_query}')
+
+    # If we ran out of retry attempts for any of the batches, inform the user
+    # and exit. The pages already obtained are kept in the output file
+    if state['failed']:
+        exit_on_errors(state['errors'],
+                       f'The results obtained so far were saved in {output_file_path.name}.')
+
+    # Record the end of the incremental run of the query
+    if seen is not None:
+        seen.finish_run(search_query)
 
-    # Return the file path where we stored the results as a Path object
-    return output_file_path
+    # Return the file path where we stored the results as a Path object,
+    # converted to the output format
+    return _finalise(output_file_path, manifest, output_format)
@@ -1,17 +1,31 @@
 import time
 from pathlib import Path as p
-import pandas as pd
 import csv
+import hashlib
+import sqlite3
+import tempfile
 from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.result_files import read_fieldnames, read_rows, RowWriter
 from sys import exit
-from tkinter.filedialog import askdirectory, askopenfilename
+
+
+def _filedialog():
+    """Import the tkinter file dialogs, only when an interactive picker is
+    used, exiting with an error if tkinter is not available (e.g. on headless
+    machines)"""
+    try:
+        from tkinter import filedialog
+    except ImportError:
+        print(f'\nError: The interactive pickers need tkinter, which is not available. The program will now close.')
+        exit(406)
+    return filedialog
 
 
 def select_dir():
     """Open a directory selection dialog"""
 
     # Use the askdirectory function to open a directory selection dialog
-    dir_path = askdirectory(mustexist=True)
+    dir_path = _filedialog().askdirectory(mustexist=True)
 
     # If no directory was selected, print an error and exit the program
     if dir_path == '':
@@ -27,7 +41,7 @@ def _select_query_file():
 
     # Use the askopenfilename function to open a file selection dialog,
     # specifying the file types to filter the selection, and store it in a variable
-    file_path = askopenfilename(
+    file_path = _filedialog().askopenfilename(
         filetypes=[('Comma-separated values', '.csv')])
 
     # If no file was select, print an error and exit the program
@@ -51,12 +65,14 @@ def _select_query_file():
 
 
 def parse_queries(query_string, max_results, query_file, interactive_query_file_picker):
-    """Parse the queries for the searches"""
+    """Parse the queries for the searches, returning a list of tuples of each
+    query, its maximum number of results, and its priority (higher priority
+    queries run first)"""
 
     # If the query_string is set (and the user did not request the interactive
     # query file picker), use that rather than a file
     if (query_string and query_string.strip() and not interactive_query_file_picker):
-        return [(query_string, max_results)]
+        return [(query_string, max_results, 0)]
     # Otherwise, create an empty array of queries
     else:
         parsed_queries = []
@@ -71,7 +87,13 @@ def parse_queries(query_string, max_results, query_file, interactive_query_file_
 
             # Create a sniffer object to check if the CSV file is likely to have a header
             sniffer = csv.Sniffer()
-            has_header = sniffer.has_header(csvfile.read(1024))
+            # The sniffer cannot tell when rows have different numbers of
+            # columns (e.g. only some queries with a priority), so assume
+            # there is no header then
+            try:
+                has_header = sniffer.has_header(csvfile.read(1024))
+            except csv.Error:
+                has_header = False
             # Return the buffer to the start so we can read the file properly again
             csvfile.seek(0)
             # Create a CSV reader object
@@ -85,12 +107,14 @@ def parse_queries(query_string, max_results, query_file, interactive_query_file_
             for row in reader:
                 # Check if the row is not either empty or starts with a pound sign (#)
                 if (row[0].strip() and row[0].strip()[0] != '#'):
-                    # Set the query's max results to the default for now
+                    # Set the query's max results and priority to the
+                    # defaults for now
                     query_max_results = max_results
+                    query_priority = 0
                     # If soe, store the query into a variable
                     query = row[0].strip()
                     # If the number of maximum search results for the query was specified
-                    if (len(row) > 1):
+                    if (len(row) > 1 and row[1].strip()):
                         # Try to convert it to an int
                         try:
                             query_max_results = int(row[1].strip())
@@ -107,41 +131,102 @@ def parse_queries(query_string, max_results, query_file, interactive_query_file_
                                 f'\nWarning: There was a problem reading the maximum number of results ("{query_max_results}") for query "{query}". ' +
                                 'This query will be ignored and the program will continue, or press Ctrl+C to cancel the search and try again.')
                             continue
-                    # If there was no error, add the query and the max results
-                    # to get from it to our array of parsed queries
-                    parsed_queries.append((query, query_max_results))
+                    # If the priority of the query was specified, try to
+                    # convert it to an int, or ignore it with a warning
+                    if (len(row) > 2 and row[2].strip()):
+                        try:
+                            query_priority = int(row[2].strip())
+                        except ValueError:
+                            print(
+                                f'\nWarning: There was a problem reading the priority ("{row[2].strip()}") for query "{query}". The default priority will be used.')
+                    # If there was no error, add the query, the max results
+                    # to get from it and its priority to our array of parsed queries
+                    parsed_queries.append(
+                        (query, query_max_results, query_priority))
         # Return the array of parsed queries
         return parsed_queries
 
 
-def merge_search(output_files, output_dir, verbose):
-    """Merge the various files from each individual query into a single file"""
-    # Initialise an empty array of Pandas dataframes
-    dfs = [None] * len(output_files)
+class _SeenKeys:
+    """Compact set of the hashes of the deduplication keys already seen. It is
+    kept in memory until it grows beyond a set number of keys, at which point
+    it is spilled to a temporary on-disk SQLite database so memory stays bounded"""
+
+    def __init__(self):
+        self._keys = set()
+        self._conn = None
+        self._temp_dir = None
+
+    def add(self, key):
+        """Add a key, returning True if it had not been seen before"""
+        digest = hashlib.blake2b(
+            '\x1f'.join(key).encode('utf-8'), digest_size=16).digest()
+        # If the keys were spilled to disk, check and insert them there
+        if self._conn is not None:
+            return self._conn.execute('INSERT OR IGNORE INTO seen VALUES (?)', (digest,)).rowcount == 1
+        if digest in self._keys:
+            return False
+        self._keys.add(digest)
+        # If there are too many keys to keep in memory, spill them to disk
+        if len(self._keys) > global_vars.merge_max_keys_in_memory:
+            self._temp_dir = tempfile.TemporaryDirectory()
+            self._conn = sqlite3.connect(
+                str(p(self._temp_dir.name) / 'seen.sqlite3'))
+            self._conn.executescript("""PRAGMA journal_mode = OFF;
+                PRAGMA synchronous = OFF;
+                CREATE TABLE seen (key BLOB PRIMARY KEY) WITHOUT ROWID;""")
+            self._conn.executemany(
+                'INSERT INTO seen VALUES (?)', ((x,) for x in self._keys))
+            self._keys = set()
+        return True
+
+    def close(self):
+        """Remove any temporary on-disk storage"""
+        if self._conn is not None:
+            self._conn.close()
+            self._temp_dir.cleanup()
+
+
+def merge_search(output_files, output_dir, verbose,
+                 output_format=global_vars.default_output_format):
+    """Merge the various files from each individual query (in any format) into
+    a single file of the output format, streaming the files row by row so
+    memory stays bounded, and return its path"""
     # If we want verbose logging, print out the files we're merging
     if (verbose):
-        print(f'\nMerging {len(output_files)} .csv files.')
-    # Iterate through our files in the output directory
-    for (idx, filename) in enumerate(output_files):
-        # Read the CSV as a dataframe and append it to our array
-        df = pd.read_csv(str(filename), dtype=str)
-        dfs[idx] = (df)
-
-    # Merge our dataframes and store them in full_df
-    full_df = pd.concat(dfs, ignore_index=True, keys=None, sort=False)
-    # Remove any duplicates if they have the same authors, publication year, and title
-    merged_df = pd.DataFrame.drop_duplicates(
-        full_df, subset=[global_vars.author_key, global_vars.pub_year_key, global_vars.title_key], ignore_index=True)
+        print(f'\nMerging {len(output_files)} files.')
+
+    # Read only the headers of every file to obtain all the columns of the
+    # merged file, in the order they first appear
+    fieldnames = []
+    for filename in output_files:
+        for field in read_fieldnames(filename):
+            if field not in fieldnames:
+                fieldnames.append(field)
 
     # Get the current timestamp
     timestamp = time.strftime('%Y-%m-%dT%H%M%S', time.localtime(time.time()))
 
     # Define the output file path
-    output_file_path = p(output_dir / f'merged_{timestamp}.csv')
-
-    # convert the merged dataframe to a CSV and store it in the output file path location
-    merged_df.to_csv(str(output_file_path), index=False)
+    output_file_path = p(output_dir / f'merged_{timestamp}.{output_format}')
+
+    # Set of the keys of the rows already written
+    seen = _SeenKeys()
+    with RowWriter(output_file_path, fieldnames, output_format) as writer:
+        # Iterate through our files in the output directory
+        for filename in output_files:
+            for row in read_rows(filename):
+                # Remove any duplicates if they have the same authors,
+                # publication year, and title, keeping the first one
+                if seen.add((row.get(global_vars.author_key) or '',
+                             row.get(global_vars.pub_year_key) or '',
+                             row.get(global_vars.title_key) or '')):
+                    writer.writerow(row)
+    seen.close()
 
     # If verbose, signal completion
     if (verbose):
         print(f'\nMerging complete: file {str(output_file_path)} saved.')
+
+    # Return the file path where we stored the merged results as a Path object
+    return output_file_path
@@ -0,0 +1,428 @@
+import argparse
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path as p
+from sys import exit
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.serp_query import scrape_google_scholar, SerpCache
+from google_scholar_scraper.serp_query.serp_query import ScrapeCancelled
+from google_scholar_scraper.serp_query.credit_budget import CreditBudget
+from google_scholar_scraper.serp_query.key_pool import KeyPool, load_keys
+from google_scholar_scraper.crossref_query.crossref_query import crossref_query
+from google_scholar_scraper.crossref_query.doi_cache import DoiCache
+from google_scholar_scraper.scheduler import plan_queries
+from google_scholar_scraper.utils import merge_search, parse_queries
+
+# Sharded execution of large query files: the queries are put in a work queue
+# stored in an SQLite file on storage shared by every worker, each worker
+# (a process, on any host) claims one query at a time with a lease, scrapes it
+# and looks up its DOIs into the shared output directory, and a coordinator
+# merges the files of every query once they are all done
+
+
+class WorkQueue:
+    """Queue of the queries of a sharded scrape, stored in an SQLite file.
+    Queries are claimed atomically, in order of priority, with a lease which
+    the worker renews while it works on the query. A query whose lease expired
+    (e.g. because its worker crashed) can be claimed by another worker, which
+    resumes its scrape from the pages already saved. A query which failed too
+    many times is left as failed."""
+
+    def __init__(self, queue_path, max_attempts=global_vars.queue_max_attempts):
+        self.max_attempts = max_attempts
+        p(queue_path).parent.mkdir(exist_ok=True, parents=True)
+        # A single connection per process, protected by a lock for the lease
+        # renewal thread. Other processes are handled by SQLite's own locking
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(queue_path), timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                query TEXT NOT NULL UNIQUE,
+                max_results INTEGER NOT NULL,
+                priority INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                output_file TEXT,
+                error TEXT)""")
+            # Index used to find the next query to claim
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority, position)')
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL)""")
+
+    def add(self, plan, output_format=global_vars.default_output_format):
+        """Add the planned queries to the queue, keeping the queries already
+        in it, and record the format of the output files. Return the number of
+        queries added"""
+        with self._lock, self._conn:
+            start = self._conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+            cursor = self._conn.executemany(
+                'INSERT OR IGNORE INTO jobs (query, max_results, priority, position) VALUES (?, ?, ?, ?)',
+                [(x['query'], x['max_results'], x['priority'], start + x['index']) for x in plan])
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('output_format', ?)",
+                               (output_format,))
+        return cursor.rowcount
+
+    def output_format(self):
+        """Return the format of the output files of the queue"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'output_format'").fetchone()
+        return row[0] if row else global_vars.default_output_format
+
+    def claim(self, worker, lease=global_vars.queue_lease):
+        """Claim the next query in order of priority, either queued or whose
+        lease expired, for a lease in seconds. Return the (ID, query, maximum
+        number of results) tuple of the claimed query, or None if there is none"""
+        now = time.time()
+        with self._lock, self._conn:
+            # Queries whose lease expired too many times are left as failed
+            self._conn.execute("""UPDATE jobs SET status = 'failed', worker = NULL,
+                    error = 'The lease expired too many times'
+                WHERE status = 'claimed' AND lease_expires < ? AND attempts >= ?""",
+                               (now, self.max_attempts))
+            # A single statement, so no two workers can claim the same query
+            return self._conn.execute("""UPDATE jobs SET status = 'claimed', worker = ?,
+                    lease_expires = ?, attempts = attempts + 1
+                WHERE id = (SELECT id FROM jobs
+                    WHERE status = 'queued' OR (status = 'claimed' AND lease_expires < ?)
+                    ORDER BY priority DESC, position LIMIT 1)
+                RETURNING id, query, max_results""", (worker, now + lease, now)).fetchone()
+
+    def renew(self, job_id, worker, lease=global_vars.queue_lease):
+        """Extend the lease of a claimed query. Return False if the worker
+        lost it (e.g. it expired and another worker claimed the query)"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute("""UPDATE jobs SET lease_expires = ?
+                WHERE id = ? AND worker = ? AND status = 'claimed'""",
+                                        (time.time() + lease, job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, output_file):
+        """Record that a claimed query is done, and the name of its output
+        file. Return False if the worker no longer holds the lease of the query"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute("""UPDATE jobs SET status = 'done', output_file = ?,
+                    lease_expires = NULL
+                WHERE id = ? AND worker = ? AND status = 'claimed' AND lease_expires >= ?""",
+                                        (output_file, job_id, worker, time.time()))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error, retry=True):
+        """Record that a claimed query failed. It is queued again, unless it
+        failed too many times or should not be retried"""
+        with self._lock, self._conn:
+            self._conn.execute("""UPDATE jobs SET error = ?, worker = NULL, lease_expires = NULL,
+                    status = CASE WHEN ? AND attempts < ? THEN 'queued' ELSE 'failed' END
+                WHERE id = ? AND worker = ?""", (error, retry, self.max_attempts, job_id, worker))
+
+    def release(self, job_id, worker):
+        """Queue a claimed query again without counting the attempt (e.g. when
+        the worker stops because the budget was exhausted)"""
+        with self._lock, self._conn:
+            self._conn.execute("""UPDATE jobs SET status = 'queued', worker = NULL,
+                    lease_expires = NULL, attempts = attempts - 1
+                WHERE id = ? AND worker = ?""", (job_id, worker))
+
+    def counts(self):
+        """Return the number of queries of each status"""
+        with self._lock:
+            counts = dict(self._conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'))
+        return {x: counts.get(x, 0) for x in ('queued', 'claimed', 'done', 'failed')}
+
+    def failed(self):
+        """Return the (query, error) tuples of the failed queries"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT query, error FROM jobs WHERE status = 'failed' ORDER BY position").fetchall()
+
+    def output_files(self):
+        """Return the names of the output files of the queries which are done,
+        in the order of the query file"""
+        with self._lock:
+            return [x[0] for x in self._conn.execute(
+                "SELECT output_file FROM jobs WHERE status = 'done' ORDER BY position")]
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._conn.close()
+
+
+def _keep_lease(work_queue, job_id, worker, lease, stop, lost):
+    """Renew the lease of a claimed query until stopped, at a third of the
+    lease, so it only expires if the worker is gone. If the lease is lost
+    (e.g. the worker stalled and another one claimed the query), set the lost
+    event, so the work on the query is cancelled"""
+    while not stop.wait(lease / 3):
+        if not work_queue.renew(job_id, worker, lease):
+            print(f'\nWarning: worker {worker} lost the lease of query {job_id}. Cancelling it.')
+            lost.set()
+            return
+
+
+def run_worker(queue_path, serp_api_key, email, output_dir, cache_dir=None,
+               concurrency=global_vars.default_concurrency,
+               serp_rate_limit=global_vars.default_serp_rate_limit,
+               crossref_concurrency=global_vars.default_crossref_concurrency, no_doi=False,
+               monthly_budget=None, lease=global_vars.queue_lease, verbose=False,
+               serp_api_url=global_vars.serp_api_url,
+               crossref_api_url=global_vars.crossref_api_url):
+    """Claim the queries of a work queue one at a time, scraping each of them
+    and looking up its DOIs into the output directory, until every query is
+    done or failed. The API key can also be a pool of keys, as given on the
+    command line. Return the number of queries the worker completed"""
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    work_queue = WorkQueue(queue_path)
+    output_format = work_queue.output_format()
+    output_dir = p(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    # The local caches and the budget are shared with the other workers
+    # through SQLite's own locking, if they use the same cache directory
+    serp_cache = None if cache_dir is None else SerpCache(
+        cache_dir, global_vars.default_cache_ttl * 3600,
+        global_vars.default_cache_max_size * 1024 * 1024)
+    doi_cache = None if cache_dir is None or no_doi else DoiCache(cache_dir)
+    budget = None if monthly_budget is None else CreditBudget(cache_dir, monthly_budget)
+    # The searches left of the keys of a pool are also shared through the cache
+    key_pool = KeyPool(load_keys(serp_api_key), serp_rate_limit, cache_dir, serp_api_url, verbose)
+    completed = 0
+    try:
+        while True:
+            job = work_queue.claim(worker, lease)
+            if job is None:
+                # Wait for the queries claimed by other workers, in case their
+                # lease expires, and stop once there are none left
+                if not work_queue.counts()['claimed']:
+                    break
+                time.sleep(global_vars.queue_poll_interval)
+                continue
+            (job_id, query, max_results) = job
+            if (verbose):
+                print(f'\nWorker {worker} starting query {job_id}: {query}')
+            # Keep the lease while the query is being worked on, cancelling
+            # the scrape if it is lost
+            stop = threading.Event()
+            lost = threading.Event()
+            keeper = threading.Thread(target=_keep_lease,
+                                      args=(work_queue, job_id, worker, lease, stop, lost),
+                                      daemon=True)
+            keeper.start()
+            try:
+                output_file = scrape_google_scholar(
+                    key_pool, query, max_results, output_dir, verbose, concurrency,
+                    serp_rate_limit, serp_cache, serp_api_url, output_format, budget,
+                    cancel=lost)
+                # The file now belongs to the worker which claimed the query
+                # again, so its DOIs are left to it
+                if (not no_doi and not lost.is_set()):
+                    crossref_query(email, verbose, [output_file], crossref_concurrency,
+                                   doi_cache, api_url=crossref_api_url)
+            # If the lease was lost, the query is left to the worker which
+            # claimed it again
+            except ScrapeCancelled:
+                continue
+            # The scrape exits on errors: stop the worker if the budget is
+            # exhausted or no API key has searches left, leaving the query to
+            # resume later, and otherwise
+            # record the failure so the query is retried
+            except SystemExit as e:
+                if e.code == 402:
+                    work_queue.release(job_id, worker)
+                    print(f'\nWorker {worker} stopping: no SerpApi searches are left')
+                    break
+                # Every key was rejected, so no other query can be scraped
+                # either. The query is not retried, so it is not claimed again
+                # and again
+                if e.code == 401:
+                    work_queue.fail(job_id, worker, 'SerpApi rejected every API key',
+                                    retry=False)
+                    print(f'\nWorker {worker} stopping: SerpApi rejected every API key')
+                    break
+                work_queue.fail(job_id, worker, f'The scrape exited with code {e.code}')
+                continue
+            except Exception as e:
+                work_queue.fail(job_id, worker, str(e))
+                continue
+            # If the worker is interrupted, leave the query to another worker
+            except BaseException:
+                work_queue.release(job_id, worker)
+                raise
+            finally:
+                stop.set()
+                keeper.join()
+            # Only record the query as done if the lease is still held
+            if lost.is_set() or not work_queue.complete(job_id, worker, output_file.name):
+                print(f'\nWarning: worker {worker} lost the lease of query {job_id}. Leaving it to another worker.')
+                continue
+            completed += 1
+    finally:
+        work_queue.close()
+        for x in (serp_cache, doi_cache, budget, key_pool):
+            if x is not None:
+                x.close()
+    return completed
+
+
+def _print_counts(counts):
+    """Print the number of queries of each status"""
+    print('\nQueries: ' + ', '.join(f'{y} {x}' for (x, y) in counts.items()))
+
+
+def main():
+    """Command line interface to create a work queue, run workers pulling
+    queries from it, follow its progress, and merge its files"""
+    parser = argparse.ArgumentParser(prog='Google Scholar Scraper Work Queue',
+                                     description='Scrape large query files with several worker processes, on one or more hosts, sharing a work queue and an output directory on shared storage.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    init_parser = subparsers.add_parser('init', help='Create a work queue, or add queries to it.')
+    init_parser.add_argument('queue_file', help='The path of the SQLite file of the work queue.')
+    query_group = init_parser.add_mutually_exclusive_group(required=True)
+    query_group.add_argument('-f', '--query-file', help='Set the path of the query file to add.', type=str)
+    query_group.add_argument('-q', '--query-string', help='Set a single query to add.', type=str)
+    init_parser.add_argument('-m', '--max-results',
+                             help=f'Sets the default number of search results of each query. Default = {global_vars.default_max_results}.',
+                             default=global_vars.default_max_results, type=int)
+    init_parser.add_argument('--output-format',
+                             help=f'Sets the format of the files of search results (csv or parquet). Default = {global_vars.default_output_format}.',
+                             choices=['csv', 'parquet'], default=global_vars.default_output_format)
+
+    worker_parser = subparsers.add_parser('worker', help='Run workers claiming queries from a work queue until it is finished.')
+    worker_parser.add_argument('queue_file', help='The path of the SQLite file of the work queue.')
+    worker_parser.add_argument(
+        'serp_api_key', help='The API key for your SerpApi account to use to scrape Google Scholar data, or a pool of keys: the path of a file with one key per line, or env:NAME for an environment variable with comma-separated keys.')
+    worker_parser.add_argument(
+        'email', help='For faster Crossref API queries, we require an email address.')
+    worker_parser.add_argument('-p', '--processes',
+                               help='Sets the number of worker processes to run on this host. Default = 1.',
+                               default=1, type=int)
+    worker_parser.add_argument('-c', '--concurrency',
+                               help=f'Sets the number of SerpApi result pages each worker requests at the same time. Default = {global_vars.default_concurrency}.',
+                               default=global_vars.default_concurrency, type=int)
+    worker_parser.add_argument('--serp-rate-limit',
+                               help=f"""Sets the maximum number of SerpApi requests per second
+                               of each worker, so the total across all workers should
+                               stay within the limit of the API key.
+                               Default = {global_vars.default_serp_rate_limit}.""",
+                               default=global_vars.default_serp_rate_limit, type=float)
+    worker_parser.add_argument('-C', '--crossref-concurrency',
+                               help=f'Sets the number of Crossref DOI lookups each worker performs at the same time. Default = {global_vars.default_crossref_concurrency}.',
+                               default=global_vars.default_crossref_concurrency, type=int)
+    worker_parser.add_argument('-N', '--no-doi',
+                               help='Use this option to not look up the DOIs of the queries.',
+                               action='store_true')
+    worker_parser.add_argument('--lease',
+                               help=f"""Sets the number of seconds a claimed query is leased
+                               to a worker, renewed while the worker is alive.
+                               Default = {global_vars.queue_lease}.""",
+                               default=global_vars.queue_lease, type=float)
+    worker_parser.add_argument('--cache-dir',
+                               help="""Set the path for the directory of the local caches and
+                               budget, shared by the workers. By default, this is a
+                               'cache' folder next to the queue file.""",
+                               type=str)
+    worker_parser.add_argument('--no-local-cache',
+                               help='Use this option to bypass the local caches of SerpApi responses and DOIs.',
+                               action='store_true')
+    worker_parser.add_argument('--monthly-budget',
+                               help='Sets the maximum number of SerpApi searches to use per calendar month, across every worker using the same cache directory.',
+                               type=int)
+
+    status_parser = subparsers.add_parser('status', help='Show the progress of a work queue.')
+    status_parser.add_argument('queue_file', help='The path of the SQLite file of the work queue.')
+
+    merge_parser = subparsers.add_parser('merge', help='Merge the files of the finished queries of a work queue.')
+    merge_parser.add_argument('queue_file', help='The path of the SQLite file of the work queue.')
+    merge_parser.add_argument('--wait',
+                              help='Use this option to wait for the workers to finish every query before merging.',
+                              action='store_true')
+
+    for subparser in (worker_parser, merge_parser):
+        subparser.add_argument('-o', '--output-dir',
+                               help="""Set the path of the output directory shared by the
+                               workers. By default, this is an 'output' folder next to
+                               the queue file.""",
+                               type=str)
+    for subparser in (init_parser, worker_parser, status_parser, merge_parser):
+        subparser.add_argument('-v', '--verbose', help='Verbose logging mode.', action='store_true')
+    args = parser.parse_args()
+
+    queue_path = p(args.queue_file)
+    output_dir = p(args.output_dir) if getattr(args, 'output_dir', None) \
+        else queue_path.parent / 'output'
+    # Every command but init needs an existing queue
+    if args.command != 'init' and not queue_path.is_file():
+        print(f'\nError: no work queue found at {queue_path}')
+        exit(404)
+
+    if args.command == 'init':
+        parsed_queries = parse_queries(args.query_string, args.max_results, args.query_file, False)
+        # Merge the duplicate queries and order them by priority, as a run would
+        plan = plan_queries(parsed_queries, queue_path.parent / 'output')
+        work_queue = WorkQueue(queue_path)
+        added = work_queue.add(plan, args.output_format)
+        print(f'\n{added} queries added to {queue_path}')
+        _print_counts(work_queue.counts())
+        work_queue.close()
+
+    elif args.command == 'worker':
+        if min(args.processes, args.concurrency, args.crossref_concurrency) < 1 \
+                or args.serp_rate_limit <= 0 or args.lease <= 0:
+            print('\nError: the processes, concurrency values, SerpApi rate limit and lease must be greater than 0')
+            exit(406)
+        if args.monthly_budget is not None and args.no_local_cache:
+            print('\nError: the monthly budget is kept in the cache directory, so it cannot be used with --no-local-cache')
+            exit(406)
+        if not load_keys(args.serp_api_key):
+            print(f'\nError: no SerpApi API key found in {args.serp_api_key}')
+            exit(404)
+        cache_dir = None if args.no_local_cache else \
+            (args.cache_dir or str(queue_path.parent / 'cache'))
+        worker_args = (queue_path, args.serp_api_key, args.email, output_dir, cache_dir,
+                       args.concurrency, args.serp_rate_limit, args.crossref_concurrency,
+                       args.no_doi, args.monthly_budget, args.lease, args.verbose)
+        start_time = time.perf_counter()
+        # Run the workers of this host in their own processes
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            completed = sum(executor.map(run_worker, *zip(*[worker_args] * args.processes)))
+        print(f'\n{completed} queries completed by {args.processes} workers in {time.perf_counter() - start_time:.2f} s')
+
+    elif args.command == 'status':
+        work_queue = WorkQueue(queue_path)
+        _print_counts(work_queue.counts())
+        for (query, error) in work_queue.failed():
+            print(f'Failed: {query} ({error})')
+        work_queue.close()
+
+    elif args.command == 'merge':
+        work_queue = WorkQueue(queue_path)
+        counts = work_queue.counts()
+        # Wait for the queries which are not finished yet, if requested
+        while args.wait and (counts['queued'] or counts['claimed']):
+            time.sleep(global_vars.queue_poll_interval)
+            counts = work_queue.counts()
+        _print_counts(counts)
+        if counts['queued'] or counts['claimed']:
+            print('\nError: some queries are not finished yet. Run the merge again once they are, or with --wait')
+            exit(406)
+        if counts['failed']:
+            print(f'Warning: the {counts["failed"]} failed queries are left out of the merge')
+        output_files = [output_dir / x for x in work_queue.output_files()]
+        output_format = work_queue.output_format()
+        work_queue.close()
+        if output_files:
+            merge_search(output_files, output_dir, args.verbose, output_format)
+
+
+if __name__ == '__main__':
+    main()
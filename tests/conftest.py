@@ -0,0 +1,29 @@
+import pytest
+from google_scholar_scraper import rate_limiter, retry
+from google_scholar_scraper.benchmark import FakeApiServer
+
+
+@pytest.fixture(autouse=True)
+def shared_state(monkeypatch):
+    """Give every test its own rate limiters and retry engines, which are
+    otherwise shared by the whole process, retrying quickly"""
+    monkeypatch.setattr(rate_limiter, '_limiters', {})
+    monkeypatch.setattr(retry, '_retriers', {
+        name: retry.Retrier(name, base_delay=0.01, max_delay=0.05, breaker_cooldown=0.1)
+        for name in ('SerpApi', 'Crossref')})
+
+
+@pytest.fixture
+def fake_api():
+    """Return a function starting a local stand-in of SerpApi and Crossref
+    (see FakeApiServer), without latency unless given. The servers are
+    stopped at the end of the test"""
+    servers = []
+
+    def start(**kwargs):
+        servers.append(FakeApiServer(**{'latency': 0, **kwargs}).start())
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.stop()
@@ -0,0 +1,40 @@
+import httpx
+import pytest
+from google_scholar_scraper import http_transport
+from google_scholar_scraper.benchmark import run_benchmark
+
+
+def test_stand_in_server_answers_as_the_apis(fake_api):
+    server = fake_api(serp_results=100, result_cap=60, error_rate=0)
+    (page, _) = http_transport.get_json(server.serp_api_url,
+                                        params={'q': 'test query', 'start': 40, 'num': 20})
+    assert len(page['organic_results']) == 20
+    # The search results stop at the result cap
+    (page, _) = http_transport.get_json(server.serp_api_url,
+                                        params={'q': 'test query', 'start': 60, 'num': 20})
+    assert 'organic_results' not in page
+    # The search results can be narrowed to a range of years
+    (page, _) = http_transport.get_json(server.serp_api_url, params={
+        'q': 'test query', 'num': 20, 'as_ylo': 2000, 'as_yhi': 2001})
+    assert all(x['publication_info']['summary'].split(', ')[-1][:4] in ('2000', '2001')
+               for x in page['organic_results'])
+    (_, headers) = http_transport.get_json(f'{server.crossref_api_url}/works',
+                                           params={'query': 'test', 'rows': 1})
+    assert headers['X-Rate-Limit-Limit'] == str(server.crossref_rate_limit)
+
+
+def test_stand_in_server_fails_at_the_error_rate(fake_api):
+    server = fake_api(error_rate=1)
+    with pytest.raises(httpx.HTTPStatusError) as error:
+        http_transport.get_json(server.serp_api_url, params={'q': 'test query'})
+    assert error.value.response.status_code == 503
+    assert server.snapshot()['errors'] == 1
+
+
+def test_workloads_run_in_their_own_process():
+    results = run_benchmark(['scrape-1x1000', 'doi-500x20', 'pipeline-500x20'], scale=0.01,
+                            latency=0, error_rate=0)
+    assert [(x['workload'], x['queries'], x['rows'], x['errors']) for x in results] == \
+        [('scrape-1x1000', 1, 1000, 0), ('doi-500x20', 5, 100, 0), ('pipeline-500x20', 5, 100, 0)]
+    assert results[0]['pages'] == 50
+    assert all(x['elapsed'] > 0 for x in results)
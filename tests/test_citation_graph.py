@@ -0,0 +1,55 @@
+from google_scholar_scraper.citation_graph import CitationCrawler
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.result_files import read_columns
+
+# On the stand-in server, the search result with index idx is cited idx times
+# (below 100), so the 10 seeds are cited 0 to 9 times, and a fan-out of 5
+# keeps the first min(idx, 5) citing publications, cited 0 to 4 times each
+_first_level = [min(x, 5) for x in range(10)]
+_second_level = sum(sum(range(x)) for x in _first_level)
+# One search for the seeds, and a page per publication cited at least once
+_searches = 1 + sum(x > 0 for x in _first_level) + sum(x - 1 for x in _first_level if x)
+
+
+def _crawl(server, output_dir, max_credits=100):
+    """Crawl the citations of the first 10 search results of a query on the
+    stand-in server, 2 levels deep and up to 5 citing publications each.
+    Return whether the crawl is complete and the numbers of nodes and edges"""
+    crawler = CitationCrawler('key', output_dir, max_depth=2, fan_out=5,
+                              max_credits=max_credits, concurrency=4, rate_limit=1000,
+                              api_url=server.serp_api_url)
+    try:
+        crawler.seed_query('test query', 10)
+        complete = crawler.crawl()
+        crawler.write()
+        return (complete, crawler.state.counts())
+    finally:
+        crawler.close()
+
+
+def test_crawl_is_breadth_first(fake_api, tmp_path):
+    server = fake_api(serp_results=30)
+    (complete, (nodes, edges)) = _crawl(server, tmp_path)
+    assert complete
+    assert (nodes, edges) == (10 + sum(_first_level) + _second_level,
+                              sum(_first_level) + _second_level)
+    assert server.snapshot()['serp_requests'] == _searches
+    depths = read_columns(tmp_path / 'nodes.csv')[global_vars.depth_key]
+    assert depths == ['0'] * 10 + ['1'] * sum(_first_level) + ['2'] * _second_level
+    assert len(read_columns(tmp_path / 'edges.csv')[global_vars.citing_key]) == edges
+
+
+def test_crawl_stops_at_its_credits_and_resumes(fake_api, tmp_path):
+    server = fake_api(serp_results=30)
+    (complete, (nodes, _)) = _crawl(server, tmp_path, max_credits=5)
+    assert not complete
+    assert server.snapshot()['serp_requests'] == 5
+    # The credits of the previous run count towards the limit
+    assert _crawl(server, tmp_path, max_credits=5) == (False, (nodes, nodes - 10))
+    assert server.snapshot()['serp_requests'] == 5
+    # The crawl resumes from its frontier, without requesting any page again
+    (complete, counts) = _crawl(server, tmp_path, max_credits=100)
+    assert complete
+    assert counts == (10 + sum(_first_level) + _second_level,
+                      sum(_first_level) + _second_level)
+    assert server.snapshot()['serp_requests'] == _searches
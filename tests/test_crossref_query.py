@@ -0,0 +1,72 @@
+import csv
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from google_scholar_scraper import rate_limiter
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.crossref_query.crossref_query import InFlightLookups, \
+    crossref_query, _get_dois
+from google_scholar_scraper.crossref_query.doi_journal import DoiJournal
+from google_scholar_scraper.rate_limiter import get_rate_limiter
+from google_scholar_scraper.result_files import read_columns
+
+
+def _results_file(file_path, publications):
+    """Write a file of search results without DOIs"""
+    with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([global_vars.author_key, global_vars.pub_year_key, global_vars.title_key])
+        for i in publications:
+            writer.writerow([f'A Author{i}', 2000 + i % 20, f'Publication number {i}'])
+    return file_path
+
+
+def test_publications_are_looked_up_once_across_files(fake_api, tmp_path):
+    server = fake_api(latency=0.01, crossref_hit_rate=1, crossref_rate_limit=500)
+    files = [_results_file(tmp_path / 'a.csv', range(0, 30)),
+             _results_file(tmp_path / 'b.csv', range(20, 50))]
+    crossref_query('a@b.c', False, files, 8, api_url=server.crossref_api_url)
+    # One request reads the rate limit, and each publication is looked up once
+    assert server.snapshot()['crossref_requests'] == 1 + 50
+    (first, second) = (read_columns(x)[global_vars.doi_key] for x in files)
+    assert all(first) and all(second)
+    assert first[20:] == second[:10]
+    # The rate limit reported by Crossref is shared by every lookup
+    assert rate_limiter._limiters['crossref'].limit == 500
+
+
+def test_shared_rate_limiter_takes_the_new_rate():
+    limiter = get_rate_limiter('key', 10)
+    assert get_rate_limiter('key', 2, 60) is limiter
+    assert (limiter.limit, limiter.interval) == (2, 60)
+
+
+def test_failed_file_leaves_shared_lookups_to_other_files(tmp_path):
+    blocked = threading.Event()
+
+    def lookup(query):
+        if query == 'first':
+            blocked.wait(5)
+        return f'https://doi.org/10.1/{query}'
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    in_flight = InFlightLookups(executor, lookup)
+    # The only worker is busy, so the other lookups have not started yet
+    in_flight.submit('first')
+    shared = in_flight.submit('shared')[0]
+    own = in_flight.submit('own')[0]
+    # Another file waits for the shared lookup too
+    in_flight.submit('shared')
+    # The first lookup of the file ran out of retry attempts
+    failed = Future()
+    failed.set_result(None)
+    file_path = _results_file(tmp_path / 'results.csv', range(3))
+    columns = {**read_columns(file_path), global_vars.doi_key: [''] * 3}
+    _get_dois(file_path, in_flight, columns, [failed, shared, own], ['failed', 'shared', 'own'],
+              DoiJournal(file_path), False)
+    assert own.cancelled()
+    assert not shared.cancelled()
+    # The cancelled lookup can be submitted again
+    assert in_flight.submit('own')[1]
+    blocked.set()
+    assert shared.result() == 'https://doi.org/10.1/shared'
+    executor.shutdown()
@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+import pytest
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.daemon import DaemonServer, ScraperDaemon
+from google_scholar_scraper.result_files import read_columns
+
+
+@pytest.fixture
+def daemon(fake_api, tmp_path):
+    """Start a daemon scraping the stand-in server, and return the URL of its API"""
+    server = fake_api(crossref_hit_rate=1, crossref_rate_limit=500)
+    scraper = ScraperDaemon('key', 'a@b.c', tmp_path / 'output', workers=2,
+                            serp_api_url=server.serp_api_url,
+                            crossref_api_url=server.crossref_api_url)
+    daemon_server = DaemonServer(scraper, port=0)
+    threading.Thread(target=daemon_server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{daemon_server.server_address[1]}'
+    daemon_server.shutdown()
+    daemon_server.server_close()
+    scraper.close()
+
+
+def _request(url, method='GET', body=None):
+    """Send a request to the API of the daemon, and return its status and body"""
+    data = (body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')) \
+        if body is not None else None
+    request = urllib.request.Request(url, data=data, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return (response.status, json.loads(response.read()))
+    except urllib.error.HTTPError as e:
+        return (e.code, json.loads(e.read()))
+
+
+def _wait(url, job_id):
+    """Wait for a job to finish, and return its status"""
+    for _ in range(500):
+        (_, job) = _request(f'{url}/jobs/{job_id}')
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f'The job {job_id} did not finish')
+
+
+def test_scrape_job(daemon):
+    (status, job) = _request(f'{daemon}/jobs', 'POST',
+                             {'queries': ['alpha', {'query': 'beta', 'max_results': 20}],
+                              'max_results': 40})
+    assert status == 202 and job['status'] in ('queued', 'running')
+    job = _wait(daemon, job['id'])
+    assert job['status'] == 'done', job['error']
+    assert (job['queries_done'], job['rows_scraped']) == (2, 60)
+    assert [len(read_columns(x)[global_vars.doi_key]) for x in job['output_files']] == [40, 20]
+    assert all(read_columns(job['merged_file'])[global_vars.doi_key])
+    (_, health) = _request(f'{daemon}/health')
+    assert health['jobs']['done'] == 1
+
+
+@pytest.mark.parametrize('body', [b'not json', {}, {'queries': 'alpha'},
+                                  {'query': 'alpha', 'max_results': 0},
+                                  {'query': 'alpha', 'output_dir_name': '../elsewhere'},
+                                  {'doi_only': '/no/such/file.csv'}])
+def test_invalid_jobs_are_rejected(daemon, body):
+    (status, response) = _request(f'{daemon}/jobs', 'POST', body)
+    assert status == 400 and response['error']
+
+
+def test_unknown_jobs(daemon):
+    assert _request(f'{daemon}/jobs/nothing')[0] == 404
+    assert _request(f'{daemon}/jobs/nothing', 'DELETE')[0] == 404
+    assert _request(f'{daemon}/nothing')[0] == 404
+
+
+def test_jobs_with_the_same_output_dir_run_one_at_a_time(tmp_path):
+    scraper = ScraperDaemon('key', 'a@b.c', tmp_path, workers=3)
+    (lock, running, most_running) = (threading.Lock(), {}, {})
+
+    def run(job):
+        with lock:
+            running[job['output_dir']] = running.get(job['output_dir'], 0) + 1
+            most_running[job['output_dir']] = max(most_running.get(job['output_dir'], 0),
+                                                  running[job['output_dir']])
+        time.sleep(0.05)
+        with lock:
+            running[job['output_dir']] -= 1
+
+    scraper._run = run
+    jobs = [scraper.submit({'query': 'alpha', 'output_dir_name': name})
+            for name in ('shared', 'shared', 'shared', 'other')]
+    for _ in range(200):
+        if all(scraper.get(x['id'])['status'] == 'done' for x in jobs):
+            break
+        time.sleep(0.02)
+    assert all(scraper.get(x['id'])['status'] == 'done' for x in jobs)
+    assert most_running == {str(tmp_path / 'shared'): 1, str(tmp_path / 'other'): 1}
@@ -0,0 +1,47 @@
+import csv
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.dedup import MinHasher, dedup_search, find_clusters, \
+    _normalise_title
+from google_scholar_scraper.result_files import read_rows
+
+
+def test_signatures_estimate_similarity():
+    minhasher = MinHasher()
+    signatures = minhasher.signatures([
+        _normalise_title('Deep learning for the detection of near duplicates'),
+        _normalise_title('Deep Learning for the Detection of Near-Duplicates.'),
+        _normalise_title('A survey of protein folding methods'),
+        'ab'])
+    assert (signatures[0] == signatures[1]).all()
+    assert (signatures[0] == signatures[2]).mean() < 0.2
+    assert signatures.shape == (4, minhasher.num_perm)
+
+
+def test_clusters_of_titles_and_scholar_clusters():
+    titles = [_normalise_title(x) for x in [
+        'A study of near duplicate detection in scholarly search results',
+        'A study of near-duplicate detection in scholarly search result',
+        'A study of near duplicate detection in scholarly search results',
+        'An unrelated publication about the migration of birds',
+        'A different title of the same Google Scholar cluster',
+        '']]
+    years = ['2001', '2001', '2015', '2001', '', '']
+    scholar_clusters = [None, None, None, '7', '7', None]
+    # The same title from another year is another publication
+    assert find_clusters(titles, years, scholar_clusters) == [0, 0, 2, 3, 3, 5]
+
+
+def test_dedup_keeps_the_most_complete_row(tmp_path):
+    file_path = tmp_path / 'merged.csv'
+    fieldnames = [global_vars.author_key, global_vars.pub_year_key, global_vars.title_key,
+                  global_vars.scholar_link_key]
+    with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(fieldnames)
+        writer.writerow(['', '2001', 'Scalable near duplicate detection', ''])
+        writer.writerow(['A Author', '2001', 'Scalable Near-Duplicate Detection.', ''])
+        writer.writerow(['B Author', '2003', 'Another publication altogether',
+                         'https://scholar.google.com/scholar?cluster=42'])
+    rows = list(read_rows(dedup_search(file_path, False)))
+    assert [x[global_vars.author_key] for x in rows] == ['A Author', 'B Author']
+    assert [x[global_vars.cluster_id_key] for x in rows] == ['row-1', '42']
@@ -0,0 +1,52 @@
+import csv
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.crossref_query.crossref_query import crossref_query, query_string
+from google_scholar_scraper.crossref_query.doi_cache import DoiCache
+from google_scholar_scraper.result_files import read_columns
+
+
+def _results_file(file_path, size=10):
+    """Write a file of search results without DOIs"""
+    with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([global_vars.author_key, global_vars.pub_year_key, global_vars.title_key])
+        for i in range(size):
+            writer.writerow([f'A Author{i}; B "Author"', 2000 + i, f'Publication Number {i}'])
+    return file_path
+
+
+def test_entries_persist_and_are_kept_unless_replaced(tmp_path):
+    cache = DoiCache(tmp_path)
+    cache.put_many([('first', 'https://doi.org/10.1/1'), ('missing', '')])
+    cache.put_many([('first', 'https://doi.org/10.1/2')], replace=False)
+    cache.close()
+    cache = DoiCache(tmp_path)
+    assert cache.get('first') == 'https://doi.org/10.1/1'
+    # Lookups without a match are not cached
+    assert cache.get('missing') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+    cache = DoiCache(tmp_path, refresh=True)
+    assert cache.get('first') is None
+    cache.close()
+
+
+def test_query_string_is_normalised():
+    assert query_string('A Author; B "Author"', '2001', 'A Title') == \
+        query_string('a author; b author', '2001', 'a title')
+
+
+def test_cached_dois_are_not_looked_up_again(fake_api, tmp_path):
+    server = fake_api(crossref_hit_rate=1)
+    cache = DoiCache(tmp_path / 'cache')
+    crossref_query('a@b.c', False, [_results_file(tmp_path / 'first.csv')], 4, cache,
+                   api_url=server.crossref_api_url)
+    requests = server.snapshot()['crossref_requests']
+    # Another run, over another file with the same publications
+    crossref_query('a@b.c', False, [_results_file(tmp_path / 'second.csv')], 4, cache,
+                   api_url=server.crossref_api_url)
+    # Only the rate limit is read again
+    assert server.snapshot()['crossref_requests'] - requests == 1
+    assert read_columns(tmp_path / 'second.csv')[global_vars.doi_key] == \
+        read_columns(tmp_path / 'first.csv')[global_vars.doi_key]
+    cache.close()
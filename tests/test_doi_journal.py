@@ -0,0 +1,90 @@
+import csv
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.crossref_query.crossref_query import InFlightLookups, \
+    crossref_query, _build_query, _get_dois, _submit_dois
+from google_scholar_scraper.crossref_query.doi_journal import DoiJournal
+from google_scholar_scraper.result_files import read_columns
+
+
+def _results_file(tmp_path, size=10):
+    """Write a file of search results without DOIs"""
+    file_path = tmp_path / 'results.csv'
+    with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([global_vars.author_key, global_vars.pub_year_key, global_vars.title_key])
+        for i in range(size):
+            writer.writerow([f'A Author{i}', 2000 + i, f'Publication number {i}'])
+    return file_path
+
+
+def test_journal_skips_incomplete_last_line(tmp_path):
+    journal = DoiJournal(tmp_path / 'results.csv')
+    journal.append('first query', 'https://doi.org/10.1/1')
+    journal.append('second query', '')
+    journal.close()
+    with open(journal.path, 'a', encoding='utf-8') as journal_file:
+        journal_file.write('third qu')
+    assert journal.read() == {'first query': 'https://doi.org/10.1/1', 'second query': ''}
+
+
+def test_lookups_are_journaled_and_compacted(fake_api, tmp_path):
+    server = fake_api(crossref_hit_rate=0.5)
+    file_path = _results_file(tmp_path)
+    crossref_query('a@b.c', False, [file_path], 2, api_url=server.crossref_api_url)
+    dois = read_columns(file_path)[global_vars.doi_key]
+    assert len(dois) == 10
+    assert any(dois) and not all(dois)
+    # The journal is removed once its DOIs are in the file
+    assert not DoiJournal(file_path).path.exists()
+
+
+def test_resume_skips_journaled_lookups(fake_api, tmp_path):
+    server = fake_api(crossref_hit_rate=0.5)
+    file_path = _results_file(tmp_path)
+    columns = read_columns(file_path)
+    # An interrupted run journaled the first 6 lookups, half of them without a match
+    journal = DoiJournal(file_path)
+    for i in range(6):
+        journal.append(_build_query(columns, i), '' if i % 2 else f'https://doi.org/10.1/{i}')
+    journal.close()
+    requests = server.snapshot()['crossref_requests']
+    crossref_query('a@b.c', False, [file_path], 2, api_url=server.crossref_api_url)
+    # One request reads the rate limit, and only the 4 entries left are looked up
+    assert server.snapshot()['crossref_requests'] - requests == 1 + 4
+    dois = read_columns(file_path)[global_vars.doi_key]
+    assert dois[:6] == ['https://doi.org/10.1/0', '', 'https://doi.org/10.1/2', '',
+                        'https://doi.org/10.1/4', '']
+
+
+def test_lookups_are_journaled_as_they_finish(tmp_path):
+    file_path = _results_file(tmp_path, 3)
+    first_query = _build_query(read_columns(file_path), 0)
+    blocked = threading.Event()
+
+    def lookup(query):
+        # The lookup of the first entry is the last to finish
+        if query == first_query:
+            blocked.wait(5)
+        return f'https://doi.org/10.1/{len(query)}'
+
+    executor = ThreadPoolExecutor(max_workers=3)
+    in_flight = InFlightLookups(executor, lookup)
+    file_lookups = _submit_dois(file_path, in_flight)
+    (_, lookups, queries, journal) = file_lookups
+    lookups[2].result()
+    lookups[1].result()
+    # The finished lookups are journaled before the first one finishes, in
+    # case of a crash
+    for _ in range(100):
+        if len(journal.read()) == 2:
+            break
+        time.sleep(0.01)
+    assert set(journal.read()) == {queries[1], queries[2]}
+    blocked.set()
+    _get_dois(file_path, in_flight, *file_lookups, False)
+    executor.shutdown()
+    assert all(read_columns(file_path)[global_vars.doi_key])
+    assert not journal.path.exists()
@@ -0,0 +1,68 @@
+import threading
+import time
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.crossref_query.crossref_query import InFlightLookups
+from google_scholar_scraper.crossref_query.doi_pipeline import DoiPipeline
+from google_scholar_scraper.result_files import read_columns
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+
+
+def test_dois_are_saved_into_the_scraped_files(fake_api, tmp_path):
+    server = fake_api(crossref_hit_rate=1, crossref_rate_limit=500)
+    pipeline = DoiPipeline('a@b.c', False, 4, api_url=server.crossref_api_url)
+    output_files = []
+    for query in ('alpha', 'beta'):
+        output_files.append(scrape_google_scholar(
+            'key', query, 40, tmp_path, False, 4, 1000, None, server.serp_api_url,
+            on_rows=pipeline.put))
+        pipeline.add_file(output_files[-1])
+    pipeline.close()
+    dois = [read_columns(x)[global_vars.doi_key] for x in output_files]
+    assert [len(x) for x in dois] == [40, 40]
+    assert all(all(x) for x in dois)
+    # One request reads the rate limit, and each publication is looked up once
+    titles = {y for x in output_files for y in read_columns(x)[global_vars.title_key]}
+    assert server.snapshot()['crossref_requests'] <= 1 + len(titles)
+
+
+def test_put_blocks_while_the_queue_is_full(fake_api):
+    server = fake_api()
+    pipeline = DoiPipeline('a@b.c', False, 2, api_url=server.crossref_api_url, queue_size=3)
+    (lock, pending, most_pending) = (threading.Lock(), set(), [0])
+
+    def lookup(query):
+        time.sleep(0.005)
+        with lock:
+            most_pending[0] = max(most_pending[0], len(pending))
+            pending.discard(query)
+        return None
+
+    pipeline.in_flight = InFlightLookups(pipeline._executor, lookup)
+    submit = pipeline.in_flight.submit
+
+    def record(query, wait=True):
+        with lock:
+            pending.add(query)
+        return submit(query, wait)
+
+    pipeline.in_flight.submit = record
+    pipeline.put([{global_vars.author_key: f'A Author{i}', global_vars.pub_year_key: 2001,
+                   global_vars.title_key: f'Publication {i}'} for i in range(30)])
+    pipeline.close()
+    assert 0 < most_pending[0] <= 3
+
+
+def test_cancel_leaves_the_queued_lookups(fake_api):
+    server = fake_api()
+    pipeline = DoiPipeline('a@b.c', False, 1, api_url=server.crossref_api_url, queue_size=10)
+    blocked = threading.Event()
+    pipeline.in_flight = InFlightLookups(pipeline._executor, lambda _: blocked.wait(5))
+    pipeline.put([{global_vars.author_key: 'A Author', global_vars.pub_year_key: 2001,
+                   global_vars.title_key: f'Publication {i}'} for i in range(5)])
+    start = time.monotonic()
+    pipeline.close(cancel=True)
+    assert time.monotonic() - start < 1
+    lookups = [pipeline.in_flight.get(x) for x in list(pipeline.in_flight._futures)]
+    blocked.set()
+    # Only the lookup already running is left to finish
+    assert sum(x.cancelled() for x in lookups) == 4
@@ -0,0 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import pytest
+from google_scholar_scraper import http_transport
+
+
+@pytest.fixture
+def connections(fake_api):
+    """Start a stand-in server counting the connections it accepts, with a new
+    shared HTTP client"""
+    server = fake_api(latency=0.01)
+    accepted = []
+    process_request = server.process_request
+
+    def count_connection(request, client_address):
+        accepted.append(client_address)
+        process_request(request, client_address)
+
+    server.process_request = count_connection
+    http_transport.close()
+    yield (server, accepted)
+    http_transport.configure()
+
+
+def test_connections_are_kept_alive(connections):
+    (server, accepted) = connections
+    for i in range(20):
+        (body, headers) = http_transport.get_json(f'{server.crossref_api_url}/works',
+                                                  params={'query': f'query {i}', 'rows': 1})
+        assert body['status'] == 'ok'
+    assert server.snapshot()['crossref_requests'] == 20
+    assert len(accepted) == 1
+
+
+def test_pool_is_bounded_and_shared_by_threads(connections):
+    (server, accepted) = connections
+    http_transport.configure(max_connections=2)
+    client = http_transport.get_client()
+
+    def request(i):
+        assert http_transport.get_client() is client
+        return http_transport.get_json(f'{server.crossref_api_url}/works',
+                                       params={'query': f'query {i}'})[0]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert len(list(executor.map(request, range(40)))) == 40
+    assert len(accepted) <= 2
+    # Configuring the transport again replaces the client
+    http_transport.configure()
+    assert http_transport.get_client() is not client
+
+
+def test_errors_raise_with_their_status_code(connections):
+    (server, _) = connections
+    with pytest.raises(httpx.HTTPStatusError) as error:
+        http_transport.get_json(server.serp_api_url.replace('/search', '/missing'))
+    assert error.value.response.status_code == 404
@@ -0,0 +1,26 @@
+import subprocess
+import sys
+from pathlib import Path as p
+from google_scholar_scraper.benchmark.import_time import measure_import_time
+from google_scholar_scraper.config import global_vars
+
+# Source directory of the package, for the fresh interpreters
+_src_dir = str(p(__file__).parents[1] / 'src')
+# Modules which only the stages using them should load
+_stage_modules = ('sqlite3', 'multiprocessing', 'concurrent.futures', 'cProfile',
+                  'google_scholar_scraper.serp_query', 'google_scholar_scraper.crossref_query',
+                  'google_scholar_scraper.result_store', 'google_scholar_scraper.utils')
+
+
+def test_cli_starts_without_heavy_modules(monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', _src_dir)
+    result = measure_import_time(runs=1, heavy=global_vars.import_heavy_modules + _stage_modules)
+    assert result['heavy_modules_loaded'] == []
+
+
+def test_help_is_shown_without_running(monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', _src_dir)
+    process = subprocess.run([sys.executable, '-m', 'google_scholar_scraper', '-h'],
+                             capture_output=True, text=True)
+    assert process.returncode == 0
+    assert '--doi-only' in process.stdout
@@ -0,0 +1,92 @@
+import pytest
+from google_scholar_scraper.result_files import read_rows
+from google_scholar_scraper.serp_query.key_pool import KeyPool, KeysExhausted, KeysRejected, \
+    load_keys
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+
+
+def _pool(server, keys, tmp_path=None):
+    """Return a pool of keys of the stand-in server"""
+    return KeyPool(keys, 1000, tmp_path, server.serp_api_url)
+
+
+def _scrape(key_pool, server, output_dir, max_results):
+    """Scrape a query with a pool of keys"""
+    return scrape_google_scholar(key_pool, 'test query', max_results, output_dir, False, 4, 1000,
+                                 None, server.serp_api_url)
+
+
+def test_load_keys(tmp_path, monkeypatch):
+    key_file = tmp_path / 'keys.txt'
+    key_file.write_text('# pool\nk1\n\nk2\nk1\n')
+    assert load_keys(str(key_file)) == ['k1', 'k2']
+    monkeypatch.setenv('SERP_KEYS', 'k1, k2 k3')
+    assert load_keys('env:SERP_KEYS') == ['k1', 'k2', 'k3']
+    assert load_keys('k1') == ['k1']
+
+
+def test_searches_are_balanced_across_keys(fake_api, tmp_path):
+    server = fake_api(serp_accounts={'k1': 100, 'k2': 100, 'k3': 100})
+    key_pool = _pool(server, ['k1', 'k2', 'k3'], tmp_path / 'cache')
+    output_file = _scrape(key_pool, server, tmp_path, 600)
+    assert len(list(read_rows(output_file))) == 600
+    # The 30 searches are spread evenly
+    used = [100 - x for x in server.serp_accounts.values()]
+    assert sum(used) == 30
+    assert max(used) - min(used) <= 2
+    key_pool.close()
+
+
+def test_exhausted_key_is_dropped(fake_api, tmp_path):
+    server = fake_api(serp_accounts={'k1': 100, 'k2': 100})
+    key_pool = _pool(server, ['k1', 'k2'])
+    key_pool.refresh()
+    # Another run spends the searches of a key after its reading
+    server.serp_accounts['k1'] = 2
+    output_file = _scrape(key_pool, server, tmp_path, 200)
+    assert len(list(read_rows(output_file))) == 200
+    assert server.serp_accounts == {'k1': 0, 'k2': 92}
+    assert [x.key for x in key_pool.active()] == ['k2']
+
+
+def test_keys_are_read_before_the_first_searches(fake_api, tmp_path):
+    server = fake_api(serp_accounts={'k1': 2, 'k2': 100})
+    key_pool = _pool(server, ['k1', 'k2'])
+    output_file = _scrape(key_pool, server, tmp_path, 200)
+    assert len(list(read_rows(output_file))) == 200
+    # The key without enough searches is not used beyond them
+    assert server.serp_accounts['k1'] >= 0
+    assert server.snapshot()['errors'] == 0
+    assert [x.key for x in key_pool.active()] == ['k1', 'k2']
+
+
+def test_scrape_exits_when_keys_are_exhausted(fake_api, tmp_path, capsys):
+    server = fake_api(serp_accounts={'k1': 2, 'k2': 2})
+    key_pool = _pool(server, ['k1', 'k2'])
+    with pytest.raises(SystemExit) as error:
+        _scrape(key_pool, server, tmp_path, 200)
+    assert error.value.code == 402
+    assert 'No SerpApi API key has searches left' in capsys.readouterr().out
+    with pytest.raises(KeysExhausted):
+        key_pool.acquire()
+
+
+def test_rejected_keys_are_reported_apart(fake_api, tmp_path, capsys):
+    server = fake_api(serp_accounts={'k1': 100})
+    key_pool = _pool(server, ['bad1', 'bad2'])
+    with pytest.raises(SystemExit) as error:
+        _scrape(key_pool, server, tmp_path, 40)
+    assert error.value.code == 401
+    assert 'SerpApi rejected every API key' in capsys.readouterr().out
+    with pytest.raises(KeysRejected):
+        key_pool.acquire()
+
+
+def test_exhausted_and_rejected_keys(fake_api, tmp_path):
+    server = fake_api(serp_accounts={'k1': 1})
+    key_pool = _pool(server, ['bad', 'k1'])
+    with pytest.raises(SystemExit) as error:
+        _scrape(key_pool, server, tmp_path, 100)
+    assert error.value.code == 402
+    with pytest.raises(KeysExhausted, match='Rejected keys'):
+        key_pool.acquire()
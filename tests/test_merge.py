@@ -0,0 +1,38 @@
+import csv
+import pytest
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.result_files import read_rows
+from google_scholar_scraper.utils import merge_search
+
+
+def _results_file(file_path, publications, extra_column=False):
+    """Write a file of search results with the given publication numbers"""
+    fieldnames = [global_vars.author_key, global_vars.pub_year_key, global_vars.title_key]
+    if extra_column:
+        fieldnames.append(global_vars.doi_key)
+    with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames)
+        writer.writeheader()
+        for i in publications:
+            writer.writerow({global_vars.author_key: f'Author {i}',
+                             global_vars.pub_year_key: 2000 + i % 20,
+                             global_vars.title_key: f'Publication {i}',
+                             **({global_vars.doi_key: f'10.1/{i}'} if extra_column else {})})
+    return file_path
+
+
+@pytest.mark.parametrize('max_keys', [global_vars.merge_max_keys_in_memory, 5])
+def test_merge_keeps_the_first_of_each_publication(tmp_path, monkeypatch, max_keys):
+    # With few keys in memory, the keys are spilled to disk
+    monkeypatch.setattr(global_vars, 'merge_max_keys_in_memory', max_keys)
+    files = [_results_file(tmp_path / 'a.csv', range(0, 30)),
+             _results_file(tmp_path / 'b.csv', range(20, 50), extra_column=True),
+             _results_file(tmp_path / 'c.csv', [5, 60, 5, 61])]
+    merged_file = merge_search(files, tmp_path, False)
+    rows = list(read_rows(merged_file))
+    assert [x[global_vars.title_key] for x in rows] == \
+        [f'Publication {i}' for i in [*range(0, 50), 60, 61]]
+    # The columns of every file are kept, and only the rows which have them
+    # fill them in
+    assert rows[0][global_vars.doi_key] == ''
+    assert rows[30][global_vars.doi_key] == '10.1/30'
@@ -0,0 +1,74 @@
+import json
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.metrics import Metrics
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+
+
+def _work_in_a_thread(n):
+    """Stand-in of the work done by a worker thread"""
+    return sum(x * x for x in range(n))
+
+
+def test_counters_are_attributed_to_the_current_query(tmp_path):
+    metrics = Metrics()
+    with metrics.query('first query'):
+        metrics.increment('cache_lookups', cache='serpapi', result='hit')
+        metrics.record_request('serpapi', 0.2, True)
+    metrics.increment('cache_lookups', cache='serpapi', result='hit')
+    metrics.record_file('results.csv', 3, 1, 2)
+    metrics.write_json(tmp_path / 'metrics.json')
+    report = json.loads((tmp_path / 'metrics.json').read_text())
+    assert {'name': 'cache_lookups', 'labels': {'cache': 'serpapi', 'result': 'hit'},
+            'value': 2} in report['counters']
+    assert report['queries']['first query']['cache_lookups_serpapi_hit'] == 1
+    assert report['queries']['first query']['serpapi_credits'] == 1
+    assert report['files']['results.csv'] == {'dois_found': 3, 'dois_missing': 1,
+                                              'dois_existing': 2}
+    assert report['histograms'][0]['count'] == 1
+
+
+
+def test_only_the_latest_queries_and_files_are_kept():
+    metrics = Metrics(max_entries=3)
+    for i in range(5):
+        with metrics.query(f'query {i}'):
+            metrics.increment('serpapi_credits')
+        metrics.record_file(f'results {i}.csv', i, 0, 0)
+    # A query scraped again is the most recent one
+    with metrics.query('query 2'):
+        pass
+    assert list(metrics.queries) == ['query 3', 'query 4', 'query 2']
+    assert list(metrics.files) == ['results 2.csv', 'results 3.csv', 'results 4.csv']
+    assert metrics.queries['query 2']['serpapi_credits'] == 1
+
+def test_prometheus_textfile(tmp_path):
+    metrics = Metrics(buckets=(0.1, 1.0))
+    metrics.record_request('crossref', 0.05, True)
+    metrics.record_request('crossref', 0.5, False)
+    with metrics.stage('doi'):
+        pass
+    metrics.write_prometheus(tmp_path / 'metrics.prom')
+    lines = (tmp_path / 'metrics.prom').read_text().splitlines()
+    prefix = global_vars.metrics_prefix
+    assert f'# TYPE {prefix}_requests_total counter' in lines
+    assert f'{prefix}_requests_total{{service="crossref",status="error"}} 1' in lines
+    # The buckets are cumulative
+    assert f'{prefix}_request_duration_seconds_bucket{{service="crossref",le="1.0"}} 2' in lines
+    assert f'{prefix}_request_duration_seconds_bucket{{service="crossref",le="+Inf"}} 2' in lines
+    assert any(x.startswith(f'{prefix}_stage_duration_seconds{{stage="doi"}}') for x in lines)
+
+
+def test_profile_includes_the_worker_threads(fake_api, tmp_path):
+    server = fake_api()
+    metrics = Metrics()
+    metrics.profile_dir = tmp_path / '.profile'
+    with metrics.stage('scrape'):
+        scrape_google_scholar('key', 'test query', 100, tmp_path, False, 4, 1000, None,
+                              server.serp_api_url)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(_work_in_a_thread, [1000] * 8))
+    functions = {x[2] for x in pstats.Stats(str(tmp_path / '.profile' / 'scrape.prof')).stats}
+    assert {'_work_in_a_thread', '_process_batch', '_fetch_json'} <= functions
+    assert metrics.stages['scrape'] > 0
@@ -0,0 +1,51 @@
+import gzip
+import json
+import threading
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.crossref_query.offline_index import OfflineIndex, build_index, \
+    _read_works
+
+
+def _title(i):
+    """Return the title of a publication"""
+    return f'Publication about topic{i} and subject{i * 7}'
+
+
+def _work(i):
+    """Return a Crossref work"""
+    return {'DOI': f'10.1/{i}', 'title': [_title(i)],
+            'author': [{'family': f'Author{i}'}], 'issued': {'date-parts': [[2000 + i % 20]]}}
+
+
+def test_dump_files_are_streamed(tmp_path, monkeypatch):
+    # Read the files in chunks much smaller than a work
+    monkeypatch.setattr(global_vars, 'offline_read_size', 16)
+    works = [_work(i) for i in range(50)]
+    (tmp_path / 'list.json').write_text(json.dumps(works))
+    (tmp_path / 'items.json').write_text(json.dumps({'status': 'ok', 'items': works, 'total': 50}))
+    (tmp_path / 'single.json').write_text(json.dumps(works[0]))
+    with gzip.open(tmp_path / 'items.json.gz', 'wt', encoding='utf-8') as dump_file:
+        json.dump({'items': works}, dump_file)
+    (tmp_path / 'lines.jsonl').write_text('\n'.join(json.dumps(x) for x in works) + '\n')
+    for name in ('list.json', 'items.json', 'items.json.gz', 'lines.jsonl'):
+        assert list(_read_works(tmp_path / name)) == works
+    assert list(_read_works(tmp_path / 'single.json')) == [works[0]]
+
+
+def test_index_is_shared_between_threads(tmp_path):
+    (tmp_path / 'dump.jsonl').write_text('\n'.join(json.dumps(_work(i)) for i in range(200)))
+    build_index([tmp_path / 'dump.jsonl'], tmp_path / 'index.sqlite3')
+    index = OfflineIndex(tmp_path / 'index.sqlite3')
+    matches = {}
+
+    def _match(first):
+        for i in range(first, 200, 4):
+            matches[i] = index.match(f'A Author{i}', 2000 + i % 20, _title(i))
+
+    threads = [threading.Thread(target=_match, args=(x,)) for x in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    index.close()
+    assert matches == {i: f'https://doi.org/10.1/{i}' for i in range(200)}
@@ -0,0 +1,180 @@
+import sys
+from urllib import parse
+import pytest
+from google_scholar_scraper import http_transport
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.main import main
+from google_scholar_scraper.result_files import read_rows
+from google_scholar_scraper.scheduler import plan_partitions_cost, plan_queries
+from google_scholar_scraper.serp_query.partition import plan_partitions, plan_partitioned, \
+    scrape_partitioned, partitions_dir
+from google_scholar_scraper.serp_query.serp_cache import SerpCache
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+
+# First year of the search results of the stand-in server
+_first_year = 1990
+
+
+def test_ranges_are_split_below_the_cap():
+    # 300 search results a year from 2000 to 2020
+    def count_results(year_range):
+        (year_low, year_high) = year_range
+        years = range(max(year_low or 0, 2000), min(year_high, 2020) + 1)
+        return 300 * len(years)
+
+    partitions = plan_partitions(count_results, 1990, 2024)
+    threshold = global_vars.scholar_result_cap * global_vars.partition_split_ratio
+    assert all(x < threshold for (_, x) in partitions)
+    assert sum(x for (_, x) in partitions) == 300 * 21
+    # Newest first, covering every year once, with the earlier years apart
+    years = [x for ((year_low, year_high), _) in partitions if year_low is not None
+             for x in range(year_high, year_low - 1, -1)]
+    assert years == sorted(range(1990, 2025), reverse=True)
+    assert partitions[-1][0] == (None, 1989)
+
+
+def test_single_year_over_the_cap_is_kept(capsys):
+    partitions = plan_partitions(
+        lambda x: 5000 if x[0] is not None and x[0] <= 2000 <= x[1] else 0, 2000, 2001)
+    assert ((2000, 2000), 5000) in partitions
+    assert 'cannot be split further' in capsys.readouterr().out
+
+
+def test_partitioned_scrape_goes_past_the_cap(fake_api, tmp_path):
+    server = fake_api(serp_results=2500)
+    output_file = scrape_partitioned('key', 'broad query', 2500, tmp_path, False, _first_year,
+                                     rate_limit=1000, api_url=server.serp_api_url)
+    rows = list(read_rows(output_file))
+    links = {x[global_vars.scholar_link_key] for x in rows}
+    assert len(rows) == len(links) == 2500
+    assert all(x[global_vars.partition_key] for x in rows)
+    # A finished partitioned scrape is skipped when run again
+    requests = server.snapshot()['serp_requests']
+    assert scrape_partitioned('key', 'broad query', 2500, tmp_path, False, _first_year,
+                              rate_limit=1000, api_url=server.serp_api_url) == output_file
+    assert server.snapshot()['serp_requests'] == requests
+
+
+def test_partitioned_scrape_is_apart_from_the_plain_one(fake_api, tmp_path):
+    server = fake_api(serp_results=1500)
+    plain_file = scrape_google_scholar('key', 'broad query', 40, tmp_path, False, 4, 1000, None,
+                                       server.serp_api_url)
+    output_file = scrape_partitioned('key', 'broad query', 1500, tmp_path, False, _first_year,
+                                     rate_limit=1000, api_url=server.serp_api_url)
+    assert output_file != plain_file
+    assert len(list(read_rows(plain_file))) == 40
+    assert len(list(read_rows(output_file))) == 1500
+
+
+def test_cost_is_estimated_per_range(fake_api, tmp_path):
+    server = fake_api(serp_results=2500)
+    plan = plan_queries([('broad query', 2500, 0)], tmp_path)
+    partitions = plan_partitioned('key', 'broad query', 2500, tmp_path, False, _first_year,
+                                  rate_limit=1000, api_url=server.serp_api_url)
+    plan_partitions_cost(plan[0], partitions, partitions_dir(tmp_path))
+    assert sum(x for (_, x, _) in partitions) == 2500
+    requests = server.snapshot()['serp_requests']
+    scrape_partitioned('key', 'broad query', 2500, tmp_path, False, _first_year,
+                       rate_limit=1000, api_url=server.serp_api_url, partitions=partitions)
+    assert server.snapshot()['serp_requests'] - requests == plan[0]['credits']
+    # The first page of each range, which counted its search results, is not
+    # requested again, even without the local cache
+    assert plan[0]['credits'] == plan[0]['pages'] - len(partitions)
+
+
+def test_first_page_is_not_requested_again(fake_api, tmp_path):
+    server = fake_api()
+    first_page = server.serp_response({'q': 'test query', 'num': 20})
+    output_file = scrape_google_scholar('key', 'test query', 15, tmp_path, False, 4, 1000, None,
+                                        server.serp_api_url, first_page=first_page)
+    assert [x[global_vars.title_key] for x in read_rows(output_file)] == \
+        [x['title'] for x in first_page['organic_results'][:15]]
+    assert server.snapshot()['serp_requests'] == 0
+
+
+def test_offline_plan_only_reads_the_cache(fake_api, tmp_path):
+    server = fake_api(serp_results=2500)
+    cache = SerpCache(tmp_path / 'cache', 3600, 1 << 30)
+    # Nothing is counted yet
+    assert plan_partitioned('key', 'broad query', 2500, tmp_path, False, _first_year,
+                            rate_limit=1000, cache=cache, api_url=server.serp_api_url,
+                            offline=True) is None
+    assert server.snapshot()['serp_requests'] == 0
+    partitions = plan_partitioned('key', 'broad query', 2500, tmp_path, False, _first_year,
+                                  rate_limit=1000, cache=cache, api_url=server.serp_api_url)
+    requests = server.snapshot()['serp_requests']
+    assert plan_partitioned('key', 'broad query', 2500, tmp_path, False, _first_year,
+                            rate_limit=1000, cache=cache, api_url=server.serp_api_url,
+                            offline=True) == partitions
+    assert server.snapshot()['serp_requests'] == requests
+    cache.close()
+
+
+@pytest.fixture
+def run_main(monkeypatch, tmp_path):
+    """Return a function running the command line interface with the given
+    arguments against a stand-in server, and return the URLs it requested,
+    without their API key"""
+    requested = []
+    get_json = http_transport.get_json
+
+    def run(server, *args):
+        def local_get_json(url, params=None, headers=None):
+            """Send the SerpApi requests to the stand-in server"""
+            url = url.replace('https://serpapi.com', server.crossref_api_url)
+            query = {x: y for (x, y) in parse.parse_qsl(parse.urlsplit(url).query)
+                     if x != 'api_key'}
+            requested.append(parse.urlencode(sorted(query.items())))
+            return get_json(url, params=params, headers=headers)
+
+        monkeypatch.setattr(http_transport, 'get_json', local_get_json)
+        monkeypatch.setattr(sys, 'argv', ['gss', 'key', 'a@b.c', '-N', '-b', str(tmp_path),
+                                          '-o', 'run', '--cache-dir', str(tmp_path / 'cache'),
+                                          '--serp-rate-limit', '1000',
+                                          *args])
+        main()
+        return requested
+
+    return run
+
+
+def test_dry_run_makes_no_searches(fake_api, run_main, capsys):
+    server = fake_api(serp_results=2500)
+    with pytest.raises(SystemExit) as error:
+        run_main(server, '-q', 'broad query', '-m', '2500', '--partition-years', '1990',
+                 '--dry-run')
+    assert error.value.code == 0
+    assert server.snapshot()['serp_requests'] == 0
+    assert 'not counted yet' in capsys.readouterr().out
+
+
+def test_budget_is_checked_before_counting(fake_api, run_main):
+    server = fake_api(serp_results=2500)
+    with pytest.raises(SystemExit) as error:
+        run_main(server, '-q', 'broad query', '-m', '2500', '--partition-years', '1990',
+                 '--monthly-budget', '50')
+    assert error.value.code == 402
+    assert server.snapshot()['serp_requests'] == 0
+
+
+def test_partitioned_run_requests_each_page_once(fake_api, run_main):
+    server = fake_api(serp_results=2500)
+    requested = run_main(server, '-q', 'broad query', '-m', '2500', '--partition-years',
+                         '1990', '--no-local-cache')
+    assert len(requested) == len(set(requested)) == server.snapshot()['serp_requests']
+
+
+def test_counting_errors_exit(fake_api, tmp_path):
+    server = fake_api(serp_results=2500, serp_accounts={'k1': 100})
+    with pytest.raises(SystemExit) as error:
+        plan_partitioned('bad', 'broad query', 2500, tmp_path, False, _first_year,
+                         rate_limit=1000, api_url=server.serp_api_url)
+    assert error.value.code == 401
+
+
+def test_no_partitions_for_a_finished_query(fake_api, tmp_path):
+    server = fake_api(serp_results=1500)
+    scrape_partitioned('key', 'broad query', 1500, tmp_path, False, _first_year,
+                       rate_limit=1000, api_url=server.serp_api_url)
+    assert plan_partitioned('key', 'broad query', 1500, tmp_path, False, _first_year,
+                            rate_limit=1000, api_url=server.serp_api_url) == []
@@ -0,0 +1,59 @@
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.result_files import read_rows
+from google_scholar_scraper.serp_query.response_archive import ResponseArchive, rebuild, \
+    segments
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+
+
+def _page(query, start, titles):
+    """Return the request parameters and response of a page of search results"""
+    return ({'engine': 'google_scholar', 'q': query, 'start': start, 'num': len(titles)},
+            {'organic_results': [
+                {'position': i, 'title': x, 'snippet': f'About {x}',
+                 'publication_info': {'summary': 'A Author - Journal, 2001 - example.org'},
+                 'inline_links': {'versions': {'cluster_id': f'{query}-{start + i}'}}}
+                for (i, x) in enumerate(titles)]})
+
+
+def test_rebuild_matches_the_scraped_files(fake_api, tmp_path):
+    server = fake_api()
+    # Small segments, so the responses are spread across several of them
+    archive = ResponseArchive(tmp_path / 'archive', segment_size=1000)
+    output_files = [scrape_google_scholar('key', query, 50, tmp_path, False, 4, 1000, None,
+                                          server.serp_api_url, archive=archive)
+                    for query in ('alpha', 'beta')]
+    archive.close()
+    assert len(segments(tmp_path / 'archive')) > 2
+    rows = rebuild(tmp_path / 'archive', tmp_path / 'rebuilt.csv', processes=2)
+    rebuilt = list(read_rows(tmp_path / 'rebuilt.csv'))
+    assert rows == len(rebuilt) == 100
+    for (query, output_file) in zip(('alpha', 'beta'), output_files):
+        scraped = list(read_rows(output_file))
+        assert [{x: y for (x, y) in row.items() if x != global_vars.query_key}
+                for row in rebuilt if row[global_vars.query_key] == query] == scraped
+
+
+def test_only_the_latest_response_of_a_result_is_kept(tmp_path):
+    archive = ResponseArchive(tmp_path, segment_size=1)
+    archive.append(*_page('alpha', 0, ['Old first', 'Old second']))
+    archive.append(*_page('alpha', 2, ['Third']))
+    archive.append(*_page('alpha', 0, ['New first']))
+    archive.close()
+    assert len(segments(tmp_path)) == 3
+    fields = [global_vars.query_key, global_vars.title_key, global_vars.cluster_id_key,
+              global_vars.snippet_key]
+    assert rebuild(tmp_path, tmp_path / 'rebuilt.csv', fields, processes=2) == 3
+    assert list(read_rows(tmp_path / 'rebuilt.csv')) == [
+        {global_vars.query_key: 'alpha', global_vars.title_key: x,
+         global_vars.cluster_id_key: f'alpha-{i}', global_vars.snippet_key: f'About {x}'}
+        for (i, x) in enumerate(['New first', 'Old second', 'Third'])]
+
+
+def test_segment_cut_short_by_a_crash(tmp_path):
+    archive = ResponseArchive(tmp_path)
+    archive.append(*_page('alpha', 0, ['First', 'Second']))
+    # The process crashes before the segment is finished
+    try:
+        assert rebuild(tmp_path, tmp_path / 'rebuilt.csv', processes=1) == 2
+    finally:
+        archive.close()
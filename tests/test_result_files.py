@@ -0,0 +1,57 @@
+import pytest
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.result_files import RowWriter, convert, read_columns, \
+    read_fieldnames, read_rows, write_columns
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+_fieldnames = [global_vars.author_key, global_vars.pub_year_key, global_vars.title_key,
+               global_vars.num_citations_key, global_vars.doi_key]
+
+
+def _rows(size):
+    """Return rows of search results, some of them with missing values"""
+    return [{global_vars.author_key: f'Author, {i}', global_vars.pub_year_key: str(2000 + i),
+             global_vars.title_key: f'Publication "number" {i}',
+             global_vars.num_citations_key: str(i) if i % 3 else '',
+             global_vars.doi_key: ''} for i in range(size)]
+
+
+def test_parquet_round_trip(tmp_path, monkeypatch):
+    # Several row groups
+    monkeypatch.setattr(global_vars, 'parquet_row_group_size', 4)
+    with RowWriter(tmp_path / 'results.parquet', _fieldnames) as writer:
+        writer.writerows(_rows(10))
+    assert read_fieldnames(tmp_path / 'results.parquet') == _fieldnames
+    assert list(read_rows(tmp_path / 'results.parquet')) == _rows(10)
+    assert pq.ParquetFile(str(tmp_path / 'results.parquet')).metadata.num_row_groups == 3
+    # The year and number of citations are stored as integers
+    schema = pq.read_schema(str(tmp_path / 'results.parquet'))
+    assert str(schema.field(global_vars.pub_year_key).type) == 'int32'
+    assert str(schema.field(global_vars.title_key).type) == 'string'
+
+
+def test_conversions_keep_the_values(tmp_path):
+    with RowWriter(tmp_path / 'results.csv', _fieldnames) as writer:
+        writer.writerows(_rows(10))
+    convert(tmp_path / 'results.csv', tmp_path / 'results.parquet')
+    columns = read_columns(tmp_path / 'results.parquet')
+    assert columns == read_columns(tmp_path / 'results.csv')
+    columns[global_vars.doi_key][0] = 'https://doi.org/10.1/0'
+    write_columns(columns, tmp_path / 'results.parquet')
+    assert read_columns(tmp_path / 'results.parquet')[global_vars.doi_key][:2] == \
+        ['https://doi.org/10.1/0', '']
+
+
+def test_scrape_to_parquet(fake_api, tmp_path):
+    server = fake_api()
+    (tmp_path / 'csv').mkdir()
+    (tmp_path / 'parquet').mkdir()
+    csv_file = scrape_google_scholar('key', 'test query', 60, tmp_path / 'csv', False, 4, 1000,
+                                     None, server.serp_api_url)
+    parquet_file = scrape_google_scholar('key', 'test query', 60, tmp_path / 'parquet', False, 4,
+                                         1000, None, server.serp_api_url,
+                                         output_format='parquet')
+    assert parquet_file.suffix == '.parquet'
+    assert list(read_rows(parquet_file)) == list(read_rows(csv_file))
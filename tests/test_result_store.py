@@ -0,0 +1,96 @@
+import sqlite3
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.result_files import read_rows
+from google_scholar_scraper.result_store import ResultStore, is_result_store
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+
+
+def _row(cluster, rank, title=None, num_citations=1):
+    """Return a row of a search result"""
+    return {global_vars.author_key: 'A Author', global_vars.pub_year_key: 2001,
+            global_vars.title_key: title or f'Publication {cluster}',
+            global_vars.scholar_link_key: f'https://scholar.google.com/scholar?cluster={cluster}'
+            if cluster is not None else '',
+            global_vars.pub_url_key: '', global_vars.gs_rank_key: rank,
+            global_vars.num_citations_key: num_citations}
+
+
+def _stored_results(db_path):
+    """Count the results stored, from another connection"""
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+
+def test_pages_are_stored_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(global_vars, 'result_store_write_batch', 30)
+    store = ResultStore(tmp_path / 'store.sqlite3')
+    assert not store.add_rows('alpha', [_row(i, i) for i in range(20)])
+    assert _stored_results(tmp_path / 'store.sqlite3') == 0
+    assert store.add_rows('beta', [_row(i, i) for i in range(20, 40)])
+    assert _stored_results(tmp_path / 'store.sqlite3') == 40
+    assert not store.add_rows('beta', [_row(40, 20)])
+    store.flush()
+    assert _stored_results(tmp_path / 'store.sqlite3') == 41
+    store.close()
+    assert is_result_store(tmp_path / 'store.sqlite3')
+
+
+def test_export_merges_the_queries(tmp_path):
+    store = ResultStore(tmp_path / 'store.sqlite3')
+    store.add_rows('alpha', [_row(1, 0), _row(2, 1), _row(None, 2, 'No Cluster: a title')])
+    # Publications found again are only updated, and kept at their first rank
+    store.add_rows('beta', [_row(3, 0), _row(1, 1, num_citations=5),
+                            _row(None, 2, 'no cluster, a title')])
+    store.save_dois([(1, 'https://doi.org/10.1/1')])
+    size = store.export(tmp_path / 'merged.csv', ['alpha', 'beta'], 'csv')
+    rows = list(read_rows(tmp_path / 'merged.csv'))
+    assert size == len(rows) == 4
+    assert [x[global_vars.title_key] for x in rows] == \
+        ['Publication 1', 'Publication 2', 'No Cluster: a title', 'Publication 3']
+    assert rows[0][global_vars.num_citations_key] == '5'
+    assert rows[0][global_vars.doi_key] == 'https://doi.org/10.1/1'
+    assert rows[3][global_vars.gs_rank_key] == '0'
+    # The results still missing a DOI
+    assert store.count_missing_dois() == 3
+    assert [x[0] for x in store.missing_dois()] == [2, 3, 4]
+    store.close()
+
+
+def test_export_of_many_queries(tmp_path):
+    store = ResultStore(tmp_path / 'store.sqlite3')
+    # More queries than the parameters of a statement
+    queries = [f'query {i}' for i in range(40000)]
+    for (i, query) in enumerate(queries):
+        store.add_rows(query, [_row(i % 30000, 0)])
+    assert store.export(tmp_path / 'merged.csv', queries, 'csv') == 30000
+    store.close()
+
+
+def test_scrape_into_the_store(fake_api, tmp_path):
+    server = fake_api()
+    store = ResultStore(tmp_path / 'store.sqlite3')
+    output_file = scrape_google_scholar('key', 'test query', 100, tmp_path, False, 4, 1000, None,
+                                        server.serp_api_url, store=store)
+    store.export(tmp_path / 'merged.csv', ['test query'], 'csv')
+    assert [x[global_vars.scholar_link_key] for x in read_rows(tmp_path / 'merged.csv')] == \
+        [x[global_vars.scholar_link_key] for x in read_rows(output_file)]
+    store.close()
+
+
+def test_ranks_of_a_previous_run_are_replaced(fake_api, tmp_path):
+    server = fake_api()
+    store = ResultStore(tmp_path / 'store.sqlite3')
+    for (run, max_results) in (('run1', 60), ('run2', 20)):
+        (tmp_path / run).mkdir()
+        output_file = scrape_google_scholar('key', 'test query', max_results, tmp_path / run,
+                                            False, 4, 1000, None, server.serp_api_url,
+                                            store=store)
+    # Only the search results of the last run of the query are exported
+    assert store.export(tmp_path / 'merged.csv', ['test query'], 'csv') == 20
+    assert list(read_rows(tmp_path / 'merged.csv')) == \
+        [{**x, global_vars.doi_key: ''} for x in read_rows(output_file)]
+    # A resumed scrape keeps the ranks of the pages stored before
+    scrape_google_scholar('key', 'test query', 40, tmp_path / 'run2', False, 4, 1000, None,
+                          server.serp_api_url, store=store)
+    assert store.export(tmp_path / 'merged.csv', ['test query'], 'csv') == 40
+    store.close()
@@ -0,0 +1,36 @@
+import json
+import socket
+from http.client import IncompleteRead
+from urllib.error import HTTPError, URLError
+import pytest
+from google_scholar_scraper.retry import PermanentError, Retrier, is_transient
+
+
+@pytest.mark.parametrize('error, transient', [
+    (URLError('DNS failure'), True),
+    (socket.timeout(), True),
+    (ConnectionResetError(), True),
+    (IncompleteRead(b''), True),
+    (json.JSONDecodeError('Expecting value', '', 0), True),
+    (HTTPError('url', 503, 'Unavailable', {}, None), True),
+    (HTTPError('url', 429, 'Too Many Requests', {}, None), True),
+    (HTTPError('url', 404, 'Not Found', {}, None), False),
+    (PermanentError('bad key'), False),
+    (FileNotFoundError('results.csv'), False),
+    (KeyError('organic_results'), False),
+    (ValueError('bug'), False),
+])
+def test_only_transient_errors_are_retried(error, transient):
+    assert is_transient(error) == transient
+
+
+def test_permanent_errors_fail_fast():
+    calls = []
+
+    def _missing_file():
+        calls.append(1)
+        raise FileNotFoundError('results.csv')
+
+    with pytest.raises(FileNotFoundError):
+        Retrier('test', base_delay=0.01, max_delay=0.05).call(_missing_file)
+    assert len(calls) == 1
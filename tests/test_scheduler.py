@@ -0,0 +1,83 @@
+import threading
+import time
+import pytest
+from google_scholar_scraper.result_files import read_rows
+from google_scholar_scraper.scheduler import normalise_query, plan_queries, run_plan
+from google_scholar_scraper.serp_query.credit_budget import CreditBudget
+from google_scholar_scraper.serp_query.serp_cache import SerpCache
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+
+
+def test_duplicate_queries_are_planned_once(tmp_path):
+    assert normalise_query('  Deep   Learning OR Birds ') == 'deep learning OR birds'
+    plan = plan_queries([('deep learning', 40, 0), ('birds', 100, 0), ('Deep  Learning', 60, 5),
+                         ('fish', 20, 1)], tmp_path)
+    assert [(x['query'], x['max_results'], x['priority'], x['duplicates']) for x in plan] == \
+        [('deep learning', 60, 5, 1), ('fish', 20, 1, 0), ('birds', 100, 0, 0)]
+    assert [x['credits'] for x in plan] == [3, 1, 5]
+
+
+def test_plan_counts_only_the_searches_left(fake_api, tmp_path):
+    server = fake_api()
+    cache = SerpCache(tmp_path / 'cache', ttl=3600, max_size=1 << 20)
+    # A previous run scraped the first 40 results of a query, and another
+    # directory has the first 60 results of another query in the cache
+    scrape_google_scholar('key', 'first query', 40, tmp_path, False, 4, 1000, None,
+                          server.serp_api_url)
+    (tmp_path / 'other').mkdir()
+    scrape_google_scholar('key', 'second query', 60, tmp_path / 'other', False, 4, 1000, cache,
+                          server.serp_api_url)
+    plan = plan_queries([('first query', 100, 0), ('second query', 100, 0)], tmp_path, cache)
+    assert [(x['pages'], x['cached_pages'], x['credits']) for x in plan] == \
+        [(3, 0, 3), (5, 3, 2)]
+    cache.close()
+
+
+def test_queries_run_by_priority_and_return_in_file_order(tmp_path):
+    plan = plan_queries([('low', 20, 0), ('high', 20, 9), ('middle', 20, 5)], tmp_path)
+    started = []
+    running = []
+    lock = threading.Lock()
+
+    def scrape(query, max_results):
+        with lock:
+            started.append(query)
+            running.append(query)
+            assert len(running) <= 2
+        time.sleep(0.05)
+        with lock:
+            running.remove(query)
+        return f'{query}.csv'
+
+    assert run_plan(plan, scrape, query_concurrency=2) == ['low.csv', 'high.csv', 'middle.csv']
+    assert started[:2] == ['high', 'middle']
+
+
+def test_monthly_budget_holds_across_runs(fake_api, tmp_path, capsys):
+    server = fake_api()
+    budget = CreditBudget(tmp_path / 'cache', 7)
+    output_file = scrape_google_scholar('key', 'first query', 100, tmp_path, False, 4, 1000,
+                                        None, server.serp_api_url, budget=budget)
+    assert len(list(read_rows(output_file))) == 100
+    budget.close()
+    # Another run only has the 2 searches left
+    budget = CreditBudget(tmp_path / 'cache', 7)
+    assert (budget.used(), budget.remaining()) == (5, 2)
+    with pytest.raises(SystemExit) as error:
+        scrape_google_scholar('key', 'second query', 100, tmp_path, False, 1, 1000, None,
+                              server.serp_api_url, budget=budget)
+    assert error.value.code == 402
+    assert budget.used() == 7
+    assert server.snapshot()['serp_requests'] == 7
+    budget.close()
+
+
+def test_failed_searches_are_not_charged(fake_api, tmp_path):
+    server = fake_api(error_rate=1)
+    budget = CreditBudget(tmp_path / 'cache', 100)
+    with pytest.raises(SystemExit):
+        scrape_google_scholar('key', 'test query', 20, tmp_path, False, 1, 1000, None,
+                              server.serp_api_url, budget=budget)
+    assert server.snapshot()['serp_requests'] > 1
+    assert budget.used() == 0
+    budget.close()
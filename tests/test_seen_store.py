@@ -0,0 +1,69 @@
+import time
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.result_files import read_rows
+from google_scholar_scraper.serp_query import seen_store
+from google_scholar_scraper.serp_query.seen_store import SeenStore, seen_key
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+
+
+def _scrape(server, output_dir, max_results, seen=None, **kwargs):
+    """Scrape a query from the stand-in server, and return its file and rows"""
+    output_dir.mkdir(exist_ok=True, parents=True)
+    output_file = scrape_google_scholar('key', 'test query', max_results, output_dir, False, 4,
+                                        1000, None, server.serp_api_url, seen=seen, **kwargs)
+    return output_file, list(read_rows(output_file))
+
+
+def test_seen_results_are_remembered(tmp_path):
+    seen = SeenStore(tmp_path)
+    seen.add('alpha', ['a', 'b'])
+    assert seen.known('alpha', ['a', 'c']) == {'a'}
+    assert seen.known('beta', ['a']) == set()
+    assert seen.last_run_year('alpha') is None
+    seen.finish_run('alpha')
+    seen.close()
+    # The state is kept across runs
+    seen = SeenStore(tmp_path)
+    assert seen.known('alpha', [str(x) for x in range(1000)] + ['b']) == {'b'}
+    assert seen.last_run_year('alpha') == int(time.strftime('%Y'))
+    seen.close()
+
+
+def test_only_new_results_are_saved_to_a_delta_file(fake_api, tmp_path):
+    server = fake_api()
+    (_, all_rows) = _scrape(server, tmp_path / 'full', 30)
+    seen = SeenStore(tmp_path / 'cache')
+    # A previous run saw every other search result of the first pages
+    seen.add('test query', [seen_key(x) for x in all_rows[:20:2]])
+    (output_file, rows) = _scrape(server, tmp_path / 'run1', 30, seen)
+    assert output_file.name.endswith('_delta.csv')
+    assert rows == all_rows[1:20:2] + all_rows[20:]
+    assert seen.known('test query', [seen_key(x) for x in all_rows]) == \
+        {seen_key(x) for x in all_rows}
+    seen.close()
+
+
+def test_incremental_scrape_stops_without_new_results(fake_api, tmp_path):
+    server = fake_api()
+    seen = SeenStore(tmp_path / 'cache')
+    (_, first_rows) = _scrape(server, tmp_path / 'run1', 50, seen)
+    assert len(first_rows) == 50
+    requests = server.snapshot()['serp_requests']
+    # Nothing is new on the first page of the next run, so only it is requested
+    (_, rows) = _scrape(server, tmp_path / 'run2', 50, seen)
+    assert rows == []
+    assert server.snapshot()['serp_requests'] == requests + 1
+    seen.close()
+
+
+def test_since_last_run_only_searches_the_recent_years(fake_api, tmp_path, monkeypatch):
+    server = fake_api()
+    seen = SeenStore(tmp_path / 'cache')
+    # The query was last scraped in 2020
+    with monkeypatch.context() as m:
+        m.setattr(seen_store.time, 'strftime', lambda _: '2020')
+        seen.finish_run('test query')
+    (_, rows) = _scrape(server, tmp_path / 'run', 20, seen, narrow_years=True)
+    assert len(rows) == 20
+    assert all(int(x[global_vars.pub_year_key]) >= 2020 for x in rows)
+    seen.close()
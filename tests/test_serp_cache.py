@@ -0,0 +1,80 @@
+import random
+from google_scholar_scraper.result_files import read_rows
+from google_scholar_scraper.serp_query import serp_cache
+from google_scholar_scraper.serp_query.serp_cache import SerpCache
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+
+
+class _Clock:
+    """Stand-in of the time module with a clock moved by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def _params(start):
+    """Return the parameters of the request of a page"""
+    return {'q': 'test query', 'start': start, 'num': 20}
+
+
+def test_entries_expire(tmp_path, monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(serp_cache, 'time', clock)
+    cache = SerpCache(tmp_path, ttl=60, max_size=1 << 20)
+    cache.put(_params(0), {'organic_results': [1, 2]}, uncached=True)
+    clock.now += 59
+    assert cache.contains(_params(0))
+    assert cache.get(_params(0)) == ({'organic_results': [1, 2]}, True)
+    clock.now += 2
+    assert not cache.contains(_params(0))
+    assert cache.get(_params(0)) is None
+    cache.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(serp_cache, 'time', clock)
+    # Room for two entries of random text, of about 1150 bytes once compressed
+    cache = SerpCache(tmp_path, ttl=3600, max_size=2500)
+    for start in range(3):
+        clock.now += 1
+        cache.put(_params(start), {'text': random.Random(start).randbytes(1000).hex()})
+        # The first entry is used again, so it is not the least recently used
+        clock.now += 1
+        cache.get(_params(0))
+    assert cache.contains(_params(0))
+    assert not cache.contains(_params(1))
+    assert cache.contains(_params(2))
+    cache.close()
+
+
+def test_errors_are_not_stored_and_refresh_skips_the_cache(tmp_path):
+    cache = SerpCache(tmp_path, ttl=3600, max_size=1 << 20)
+    cache.put(_params(0), {'error': 'Invalid API key.'})
+    assert cache.get(_params(0)) is None
+    cache.put(_params(0), {'organic_results': []})
+    cache.close()
+    cache = SerpCache(tmp_path, ttl=3600, max_size=1 << 20, refresh=True)
+    assert cache.get(_params(0)) is None
+    cache.close()
+    # The cache persists across runs
+    assert SerpCache(tmp_path, ttl=3600, max_size=1 << 20).get(_params(0)) == \
+        ({'organic_results': []}, False)
+
+
+def test_cached_pages_are_not_requested_again(fake_api, tmp_path):
+    server = fake_api()
+    cache = SerpCache(tmp_path / 'cache', ttl=3600, max_size=1 << 20)
+    (tmp_path / 'first').mkdir()
+    (tmp_path / 'second').mkdir()
+    first_file = scrape_google_scholar('key', 'test query', 100, tmp_path / 'first', False, 4,
+                                       1000, cache, server.serp_api_url)
+    requests = server.snapshot()['serp_requests']
+    second_file = scrape_google_scholar('key', 'test query', 100, tmp_path / 'second', False, 4,
+                                        1000, cache, server.serp_api_url)
+    assert server.snapshot()['serp_requests'] == requests
+    assert list(read_rows(second_file)) == list(read_rows(first_file))
+    cache.close()
@@ -0,0 +1,114 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path as p
+from google_scholar_scraper.config import global_vars
+from google_scholar_scraper.result_files import read_rows
+from google_scholar_scraper.serp_query.manifest import ScrapeManifest
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+
+# Script scraping a query in another process, so it can be killed mid-scrape
+_crash_script = """
+import sys
+from pathlib import Path
+from google_scholar_scraper.serp_query.serp_query import scrape_google_scholar
+scrape_google_scholar('key', sys.argv[3], int(sys.argv[4]), Path(sys.argv[1]), False, 1, 1000,
+                      None, sys.argv[2])
+"""
+
+
+def _scrape(server, output_dir, max_results, query='test query', concurrency=4, **kwargs):
+    """Scrape a query from the stand-in server, and return its rows"""
+    output_dir.mkdir(exist_ok=True, parents=True)
+    output_file = scrape_google_scholar('key', query, max_results, output_dir, False,
+                                        concurrency, 1000, None, server.serp_api_url, **kwargs)
+    return output_file, list(read_rows(output_file))
+
+
+def _links(rows):
+    """Return the links of the rows, which identify their search results"""
+    return [x[global_vars.scholar_link_key] for x in rows]
+
+
+def test_concurrent_pages_are_saved_in_order(fake_api, tmp_path):
+    server = fake_api(latency=0.01)
+    (_, serial) = _scrape(server, tmp_path / 'serial', 95, concurrency=1)
+    (_, concurrent) = _scrape(server, tmp_path / 'concurrent', 95, concurrency=8)
+    assert len(serial) == 95
+    assert _links(concurrent) == _links(serial)
+
+
+def test_scrape_stops_when_results_run_out(fake_api, tmp_path):
+    server = fake_api(serp_results=50)
+    (output_file, rows) = _scrape(server, tmp_path, 200, concurrency=1)
+    assert len(rows) == 50
+    assert ScrapeManifest(tmp_path, 'test query').ended
+    # A finished scrape is skipped when run again
+    requests = server.snapshot()['serp_requests']
+    assert _scrape(server, tmp_path, 200)[0] == output_file
+    assert server.snapshot()['serp_requests'] == requests
+
+
+def test_resume_only_requests_missing_pages(fake_api, tmp_path):
+    server = fake_api()
+    (output_file, rows) = _scrape(server, tmp_path, 40)
+    assert len(rows) == 40
+    requests = server.snapshot()['serp_requests']
+    (resumed_file, rows) = _scrape(server, tmp_path, 100)
+    assert resumed_file == output_file
+    assert server.snapshot()['serp_requests'] - requests == 3
+    assert _links(rows) == _links(_scrape(server, tmp_path / 'fresh', 100)[1])
+
+
+def test_resume_truncates_unrecorded_writes(fake_api, tmp_path):
+    server = fake_api()
+    (output_file, _) = _scrape(server, tmp_path, 40)
+    # A partial page written after the last page recorded in the manifest
+    with open(output_file, 'a', encoding='utf-8') as csvfile:
+        csvfile.write('Broken Author,2001,Broken title\nAnother')
+    (_, rows) = _scrape(server, tmp_path, 60)
+    assert _links(rows) == _links(_scrape(server, tmp_path / 'fresh', 60)[1])
+
+
+def test_crash_and_resume(fake_api, tmp_path):
+    server = fake_api(latency=0.1)
+    output_dir = tmp_path / 'crashed'
+    output_dir.mkdir()
+    env = {**os.environ, 'PYTHONPATH': str(p(__file__).parents[1] / 'src')}
+    process = subprocess.Popen(
+        [sys.executable, '-c', _crash_script, str(output_dir), server.serp_api_url,
+         'crash query', '200'], env=env, stdout=subprocess.DEVNULL)
+    # Kill the scrape once it saved a few pages
+    manifest = None
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        manifest = ScrapeManifest(output_dir, 'crash query')
+        if len(manifest.completed) >= 3:
+            break
+        time.sleep(0.01)
+    assert process.poll() is None
+    process.send_signal(signal.SIGKILL)
+    process.wait()
+    saved = len(ScrapeManifest(output_dir, 'crash query').completed)
+    assert 3 <= saved < 10
+
+    requests = server.snapshot()['serp_requests']
+    (_, rows) = _scrape(server, output_dir, 200, 'crash query')
+    # Only the pages which were not saved are requested again
+    assert server.snapshot()['serp_requests'] - requests <= 10 - saved + 1
+    assert _links(rows) == _links(_scrape(server, tmp_path / 'fresh', 200, 'crash query')[1])
+
+
+def test_rows_are_passed_on_in_order(fake_api, tmp_path):
+    server = fake_api(latency=0.01)
+    passed = []
+
+    def on_rows(rows):
+        """Slowly pass the rows on, as a full DOI pipeline would"""
+        time.sleep(0.01)
+        passed.extend(rows)
+
+    (_, rows) = _scrape(server, tmp_path, 200, concurrency=8, on_rows=on_rows)
+    assert _links(passed) == _links(rows)
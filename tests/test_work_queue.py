@@ -0,0 +1,59 @@
+import time
+from google_scholar_scraper.scheduler import plan_queries
+from google_scholar_scraper.work_queue import WorkQueue
+
+
+def _queue(tmp_path, queries, max_attempts=3):
+    """Return a work queue with the given queries"""
+    work_queue = WorkQueue(tmp_path / 'queue.sqlite3', max_attempts)
+    work_queue.add(plan_queries([(x, 20, 0) for x in queries], tmp_path))
+    return work_queue
+
+
+def test_queries_are_claimed_once(tmp_path):
+    work_queue = _queue(tmp_path, ['alpha', 'beta'])
+    first = work_queue.claim('a')
+    second = work_queue.claim('b')
+    assert {first[1], second[1]} == {'alpha', 'beta'}
+    assert work_queue.claim('c') is None
+    assert work_queue.complete(first[0], 'a', 'alpha.csv')
+    assert work_queue.counts() == {'queued': 0, 'claimed': 1, 'done': 1, 'failed': 0}
+
+
+def test_expired_lease_is_claimed_by_another_worker(tmp_path):
+    work_queue = _queue(tmp_path, ['alpha'])
+    (job_id, _, _) = work_queue.claim('a', lease=0.2)
+    assert work_queue.claim('b', lease=0.2) is None
+    time.sleep(0.3)
+    assert work_queue.claim('b', lease=60)[0] == job_id
+    # The first worker lost the query, so it can neither renew nor complete it
+    assert not work_queue.renew(job_id, 'a')
+    assert not work_queue.complete(job_id, 'a', 'alpha.csv')
+    assert work_queue.complete(job_id, 'b', 'alpha.csv')
+    assert work_queue.output_files() == ['alpha.csv']
+
+
+def test_expired_lease_cannot_be_completed(tmp_path):
+    work_queue = _queue(tmp_path, ['alpha'])
+    (job_id, _, _) = work_queue.claim('a', lease=0.1)
+    time.sleep(0.2)
+    assert not work_queue.complete(job_id, 'a', 'alpha.csv')
+
+
+def test_query_fails_after_too_many_expired_leases(tmp_path):
+    work_queue = _queue(tmp_path, ['alpha'], max_attempts=2)
+    for worker in ('a', 'b'):
+        assert work_queue.claim(worker, lease=0.05) is not None
+        time.sleep(0.1)
+    assert work_queue.claim('c') is None
+    assert work_queue.failed() == [('alpha', 'The lease expired too many times')]
+
+
+def test_failed_query_is_retried_unless_told_not_to(tmp_path):
+    work_queue = _queue(tmp_path, ['alpha'])
+    (job_id, _, _) = work_queue.claim('a')
+    work_queue.fail(job_id, 'a', 'Transient failure')
+    (job_id, _, _) = work_queue.claim('a')
+    work_queue.fail(job_id, 'a', 'SerpApi rejected every API key', retry=False)
+    assert work_queue.claim('a') is None
+    assert work_queue.failed() == [('alpha', 'SerpApi rejected every API key')]